@@ -89,6 +89,7 @@ def train_agent(restore_prior_from='data/Prior.ckpt',
                        os.path.join(scoring_function.save_dir, f'Agent_{step}.ckpt'))
             scoring_function.write_scores()
             scoring_function.kill_dash_monitor()
+            scoring_function.shutdown_scoring_functions()
             raise
 
         # Calculate loss
@@ -144,6 +145,7 @@ def train_agent(restore_prior_from='data/Prior.ckpt',
     torch.save(Agent.rnn.state_dict(), os.path.join(scoring_function.save_dir, f'Agent_{n_steps}.ckpt'))
     scoring_function.write_scores()
     scoring_function.kill_dash_monitor()
+    scoring_function.shutdown_scoring_functions()
     
     return
 
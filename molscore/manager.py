@@ -1,5 +1,9 @@
 import os
+import gzip
+import pickle
+import shutil
 import signal
+import tempfile
 import time
 import json
 import logging
@@ -9,6 +13,7 @@ import subprocess
 import molscore.scoring_functions as scoring_functions
 from molscore import utils
 from molscore.utils import dash_utils
+from molscore.utils.run_history import RunHistory
 import molscore.scaffold_memory as scaffold_memory
 
 import pandas as pd
@@ -40,6 +45,7 @@ class MolScore:
         self.results_df = None
         self.batch_df = None
         self.exists_df = None
+        self.rescore_smiles = set()
         self.main_df = None
         self.dash_monitor = None
         self.logged_parameters = {}
@@ -64,7 +70,12 @@ class MolScore:
         else:
             if os.path.exists(self.save_dir):
                 logger.warning("Found existing directory, appending current time to distinguish")
-                self.save_dir = self.save_dir + time.strftime("_%H_%M_%S", time.localtime())
+                save_dir = self.save_dir + time.strftime("_%H_%M_%S", time.localtime())
+                # Runs started within the same second (e.g. forked sweep arms) are numbered
+                self.save_dir, n = save_dir, 1
+                while os.path.exists(self.save_dir):
+                    self.save_dir = f'{save_dir}_{n}'
+                    n += 1
             os.makedirs(self.save_dir)
             os.makedirs(os.path.join(self.save_dir, 'iterations'))
 
@@ -85,12 +96,21 @@ class MolScore:
             if fconfig['run']:
                 for fclass in scoring_functions.all_scoring_functions:
                     if fclass.__name__ == fconfig['name']:
-                        self.scoring_functions.append(fclass(**fconfig['parameters']))
+                        function = fclass(**fconfig['parameters'])
+                        # Optionally pre-screen with an online surrogate model
+                        if fconfig.get('surrogate', {}).get('run', False):
+                            function = scoring_functions.SurrogateScreen(function,
+                                                                         **fconfig['surrogate']['parameters'])
+                            self.log_parameters({f'{fconfig["name"]}_surrogate': True})
+                        self.scoring_functions.append(function)
                 if all([fclass.__name__ != fconfig['name'] for fclass in scoring_functions.all_scoring_functions]):
                     logger.warning(f'Not found associated scoring function for {fconfig["name"]}')
             else:
                 pass
         assert len(self.scoring_functions) > 0, "No scoring functions assigned"
+        # Flags of surrogate predictions, which aren't reused as scores for duplicates
+        self.predicted_metrics = [function.predicted_metric for function in self.scoring_functions
+                                  if isinstance(function, scoring_functions.SurrogateScreen)]
 
         # Setup modifiers
         self.modifier_functions = utils.all_score_modifiers
@@ -124,6 +144,26 @@ class MolScore:
             self.init_time = time.time() - self.main_df['absolute_time'].iloc[-1]
             # Update max min
             self.update_maxmin(df=self.main_df)
+            # Restore diversity filter memory
+            if (self.diversity_filter is not None) and \
+                    os.path.exists(os.path.join(self.save_dir, 'scaffold_memory.jsonl')):
+                n = self.diversity_filter.loadJournal(os.path.join(self.save_dir, 'scaffold_memory.jsonl'))
+                logger.info(f'Restored {n} diversity filter memory entries from previous run')
+
+        # Journal diversity filter memory insertions so the filter can be restored
+        if self.diversity_filter is not None:
+            self.diversity_filter.openJournal(os.path.join(self.save_dir, 'scaffold_memory.jsonl'))
+
+        # Setup queryable run history (sharing the diversity filter scaffold cache)
+        history_path = os.path.join(self.save_dir, 'scores.db')
+        history_exists = os.path.exists(history_path)
+        self.history = RunHistory(history_path,
+                                  index_columns=[self.configs['scoring']['method'],
+                                                 f"filtered_{self.configs['scoring']['method']}"] +
+                                                [metric['name'] for metric in self.configs['scoring']['metrics']],
+                                  scaffold_cache=getattr(self.diversity_filter, '_scaffoldcache', None))
+        if self.configs['load_from_previous'] and not history_exists:
+            self.history.add(self.main_df)
 
         logger.info('molscore initiated')
 
@@ -196,8 +236,39 @@ class MolScore:
                     self.batch_df.loc[self.batch_df.smiles == smi, 'unique'] = 'false'
                     self.batch_df.loc[self.batch_df.smiles == smi, 'occurrences'] += self.exists_df.smiles[
                         self.exists_df.smiles == smi].count()
+
+        # Surrogate predictions aren't scores, so molecules that were only predicted are scored again
+        predicted = self.predicted_rows(self.exists_df)
+        self.rescore_smiles = set(self.exists_df.smiles[predicted]) - set(self.exists_df.smiles[~predicted])
+        self.exists_df = self.exists_df[~predicted]
         return self
 
+    def predicted_rows(self, df):
+        """
+        Rows of a dataframe where any metric is a surrogate model prediction rather than a score.
+
+        :param df: Dataframe
+        :return: Boolean series
+        """
+        columns = [column for column in self.predicted_metrics if column in df.columns]
+        if len(columns) == 0:
+            return pd.Series(False, index=df.index)
+        return (df.loc[:, columns] == 'true').any(axis=1)
+
+    def fill_missing(self, df):
+        """
+        Fill missing values with 0.0, except in rows with surrogate predictions where metrics the surrogate didn't
+         predict are left missing rather than given a score.
+
+        :param df: Dataframe
+        :return: Dataframe
+        """
+        predicted = self.predicted_rows(df)
+        if not predicted.any():
+            return df.fillna(0.0)
+        df.loc[~predicted] = df.loc[~predicted].fillna(0.0)
+        return df
+
     def run_scoring_functions(self, smiles: list, file_names: list):
         """
         Calculate respective scoring function scores for a list of unique smiles
@@ -207,8 +278,9 @@ class MolScore:
         :param file_names: A corresponding list of file prefixes for tracking - format={step}_{batch_idx}
         :return: self.results (a list of dictionaries with smiles and resulting scores)
         """
+        metrics = [metric['name'] for metric in self.configs['scoring']['metrics']]
         for function in self.scoring_functions:
-            results = function(smiles=smiles, directory=self.save_dir, file_names=file_names)
+            results = function(smiles=smiles, directory=self.save_dir, file_names=file_names, metrics=metrics)
             results_df = pd.DataFrame(results)
 
             if self.results_df is None:
@@ -224,7 +296,7 @@ class MolScore:
         """
         logger.debug('    Merging results to batch df')
         self.batch_df = self.batch_df.merge(self.results_df, on='smiles', how='left', sort=False)
-        self.batch_df.fillna(0.0, inplace=True)
+        self.batch_df = self.fill_missing(self.batch_df)
         return self
 
     def concurrent_update(self):
@@ -250,7 +322,7 @@ class MolScore:
         # Merge with batch_df
         logger.debug('    Merging results to batch df')
         self.batch_df = self.batch_df.merge(self.results_df, on='smiles', how='left', sort=False)
-        self.batch_df.fillna(0.0, inplace=True)
+        self.batch_df = self.fill_missing(self.batch_df)
         return self
 
     def update_maxmin(self, df):
@@ -321,17 +393,14 @@ class MolScore:
 
         # Run through diversity filter if applicable
         if self.diversity_filter is not None:
-            scores_dict = {"total_score": np.asarray(df[self.configs['scoring']['method']].tolist(),
-                                                     dtype=np.float32),
-                           "step": [self.step] * len(df)}
-            filtered_scores = self.diversity_filter.score(smiles=df['smiles'].tolist(),
-                                                          scores_dict=scores_dict)
-            df["passes_diversity_filter"] = ['true' if a == b else 'false'
-                                             for b, a in
-                                             zip(df[self.configs['scoring']['method']],
-                                                 filtered_scores)]
+            filtered_scores, passes = self.diversity_filter.score_batch(
+                smiles=df['smiles'].tolist(),
+                scores=np.asarray(df[self.configs['scoring']['method']].tolist(), dtype=np.float32),
+                columns={"step": np.full(len(df), self.step, dtype=np.float64)})
+            df["passes_diversity_filter"] = np.where(passes, 'true', 'false')
             df[f"filtered_{self.configs['scoring']['method']}"] = filtered_scores
             df.fillna(1e-6)
+            self.diversity_filter.flushJournal()
 
         return df
 
@@ -356,10 +425,163 @@ class MolScore:
         if self.diversity_filter is not None:
             self.diversity_filter.savetocsv(os.path.join(self.save_dir, 'scaffold_memory.csv'))
 
+        self.shutdown_scoring_functions()
         self.fh.close()
 
         return self
 
+    def query(self, **kwargs):
+        """
+        Query molecules scored so far (from the SQLite run history save_dir/scores.db, rather than loading csv
+         files), e.g. ms.query(top=100, by='amean'), ms.query(steps=(500, 600)) or ms.query(scaffold='c1ccccc1').
+
+        :param kwargs: See RunHistory.query
+        :return: pd.DataFrame
+        """
+        return self.history.query(**kwargs)
+
+    def snapshot(self, path: str = None):
+        """
+        Save the state of this run (step, time, scores history, metric max/min, diversity filter memory and scoring
+         function state such as surrogate models) to a compressed pickle, see fork.
+
+        :param path: Snapshot file (default save_dir/snapshots/{step}.pkl.gz)
+        :return: Snapshot file
+        """
+        if path is None:
+            os.makedirs(os.path.join(self.save_dir, 'snapshots'), exist_ok=True)
+            path = os.path.join(self.save_dir, 'snapshots', f'{self.step:06d}.pkl.gz')
+
+        journal = os.path.join(self.save_dir, 'scaffold_memory.jsonl')
+        if self.diversity_filter is not None:
+            self.diversity_filter.flushJournal()
+        state = {
+            'save_dir': self.save_dir,
+            'step': self.step,
+            'elapsed': time.time() - self.init_time,
+            'main_df': self.main_df,
+            'logged_parameters': self.logged_parameters,
+            'maxmin': {metric['name']: {k: metric['parameters'][k] for k in ['max', 'min']
+                                        if k in metric['parameters']}
+                       for metric in self.configs['scoring']['metrics']},
+            'diversity_filter': self.diversity_filter,
+            # Only the part of the journal written so far belongs to this snapshot
+            'journal_size': os.path.getsize(journal) if os.path.exists(journal) else 0,
+            'iterations': sorted(os.listdir(os.path.join(self.save_dir, 'iterations'))),
+            'scoring_functions': {f'{type(function).__name__}_{getattr(function, "prefix", i)}': function.get_state()
+                                  for i, function in enumerate(self.scoring_functions)
+                                  if hasattr(function, 'get_state')}
+        }
+        with gzip.open(path, 'wb', compresslevel=1) as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info(f'Saved snapshot of step {self.step} to {path}')
+        return path
+
+    def restore(self, snapshot: str):
+        """
+        Continue this (new) run from a snapshot. Iteration files are hard linked (copied if that's not possible)
+         rather than copied so forks share them on disk. The diversity filter memory is only restored if the
+         snapshot was taken with the same filter class and clustering parameters, thresholds (nbmax, minscore,
+         outputmode) are taken from this run's config.
+
+        :param snapshot: Snapshot file from MolScore.snapshot
+        """
+        with gzip.open(snapshot, 'rb') as f:
+            state = pickle.load(f)
+
+        self.step = state['step']
+        self.init_time = time.time() - state['elapsed']
+        self.main_df = state['main_df']
+        self.logged_parameters.update(state['logged_parameters'])
+        for metric in self.configs['scoring']['metrics']:
+            metric['parameters'].update(state['maxmin'].get(metric['name'], {}))
+
+        for i, function in enumerate(self.scoring_functions):
+            key = f'{type(function).__name__}_{getattr(function, "prefix", i)}'
+            if hasattr(function, 'set_state') and (key in state['scoring_functions']):
+                function.set_state(state['scoring_functions'][key])
+
+        # Share history chunks with the source run
+        for file in state['iterations']:
+            src = os.path.join(state['save_dir'], 'iterations', file)
+            dst = os.path.join(self.save_dir, 'iterations', file)
+            if os.path.exists(dst) or not os.path.exists(src):
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+
+        # Diversity filter memory
+        snapshot_filter = state['diversity_filter']
+        if (self.diversity_filter is not None) and (snapshot_filter is not None):
+            clustering = ['minsimilarity', 'radius', 'useFeatures', 'bits', 'lsh', 'num_perm', 'bands',
+                          'max_leaders', 'eviction']
+            new_parameters = self.diversity_filter.getParameters()
+            old_parameters = snapshot_filter.getParameters()
+            if (type(snapshot_filter) is type(self.diversity_filter)) and \
+                    all(new_parameters.get(p) == old_parameters.get(p) for p in clustering):
+                journal = os.path.join(self.save_dir, 'scaffold_memory.jsonl')
+                self.diversity_filter.shutdown()
+                snapshot_filter.nbmax = self.diversity_filter.nbmax
+                snapshot_filter.minscore = self.diversity_filter.minscore
+                snapshot_filter._outputmode = self.diversity_filter._outputmode
+                snapshot_filter.n_jobs = self.diversity_filter.n_jobs
+                self.diversity_filter = snapshot_filter
+                # The run history shared the replaced filter's scaffold cache
+                self.history.scaffold_cache = self.diversity_filter._scaffoldcache
+                # Start this run's journal with the source journal up to the snapshot
+                src = os.path.join(state['save_dir'], 'scaffold_memory.jsonl')
+                if os.path.exists(src):
+                    with open(src, 'rb') as fsrc, open(journal, 'wb') as fdst:
+                        fdst.write(fsrc.read(state['journal_size']))
+                self.diversity_filter.openJournal(journal)
+            else:
+                logger.warning('Diversity filter differs from snapshot, starting with an empty memory')
+
+        if self.main_df is not None:
+            self.history.add(self.main_df)
+
+        logger.info(f'Restored snapshot of step {self.step} from {snapshot}')
+        return self
+
+    @classmethod
+    def fork(cls, snapshot: str, config: str):
+        """
+        Start a new run (in a new directory) from a snapshot, e.g. for each arm of a hyper-parameter sweep.
+
+        :param snapshot: Snapshot file from MolScore.snapshot
+        :param config: Config of the new run (load_from_previous is ignored)
+        :return: MolScore
+        """
+        with open(config, "r") as f:
+            configs = json.loads(f.read().replace('\r', '').replace('\n', '').replace('\t', ''))
+        if configs['load_from_previous']:
+            logger.warning('Ignoring load_from_previous when forking from a snapshot')
+            configs['load_from_previous'] = False
+            tmp = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+            json.dump(configs, tmp)
+            tmp.close()
+            config = tmp.name
+            ms = cls(config)
+            os.remove(tmp.name)
+        else:
+            ms = cls(config)
+        return ms.restore(snapshot)
+
+    def shutdown_scoring_functions(self):
+        """
+        Shutdown any persistent workers held by scoring functions (and the diversity filter), and close the run
+         history database.
+        """
+        for function in self.scoring_functions:
+            if hasattr(function, 'shutdown'):
+                function.shutdown()
+        if hasattr(self.diversity_filter, 'shutdown'):
+            self.diversity_filter.shutdown()
+        self.history.close()
+        return self
+
     def run_dash_monitor(self):
         """
         Run Dash Monitor.
@@ -374,7 +596,7 @@ class MolScore:
 
     def kill_dash_monitor(self):
         """
-        Kill dash_utils monitor
+        Kill dash_utils monitor (scoring function workers are shutdown separately, see shutdown_scoring_functions)
         """
         if self.dash_monitor is None:
             logger.info('No dash monitor to kill')
@@ -457,10 +679,12 @@ class MolScore:
                 smiles_to_process_index = self.batch_df.loc[self.batch_df.valid.isin(['true', 'sanitized']),
                                                             'batch_idx'].tolist()
             else:
-                smiles_to_process = self.batch_df.loc[(self.batch_df.valid.isin(['true', 'sanitized'])) &
-                                                      (self.batch_df.unique == 'true'), 'smiles'].tolist()
-                smiles_to_process_index = self.batch_df.loc[(self.batch_df.valid.isin(['true', 'sanitized'])) &
-                                                            (self.batch_df.unique == 'true'), 'batch_idx'].tolist()
+                # Including the first occurrence of molecules that only have surrogate predictions
+                to_process = (self.batch_df.valid.isin(['true', 'sanitized'])) & \
+                             ((self.batch_df.unique == 'true') |
+                              (self.batch_df.smiles.isin(self.rescore_smiles) & ~self.batch_df.smiles.duplicated()))
+                smiles_to_process = self.batch_df.loc[to_process, 'smiles'].tolist()
+                smiles_to_process_index = self.batch_df.loc[to_process, 'batch_idx'].tolist()
             if len(smiles_to_process) == 0:
                 # If no smiles to process then instead submit all (scoring function should handle invalid)
                 logger.info(f'    No smiles to score so submitting first 10 SMILES')
@@ -502,6 +726,7 @@ class MolScore:
 
             # Write out csv log for each iteration
             self.batch_df.to_csv(os.path.join(self.save_dir, 'iterations', f'{self.step:06d}_scores.csv'))
+            self.history.add(self.batch_df)
 
             # Start dash_utils monitor to track iteration files once first one is written!
             if self.dash_monitor is True:
@@ -520,6 +745,7 @@ class MolScore:
             # Clean up class
             self.batch_df = None
             self.exists_df = None
+            self.rescore_smiles = set()
             self.results_df = None
 
             return scores
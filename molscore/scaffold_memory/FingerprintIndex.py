@@ -0,0 +1,193 @@
+# coding=utf-8
+"""
+Append-only index of cluster centroid fingerprints for the similarity based scaffold filters
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rdkit import DataStructs
+
+# Number of set bits per byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class FingerprintIndex(object):
+    """
+    Cluster keys with their fingerprints, in insertion order. Bit vector fingerprints are packed into a uint8 matrix
+     (grown in amortized chunks) so similarities to all centroids are computed with numpy, other fingerprints
+     (e.g. sparse count or atom pair fingerprints) are kept in a list and compared with RDKit.
+    """
+
+    def __init__(self, chunk_size=1024, max_chunk_bytes=64 * 1024 ** 2):
+        """
+        :param chunk_size: Initial number of rows allocated for packed fingerprints
+        :param max_chunk_bytes: Maximum size of intermediate arrays when computing similarities
+        """
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self._keys = []
+        self._rows = {}
+        self.dense = None
+        self.n_bits = None
+        self._packed = None
+        self._popcounts = None
+        self._fps = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def key(self, row):
+        return self._keys[row]
+
+    def row(self, key):
+        """
+        Row index of a cluster key, or None if not found.
+        """
+        return self._rows.get(key)
+
+    def values(self):
+        return [self.get(key) for key in self._keys]
+
+    def items(self):
+        return [(key, self.get(key)) for key in self._keys]
+
+    def _setup(self, fp):
+        self.dense = isinstance(fp, DataStructs.ExplicitBitVect)
+        if self.dense:
+            self.n_bits = fp.GetNumBits()
+            self._packed = np.zeros((self.chunk_size, (self.n_bits + 7) // 8), dtype=np.uint8)
+            self._popcounts = np.zeros(self.chunk_size, dtype=np.int32)
+
+    def pack(self, fps):
+        """
+        Pack bit vector fingerprints into a uint8 matrix.
+        :param fps: List of ExplicitBitVect
+        :return: (packed fingerprints [n x n_bytes], popcounts [n])
+        """
+        bits = np.zeros((len(fps), self.n_bits), dtype=np.uint8)
+        for i, fp in enumerate(fps):
+            DataStructs.ConvertToNumpyArray(fp, bits[i])
+        packed = np.packbits(bits, axis=1)
+        return packed, _POPCOUNT[packed].sum(axis=1, dtype=np.int32)
+
+    def add(self, key, fp):
+        """
+        Add (or replace) the fingerprint for a cluster key.
+        """
+        if self.dense is None:
+            self._setup(fp)
+
+        if key in self._rows:
+            row = self._rows[key]
+        else:
+            row = len(self._keys)
+            self._keys.append(key)
+            self._rows[key] = row
+        self._set(row, fp)
+
+    def replace(self, old_key, key, fp):
+        """
+        Reuse the row of a cluster key for a new key and fingerprint (e.g. to evict a cluster from a bounded index).
+        :return: Row index
+        """
+        row = self._rows.pop(old_key)
+        self._keys[row] = key
+        self._rows[key] = row
+        self._set(row, fp)
+        return row
+
+    def _set(self, row, fp):
+        if self.dense:
+            if row >= len(self._packed):
+                grow = max(self.chunk_size, len(self._packed))
+                self._packed = np.vstack([self._packed, np.zeros((grow, self._packed.shape[1]), dtype=np.uint8)])
+                self._popcounts = np.concatenate([self._popcounts, np.zeros(grow, dtype=np.int32)])
+            packed, popcounts = self.pack([fp])
+            self._packed[row] = packed[0]
+            self._popcounts[row] = popcounts[0]
+        else:
+            if row < len(self._fps):
+                self._fps[row] = fp
+            else:
+                self._fps.append(fp)
+
+    def get(self, key):
+        """
+        Fingerprint for a cluster key (as an ExplicitBitVect for bit vector fingerprints).
+        """
+        row = self._rows[key]
+        if not self.dense:
+            return self._fps[row]
+        bits = np.unpackbits(self._packed[row])[:self.n_bits]
+        return DataStructs.CreateFromBitString(''.join(map(str, bits.tolist())))
+
+    def _tanimoto(self, q_packed, q_counts, f_packed, f_counts):
+        """
+        Tanimoto similarity between packed query and reference fingerprints, chunked over references.
+        """
+        n_q, n_bytes = q_packed.shape
+        sims = np.zeros((n_q, len(f_packed)), dtype=np.float64)
+        step = max(1, self.max_chunk_bytes // max(1, n_q * n_bytes))
+        for start in range(0, len(f_packed), step):
+            chunk = f_packed[start:start + step]
+            inter = _POPCOUNT[q_packed[:, None, :] & chunk[None, :, :]].sum(axis=2, dtype=np.int32)
+            union = q_counts[:, None] + f_counts[None, start:start + step] - inter
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sims[:, start:start + step] = np.where(union > 0, inter / union, 0.0)
+        return sims
+
+    def nearest(self, fps, n_jobs=1):
+        """
+        Most similar stored fingerprint for each query (first in insertion order if tied).
+        :param fps: List of query fingerprints
+        :param n_jobs: Number of threads to split queries over (numpy releases the GIL)
+        :return: (row indexes [n], similarities [n]), -1 and -1.0 if the index is empty
+        """
+        if (n_jobs > 1) and self.dense and (len(fps) >= 2 * n_jobs):
+            size = -(-len(fps) // n_jobs)
+            with ThreadPoolExecutor(n_jobs) as executor:
+                results = list(executor.map(self.nearest, [fps[i:i + size] for i in range(0, len(fps), size)]))
+            return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+        idx = np.full(len(fps), -1, dtype=np.int64)
+        sims = np.full(len(fps), -1.0, dtype=np.float64)
+        if (len(self._keys) == 0) or (len(fps) == 0):
+            return idx, sims
+
+        if self.dense:
+            n = len(self._keys)
+            q_packed, q_counts = self.pack(fps)
+            all_sims = self._tanimoto(q_packed, q_counts, self._packed[:n], self._popcounts[:n])
+            idx = np.argmax(all_sims, axis=1)
+            sims = all_sims[np.arange(len(fps)), idx]
+        else:
+            for i, fp in enumerate(fps):
+                row_sims = DataStructs.BulkTanimotoSimilarity(fp, self._fps)
+                idx[i] = int(np.argmax(row_sims))
+                sims[i] = row_sims[idx[i]]
+        return idx, sims
+
+    def pairwise(self, fps):
+        """
+        Similarity matrix between query fingerprints.
+        :param fps: List of query fingerprints
+        :return: ndarray [n x n]
+        """
+        if len(fps) == 0:
+            return np.zeros((0, 0))
+        if self.dense is None:
+            self._setup(fps[0])
+        if self.dense:
+            q_packed, q_counts = self.pack(fps)
+            return self._tanimoto(q_packed, q_counts, q_packed, q_counts)
+        return np.asarray([DataStructs.BulkTanimotoSimilarity(fp, fps) for fp in fps], dtype=np.float64)
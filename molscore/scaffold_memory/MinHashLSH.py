@@ -0,0 +1,135 @@
+# coding=utf-8
+"""
+Approximate nearest cluster search over sparse count fingerprints (e.g. atom pairs) with MinHash locality sensitive
+ hashing
+"""
+
+import numpy as np
+from rdkit import DataStructs
+
+from molscore.scaffold_memory.FingerprintIndex import FingerprintIndex
+
+# Mersenne prime for universal hashing, all intermediate products fit in 64 bits
+_PRIME = (1 << 31) - 1
+
+
+class MinHashLSH(FingerprintIndex):
+    """
+    Fingerprint index that only compares queries to candidate clusters sharing a band of their MinHash signature.
+     Count fingerprints are expanded to a set of (feature, k) for k up to the count, so signature collisions estimate
+     the weighted Jaccard (i.e. RDKit Tanimoto) similarity of count vectors. Candidates are re-ranked with exact
+     Tanimoto similarity, so only recall is approximate: a cluster with similarity s is a candidate with probability
+     1 - (1 - s^r)^bands where r = num_perm / bands.
+    """
+
+    def __init__(self, num_perm=128, bands=32, seed=1234, **kwargs):
+        """
+        :param num_perm: Number of hash functions in a signature
+        :param bands: Number of bands, more bands give higher recall (and more candidates) at lower similarities
+        :param seed: Random seed for hash functions
+        :param kwargs: Passed to FingerprintIndex
+        """
+        assert num_perm % bands == 0, "num_perm must be divisible by bands"
+        super(MinHashLSH, self).__init__(**kwargs)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+        self._buckets = [{} for _ in range(bands)]
+
+    def _setup(self, fp):
+        # Always keep RDKit fingerprints, similarities are only computed for candidates
+        self.dense = False
+
+    @staticmethod
+    def elements(fp):
+        """
+        {feature: count} of a sparse count fingerprint (or bit vector, with counts of 1).
+        """
+        if hasattr(fp, 'GetNonzeroElements'):
+            return fp.GetNonzeroElements()
+        return {bit: 1 for bit in fp.GetOnBits()}
+
+    def signature(self, fp):
+        """
+        MinHash signature of the expanded feature multiset.
+        :return: ndarray [num_perm]
+        """
+        elements = self.elements(fp)
+        if not elements:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        features = np.fromiter(elements.keys(), dtype=np.int64, count=len(elements))
+        counts = np.fromiter(elements.values(), dtype=np.int64, count=len(elements))
+        # Expand to (feature, k) for k in 1..count
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        k = np.arange(counts.sum(), dtype=np.int64) - offsets + 1
+        tokens = ((np.repeat(features, counts) % _PRIME) * 40503 + k * 2654435761) % _PRIME
+        hashes = (self._a[None, :] * tokens.astype(np.uint64)[:, None] + self._b[None, :]) % np.uint64(_PRIME)
+        return hashes.min(axis=0)
+
+    def _bands(self, signature):
+        r = self.rows_per_band
+        return [signature[i * r:(i + 1) * r].tobytes() for i in range(self.bands)]
+
+    def add(self, key, fp):
+        new = key not in self._rows
+        super(MinHashLSH, self).add(key, fp)
+        if new:
+            row = self._rows[key]
+            for band, bucket in zip(self._bands(self.signature(fp)), self._buckets):
+                bucket.setdefault(band, []).append(row)
+
+    def candidates(self, fp):
+        """
+        Rows sharing at least one signature band with a fingerprint, in insertion order.
+        """
+        rows = set()
+        for band, bucket in zip(self._bands(self.signature(fp)), self._buckets):
+            rows.update(bucket.get(band, ()))
+        return sorted(rows)
+
+    def pairwise(self, fps):
+        """
+        Similarity matrix between query fingerprints, only computed for pairs sharing a signature band (i.e. that
+         would be candidates once either is added), so clusters started earlier in a batch are found as if they
+         had been added before it.
+        :param fps: List of query fingerprints
+        :return: ndarray [n x n], -1.0 for pairs that aren't candidates
+        """
+        sims = np.full((len(fps), len(fps)), -1.0, dtype=np.float64)
+        candidates = [set() for _ in fps]
+        signatures = [self._bands(self.signature(fp)) for fp in fps]
+        for b in range(self.bands):
+            bucket = {}
+            for i, bands in enumerate(signatures):
+                bucket.setdefault(bands[b], []).append(i)
+            for rows in bucket.values():
+                for i in rows:
+                    candidates[i].update(rows)
+        for i, fp in enumerate(fps):
+            rows = sorted(candidates[i])
+            sims[i, rows] = DataStructs.BulkTanimotoSimilarity(fp, [fps[row] for row in rows])
+        return sims
+
+    def nearest(self, fps, n_jobs=1):
+        """
+        Most similar candidate fingerprint for each query (first in insertion order if tied).
+        :param fps: List of query fingerprints
+        :param n_jobs: Ignored
+        :return: (row indexes [n], similarities [n]), -1 and -1.0 if there are no candidates
+        """
+        idx = np.full(len(fps), -1, dtype=np.int64)
+        sims = np.full(len(fps), -1.0, dtype=np.float64)
+        if len(self._keys) == 0:
+            return idx, sims
+        for i, fp in enumerate(fps):
+            rows = self.candidates(fp)
+            if not rows:
+                continue
+            row_sims = DataStructs.BulkTanimotoSimilarity(fp, [self._fps[row] for row in rows])
+            best = int(np.argmax(row_sims))
+            idx[i] = rows[best]
+            sims[i] = row_sims[best]
+        return idx, sims
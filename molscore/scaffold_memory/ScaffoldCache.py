@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+Batched Murcko scaffold extraction with a least-recently-used cache
+"""
+
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from rdkit import Chem, rdBase
+from rdkit.Chem.Scaffolds import MurckoScaffold
+
+rdBase.DisableLog('rdApp.error')
+
+
+def getScaffolds(smile):
+    """
+    Murcko and generic Murcko scaffold SMILES, '' if the SMILES can't be parsed and None if the scaffold can't be
+     computed.
+    :return: (murcko, generic)
+    """
+    mol = Chem.MolFromSmiles(smile)
+    if not mol:
+        return '', ''
+    try:
+        scaffold = MurckoScaffold.GetScaffoldForMol(mol)
+        murcko = Chem.MolToSmiles(scaffold, isomericSmiles=False)
+    except Exception:
+        return None, None
+    try:
+        generic = Chem.MolToSmiles(MurckoScaffold.MakeScaffoldGeneric(scaffold), isomericSmiles=False)
+    except Exception:
+        generic = None
+    return murcko, generic
+
+
+class ScaffoldCache(object):
+    """
+    Map SMILES (canonical, as passed by MolScore) to (Murcko, generic) scaffold SMILES, computing misses in batch
+     (in worker processes for large batches) and keeping the most recently used results.
+    """
+
+    def __init__(self, max_size=100000, n_jobs=1, parallel_threshold=1000):
+        """
+        :param max_size: Maximum number of cached SMILES
+        :param n_jobs: Number of worker processes for large batches (started on first use and kept until shutdown)
+        :param parallel_threshold: Minimum number of cache misses in a batch to use worker processes
+        """
+        self.max_size = max_size
+        self.n_jobs = n_jobs
+        self.parallel_threshold = parallel_threshold
+        self._cache = OrderedDict()
+        self.pool = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, smile):
+        return smile in self._cache
+
+    def get(self, smile):
+        return self.get_many([smile])[0]
+
+    def get_many(self, smiles):
+        """
+        :param smiles: List of SMILES
+        :return: List of (murcko, generic)
+        """
+        misses = []
+        for smi in smiles:
+            if smi in self._cache:
+                self._cache.move_to_end(smi)
+            else:
+                misses.append(smi)
+        misses = list(dict.fromkeys(misses))
+        self.hits += len(smiles) - len(misses)
+        self.misses += len(misses)
+
+        if misses:
+            if (self.n_jobs > 1) and (len(misses) >= self.parallel_threshold):
+                if self.pool is None:
+                    self.pool = Pool(self.n_jobs)
+                chunksize = max(1, len(misses) // (self.n_jobs * 4))
+                results = self.pool.map(getScaffolds, misses, chunksize=chunksize)
+            else:
+                results = [getScaffolds(smi) for smi in misses]
+            new = dict(zip(misses, results))
+        else:
+            new = {}
+
+        # Look up before inserting, in case the batch is larger than the cache
+        scaffolds = [new[smi] if smi in new else self._cache[smi] for smi in smiles]
+        for smi, result in new.items():
+            self._cache[smi] = result
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return scaffolds
+
+    def __getstate__(self):
+        # Worker processes aren't copied, they are restarted on demand
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self
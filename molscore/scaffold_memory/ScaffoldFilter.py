@@ -5,33 +5,143 @@ https://github.com/tblaschke/reinvent-memory
 """
 
 import abc
+import csv
 import json
 import logging
+from multiprocessing import Pool
 
 import numpy as np
-import pandas as pd
 from rdkit import Chem
-from rdkit import DataStructs
 from rdkit.Chem import AllChem
 from rdkit.Chem.AtomPairs import Pairs
 from rdkit.Chem.Scaffolds import MurckoScaffold
 
+from molscore.scaffold_memory.FingerprintIndex import FingerprintIndex
+from molscore.scaffold_memory.MinHashLSH import MinHashLSH
+from molscore.scaffold_memory.ScaffoldJournal import ScaffoldJournal
 from molscore.scaffold_memory.ScaffoldMemory import ScaffoldMemory
 
 
+# Per worker process filter (with empty memory), set once by the pool initializer
+_worker_filter = None
+
+
+def _init_worker(name: str, parameters: dict):
+    global _worker_filter
+    _worker_filter = scaffoldFilters()[name](**parameters)
+
+
+def _worker_map(args):
+    method, smiles = args
+    return [getattr(_worker_filter, method)(smi) for smi in smiles]
+
+
 class ScaffoldFilter(ScaffoldMemory):
 
-    def __init__(self, nbmax=25, minscore=0.6, generic=False, outputmode="binary"):
-        super(ScaffoldFilter, self).__init__()
+    def __init__(self, nbmax=25, minscore=0.6, generic=False, outputmode="binary", n_jobs=1, cache_size=100000):
+        super(ScaffoldFilter, self).__init__(cache_size=cache_size, n_jobs=n_jobs)
         self.nbmax = nbmax  # number of smiles for one scaffold to score until the penalizer starts
         self.minscore = minscore  # only add smiles with a minimum score into the memory
         self.generic = generic  # store generic scaffolds or normal murcko scaffolds?
         self._scaffoldfunc = self.getGenericScaffold if generic else self.getScaffold
         self._outputmode = outputmode
+        self.n_jobs = n_jobs
+        self.parallel_threshold = 256  # Minimum number of SMILES to use worker processes in parallel_map
+        self._pool = None
 
-    @abc.abstractmethod
     def score(self, smiles, scores_dict: dict) -> np.array:
-        raise NotImplemented
+        scores = scores_dict.pop("total_score")
+        if not self.validScores(smiles, scores): return scores
+
+        filtered, _ = self.score_batch(smiles, scores, scores_dict)
+        if isinstance(scores, np.ndarray):
+            scores[:] = filtered
+            return scores
+        return filtered.tolist()
+
+    @abc.abstractmethod
+    def assign(self, smiles, scores):
+        """
+        Cluster of each SMILES, as if they were added to memory one after another.
+        :param smiles: List of SMILES
+        :param scores: Array of total scores
+        :return: (clusters, fingerprints) lists aligned with smiles, clusters are None for molecules that aren't
+         considered (e.g. below minscore) and fingerprints are only given for molecules starting a new cluster
+        """
+        raise NotImplementedError
+
+    def score_batch(self, smiles, scores, columns=None, clusters=None):
+        """
+        Penalize a batch of scores according to the bucket of each molecule, adding molecules passing minscore to
+         memory. Only memory insertion is done per molecule, penalties are computed on arrays.
+        :param smiles: List of SMILES
+        :param scores: Array of total scores
+        :param columns: Dict of additional arrays saved to memory with each molecule (e.g. {"step": [...]})
+        :param clusters: Precomputed (clusters, fingerprints) from assign
+        :return: (filtered scores, passes i.e. whether the score was not penalized)
+        """
+        scores = np.asarray(scores)
+        if clusters is None:
+            clusters = self.assign(smiles, scores)
+        counts, penalized = self._commit(smiles, scores, columns, *clusters)
+        multipliers = self.calculate_outputs(counts)
+        multipliers[penalized] = 0
+        filtered = self._penalize(scores, multipliers)
+        return filtered, filtered == scores
+
+    def _commit(self, smiles, scores, columns, clusters, fingerprints, check_memory=True):
+        """
+        Add molecules to memory in order. Molecules already in memory are penalized, others passing minscore are
+         added and the count of their bucket (after adding) recorded.
+        :return: (counts, penalized) arrays
+        """
+        counts = np.zeros(len(smiles), dtype=np.int64)
+        penalized = np.zeros(len(smiles), dtype=bool)
+        score_list = scores.tolist()
+        columns = {k: np.asarray(v, dtype=np.float64).tolist() for k, v in (columns or {}).items()}
+        for i, cluster in enumerate(clusters):
+            if cluster is None:
+                continue
+            if check_memory and self.has(cluster, smiles[i]):
+                penalized[i] = True
+            elif score_list[i] >= self.minscore:
+                save_score = {"total_score": float(score_list[i])}
+                for k, column in columns.items():
+                    save_score[k] = column[i]
+                fingerprint = fingerprints[i]
+                self._update_memory([smiles[i]], [cluster], [save_score],
+                                    [fingerprint] if fingerprint is not None else None)
+                counts[i] = self.count(cluster)
+        return counts, penalized
+
+    def parallel_map(self, method, smiles):
+        """
+        Call a method that doesn't depend on memory (e.g. computing a fingerprint) for each SMILES, in worker
+         processes for large batches (started on first use and kept until shutdown).
+        :param method: Name of the method
+        :param smiles: List of SMILES
+        :return: List of results
+        """
+        if (self.n_jobs <= 1) or (len(smiles) < self.parallel_threshold):
+            return [getattr(self, method)(smi) for smi in smiles]
+        if self._pool is None:
+            self._pool = Pool(self.n_jobs, initializer=_init_worker,
+                              initargs=(type(self).__name__, self.getParameters()))
+        size = -(-len(smiles) // (self.n_jobs * 4))
+        chunks = [(method, smiles[i:i + size]) for i in range(0, len(smiles), size)]
+        return [r for chunk in self._pool.map(_worker_map, chunks) for r in chunk]
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_pool'] = None
+        return state
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return super().shutdown()
 
     def validScores(self, smiles, scores) -> bool:
         if not len(smiles) == len(scores):
@@ -44,26 +154,33 @@ class ScaffoldFilter(ScaffoldMemory):
 
     def savetojson(self, file):
         savedict = {'nbmax':      self.nbmax, 'minscore': self.minscore, 'generic': self.generic,
-                    "_scaffolds": self._scaffolds}
+                    "_scaffolds": self._scaffolds.to_dict()}
         jsonstr = json.dumps(savedict, sort_keys=True, indent=4, separators=(',', ': '))
         with open(file, 'w') as f:
             f.write(jsonstr)
 
     def savetocsv(self, file):
-        df = {"Cluster": [], "Scaffold": [], "SMILES": []}
-        for i, scaffold in enumerate(self._scaffolds):
-            for smi, score in self._scaffolds[scaffold].items():
-                df["Cluster"].append(i)
-                df["Scaffold"].append(scaffold)
-                df["SMILES"].append(smi)
-                for item in score.keys():
-                    if item in df:
-                        df[item].append(score[item])
-                    else:
-                        df[item] = [score[item]]
-
-        df = pd.DataFrame(df)
-        df.to_csv(file, index=False)
+        """
+        Write memory members to csv one row at a time (missing scores are left empty).
+        """
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Cluster", "Scaffold", "SMILES"] + self._scaffolds.columns())
+            for row in self._scaffolds.iter_rows():
+                writer.writerow(row[:3] + ['' if np.isnan(v) else v for v in row[3:]])
+
+    def getParameters(self):
+        """
+        Parameters to re-initialize this filter with, see loadScaffoldFilter.
+        """
+        parameters = {'nbmax': self.nbmax, 'minscore': self.minscore, 'outputmode': self._outputmode}
+        for p in ['minsimilarity', 'radius', 'useFeatures', 'bits', 'lsh', 'num_perm', 'bands']:
+            if hasattr(self, p):
+                parameters[p] = getattr(self, p)
+        return parameters
+
+    def journalHeader(self):
+        return {"class": type(self).__name__, "parameters": self.getParameters()}
 
     def _sigmoid(self, x, k=0.15):
         # sigmoid function
@@ -87,35 +204,51 @@ class ScaffoldFilter(ScaffoldMemory):
             else:  #self._outputmode == "binary"
                 return 1
 
-            
-class ScaffoldMatcher(ScaffoldFilter):
-    def __init__(self, nbmax=25, minscore=0.6, generic=False, outputmode="binary"):
-        super().__init__(nbmax=nbmax, minscore=minscore, generic=generic, outputmode=outputmode)
+    def _penalize(self, scores, multipliers):
+        """
+        Multiply scores by penalties, with the same type promotion as a scalar score * calculate_output.
+        """
+        dtype = (scores.dtype.type(1) * self.calculate_output(1)).dtype
+        return (scores.astype(dtype) * multipliers.astype(dtype)).astype(scores.dtype)
 
-    def score(self, smiles, scores_dict: dict) -> np.array:
-        scores = scores_dict.pop("total_score")
-        if not self.validScores(smiles, scores): return scores
+    def calculate_outputs(self, nb_in_bucket: np.ndarray) -> np.ndarray:
+        """
+        calculate_output for an array of bucket counts.
+        """
+        frac = np.asarray(nb_in_bucket, dtype=np.float64) / self.nbmax
+        if self._outputmode == "sigmoid":
+            outputs = 1 - self._sigmoid(frac)
+        elif self._outputmode == "linear":
+            outputs = 1 - frac
+        else:  # self._outputmode == "binary"
+            outputs = np.ones_like(frac)
+        outputs[frac > 1] = 0
+        outputs[frac == 0] = 1
+        return outputs
 
-        for i, smile in enumerate(smiles):
-            score = scores[i]
-            try:
-                scaffold = self._scaffoldfunc(smile)
-            except Exception:
-                scaffold = ''
-                scores[i] = 0
-            if self.has(scaffold, smile):
-                scores[i] = 0
-            elif score >= self.minscore:
-                save_score = {"total_score": float(score)}
-                for k in scores_dict:
-                    save_score[k] = float(scores_dict[k][i])
-                self._update_memory([smile], [scaffold], [save_score])
-                scores[i] = scores[i] * self.calculate_output(len(self[scaffold]))
-        return scores
+            
+class ScaffoldMatcher(ScaffoldFilter):
+    def __init__(self, nbmax=25, minscore=0.6, generic=False, outputmode="binary", n_jobs=1, cache_size=100000):
+        super().__init__(nbmax=nbmax, minscore=minscore, generic=generic, outputmode=outputmode, n_jobs=n_jobs,
+                         cache_size=cache_size)
+
+    def assign(self, smiles, scores):
+        return self.getScaffolds(smiles, generic=self.generic, strict=False), [None] * len(smiles)
+
+    def score_batch(self, smiles, scores, columns=None, clusters=None):
+        scaffolds, fingerprints = clusters if clusters is not None else self.assign(smiles, scores)
+        # Molecules whose scaffold can't be computed are saved under '' but always penalized
+        failed = np.asarray([scaffold is None for scaffold in scaffolds], dtype=bool)
+        scaffolds = ['' if scaffold is None else scaffold for scaffold in scaffolds]
+        filtered, passes = super().score_batch(smiles, scores, columns, (scaffolds, fingerprints))
+        if failed.any():
+            filtered[failed] = 0
+            passes = filtered == np.asarray(scores)
+        return filtered, passes
 
     def savetojson(self, file):
         savedict = {'nbmax':      self.nbmax, 'minscore': self.minscore, 'generic': self.generic,
-                    "_scaffolds": self._scaffolds}
+                    "_scaffolds": self._scaffolds.to_dict()}
         jsonstr = json.dumps(savedict, sort_keys=True, indent=4, separators=(',', ': '))
         with open(file, 'w') as f:
             f.write(jsonstr)
@@ -124,217 +257,391 @@ class ScaffoldMatcher(ScaffoldFilter):
 class IdenticalMurckoScaffold(ScaffoldMatcher):
     """Penalizes compounds based on exact Murcko Scaffolds previously generated. 'minsimilarity' is ignored."""
 
-    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", **kwargs):
-        super().__init__(nbmax=nbmax, minscore=minscore, generic=False, outputmode=outputmode)
+    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", n_jobs=1, cache_size=100000,
+                 **kwargs):
+        super().__init__(nbmax=nbmax, minscore=minscore, generic=False, outputmode=outputmode, n_jobs=n_jobs,
+                         cache_size=cache_size)
 
 
 class IdenticalTopologicalScaffold(ScaffoldMatcher):
     """Penalizes compounds based on exact Topological Scaffolds previously generated. 'minsimilarity' is ignored."""
 
-    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", **kwargs):
-        super().__init__(nbmax=nbmax, minscore=minscore, generic=True, outputmode=outputmode)
+    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", n_jobs=1, cache_size=100000,
+                 **kwargs):
+        super().__init__(nbmax=nbmax, minscore=minscore, generic=True, outputmode=outputmode, n_jobs=n_jobs,
+                         cache_size=cache_size)
 
 
 class CompoundSimilarity(ScaffoldFilter):
     """Penalizes compounds based on the ECFP or FCFP Tanimoto similarity to previously generated compounds."""
 
     def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, radius=2, useFeatures=False,
-                 bits=2048, outputmode="binary", **kwargs):
-        super().__init__(nbmax=nbmax, minscore=minscore, generic=False, outputmode=outputmode)
+                 bits=2048, outputmode="binary", n_jobs=1, cache_size=100000, **kwargs):
+        super().__init__(nbmax=nbmax, minscore=minscore, generic=False, outputmode=outputmode, n_jobs=n_jobs,
+                         cache_size=cache_size)
         self.minsimilarity = minsimilarity
         self.radius = radius
         self.useFeatures = useFeatures
         self.bits = bits
 
-    def score(self, smiles, scores_dict: dict) -> np.array:
-        scores = scores_dict.pop("total_score")
-        if not self.validScores(smiles, scores): return scores
-
-        for i, smile in enumerate(smiles):
-            score = scores[i]
-            if score >= self.minscore:
-                cluster, fingerprint, isnewcluster = self.findCluster(smile)
-                if self.has(cluster, smile):
-                    scores[i] = 0
-                    continue
-                save_score = {"total_score": float(score)}
-                for k in scores_dict:
-                    save_score[k] = float(scores_dict[k][i])
-                if isnewcluster:
-                    self._update_memory([smile], [cluster], [save_score], [fingerprint])
-                else:
-                    self._update_memory([smile], [cluster], [save_score])
-                scores[i] = scores[i] * self.calculate_output(len(self[cluster]))
-
-        return scores
-
-    def findCluster(self, smiles):
+    def assign(self, smiles, scores):
+        clusters = [None] * len(smiles)
+        fingerprints = [None] * len(smiles)
+        idxs = [i for i, score in enumerate(np.asarray(scores).tolist()) if score >= self.minscore]
+        for i, (cluster, fingerprint, isnewcluster) in zip(idxs, self.find_clusters([smiles[i] for i in idxs])):
+            clusters[i] = cluster
+            if isnewcluster:
+                fingerprints[i] = fingerprint
+        return clusters, fingerprints
+
+    def clusterFingerprint(self, smiles):
+        """
+        :return: (key if a new cluster, key to look up existing clusters, fingerprint) or None if invalid
+        """
         mol = Chem.MolFromSmiles(smiles)
         if not mol:
-            return "", "", False
+            return None
         if self.bits > 0:
             fp = AllChem.GetMorganFingerprintAsBitVect(mol, self.radius, nBits=self.bits, useFeatures=self.useFeatures)
         else:
             fp = AllChem.GetMorganFingerprint(mol, self.radius, useFeatures=self.useFeatures)
+        return smiles, smiles, fp
 
-        if smiles in self.getFingerprints():
-            return smiles, fp, False
-
-        fps = list(self.getFingerprints().values())
-        sims = DataStructs.BulkTanimotoSimilarity(fp, fps)
-        if len(sims) == 0:
-            return smiles, fp, True
-        closest = np.argmax(sims)
-        if sims[closest] >= self.minsimilarity:
-            return list(self.getFingerprints().keys())[closest], fp, False
-        else:
-            return smiles, fp, True
-
-
-class ScaffoldSimilarityAP(CompoundSimilarity):
-    """Penalizes compounds based on atom pair Tanimoto similarity to previously generated Murcko Scaffolds."""
-
-    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", **kwargs):
-        super().__init__(nbmax=nbmax, minscore=minscore, minsimilarity=minsimilarity, outputmode=outputmode)
+    def find_clusters(self, smiles):
+        """
+        Find the cluster of each SMILES as if they were found and added to memory one after another, i.e. a
+         SMILES can join a new cluster started earlier in the same list. Similarities to existing clusters are
+         computed in one pass, existing clusters win ties as they were added first.
+        :param smiles: List of SMILES
+        :return: List of (cluster, fingerprint, isnewcluster)
+        """
+        results = [("", "", False)] * len(smiles)
+        infos, valid, best_rows, best_sims, batch_sims = self.precompute(smiles)
+        index = self.getFingerprints()
+        index_keys = index.keys()
+
+        new_positions = []  # Positions in queries of clusters started in this batch, in order
+        new_keys = []
+        new_key_set = set()
+        for k, i in enumerate(valid):
+            key, lookup, fp = infos[i]
+            if (lookup in index) or (lookup in new_key_set):
+                results[i] = (lookup, fp, False)
+                continue
+
+            closest, closest_sim = None, -1.0
+            if best_rows[k] >= 0:
+                closest, closest_sim = index_keys[best_rows[k]], best_sims[k]
+            if new_positions:
+                sims = batch_sims[k, new_positions]
+                j = int(np.argmax(sims))
+                if sims[j] > closest_sim:
+                    closest, closest_sim = new_keys[j], sims[j]
+
+            if (closest is not None) and (closest_sim >= self.minsimilarity):
+                results[i] = (closest, fp, False)
+            else:
+                results[i] = (key, fp, True)
+                new_positions.append(k)
+                new_keys.append(key)
+                new_key_set.add(key)
+        return results
 
-    def score(self, smiles, scores_dict: dict) -> np.array:
-        scores = scores_dict.pop("total_score")
-        if not self.validScores(smiles, scores): return scores
+    def precompute(self, smiles):
+        """
+        The part of find_clusters that doesn't depend on the order of SMILES, i.e. fingerprints (in worker processes
+         for large batches), the nearest existing cluster of each at the start of the batch and similarities within
+         the batch.
+        :return: (clusterFingerprint of each SMILES, valid indexes, nearest rows, nearest similarities, batch
+         similarities)
+        """
+        infos = self.parallel_map('clusterFingerprint', smiles)
+        valid = [i for i, info in enumerate(infos) if info is not None]
+        queries = [infos[i][2] for i in valid]
+        index = self.getFingerprints()
+        best_rows, best_sims = index.nearest(queries, n_jobs=self.n_jobs)
+        batch_sims = index.pairwise(queries)
+        return infos, valid, best_rows, best_sims, batch_sims
 
-        for i, smile in enumerate(smiles):
-            score = scores[i]
-            if score >= self.minscore:
-                cluster, fingerprint, isnewcluster = self.findCluster(smile)
-                if self.has(cluster, smile):
-                    scores[i] = 0
-                    continue
-                save_score = {"total_score": float(score)}
-                for k in scores_dict:
-                    save_score[k] = float(scores_dict[k][i])
-                if isnewcluster:
-                    self._update_memory([smile], [cluster], [save_score], [fingerprint])
-                else:
-                    self._update_memory([smile], [cluster], [save_score])
-                scores[i] = scores[i] * self.calculate_output(len(self[cluster]))
+    def findCluster(self, smiles):
+        return self.find_clusters([smiles])[0]
 
-        return scores
 
-    def findCluster(self, smiles):
+class ScaffoldSimilarityAP(CompoundSimilarity):
+    """Penalizes compounds based on atom pair Tanimoto similarity to previously generated Murcko Scaffolds.
+    If 'lsh' is true, only clusters sharing a band of 'bands' in a MinHash signature of 'num_perm' hashes are
+    compared (approximate, but doesn't slow down with the number of scaffolds)."""
+
+    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, outputmode="binary", lsh=False, num_perm=128,
+                 bands=32, n_jobs=1, cache_size=100000, **kwargs):
+        super().__init__(nbmax=nbmax, minscore=minscore, minsimilarity=minsimilarity, outputmode=outputmode,
+                         n_jobs=n_jobs, cache_size=cache_size)
+        self.lsh = lsh
+        self.num_perm = num_perm
+        self.bands = bands
+        if lsh:
+            self._morganfp = MinHashLSH(num_perm=num_perm, bands=bands)
+
+    def clusterFingerprint(self, smiles):
         mol = Chem.MolFromSmiles(smiles)
         if mol:
             try:
                 scaffold = MurckoScaffold.GetScaffoldForMol(mol)
             except:
-                return "", "", False
+                return None
             if scaffold:
                 cluster = Chem.MolToSmiles(scaffold, isomericSmiles=False)
             else:
-                return "", "", False
+                return None
         else:
-            return "", "", False
+            return None
 
         fp = Pairs.GetAtomPairFingerprint(scaffold)  # Change to Tanimoto?
-        if cluster in self.getFingerprints():
-            return cluster, fp, False
-
-        fps = list(self.getFingerprints().values())
-        sims = DataStructs.BulkTanimotoSimilarity(fp, fps)
-        if len(sims) == 0:
-            return cluster, fp, True
-        closest = np.argmax(sims)
-        if sims[closest] >= self.minsimilarity:
-            return list(self.getFingerprints().keys())[closest], fp, False
-        else:
-            return cluster, fp, True
+        return cluster, cluster, fp
 
 
 class ScaffoldSimilarityT(CompoundSimilarity):
     """Penalizes compounds based on atom pair Tanimoto similarity to previously generated Murcko Scaffolds."""
 
     def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, radius=2, useFeatures=False,
-                 bits=2048, outputmode="binary", **kwargs):
-        super().__init__(nbmax=nbmax, minscore=minscore, minsimilarity=minsimilarity, outputmode=outputmode)
+                 bits=2048, outputmode="binary", n_jobs=1, cache_size=100000, **kwargs):
+        super().__init__(nbmax=nbmax, minscore=minscore, minsimilarity=minsimilarity, outputmode=outputmode,
+                         n_jobs=n_jobs, cache_size=cache_size)
         self.radius = radius
         self.useFeatures = useFeatures
         self.bits = bits
 
-    def score(self, smiles, scores_dict: dict) -> np.array:
-        scores = scores_dict.pop("total_score")
-        if not self.validScores(smiles, scores): return scores
-
-        for i, smile in enumerate(smiles):
-            score = scores[i]
-            if score >= self.minscore:
-                cluster, fingerprint, isnewcluster = self.findCluster(smile)
-                if self.has(cluster, smile):
-                    scores[i] = 0
-                    continue
-                save_score = {"total_score": float(score)}
-                for k in scores_dict:
-                    save_score[k] = float(scores_dict[k][i])
-                if isnewcluster:
-                    self._update_memory([smile], [cluster], [save_score], [fingerprint])
-                else:
-                    self._update_memory([smile], [cluster], [save_score])
-                scores[i] = scores[i] * self.calculate_output(len(self[cluster]))
-
-        return scores
-
-    def findCluster(self, smiles):
+    def clusterFingerprint(self, smiles):
         mol = Chem.MolFromSmiles(smiles)
         if mol:
             try:
                 scaffold = MurckoScaffold.GetScaffoldForMol(mol)
             except:
-                return "", "", False
+                return None
             if scaffold:
                 cluster = Chem.MolToSmiles(scaffold, isomericSmiles=False)
             else:
-                return "", "", False
+                return None
         else:
-            return "", "", False
+            return None
 
         if self.bits > 0:
             fp = AllChem.GetMorganFingerprintAsBitVect(scaffold, self.radius, nBits=self.bits,
                                                        useFeatures=self.useFeatures)
         else:
             fp = AllChem.GetMorganFingerprint(scaffold, self.radius, useFeatures=self.useFeatures)
+        # Existing clusters are looked up by the compound SMILES (as in reinvent-memory)
+        return cluster, smiles, fp
 
-        if smiles in self.getFingerprints():
-            return smiles, fp, False
 
-        fps = list(self.getFingerprints().values())
-        sims = DataStructs.BulkTanimotoSimilarity(fp, fps)
-        if len(sims) == 0:
-            return cluster, fp, True
-        closest = np.argmax(sims)
-        if sims[closest] >= self.minsimilarity:
-            return list(self.getFingerprints().keys())[closest], fp, False
-        else:
-            return cluster, fp, True
+class LeaderClustering(ScaffoldFilter):
+    """Penalizes compounds based on online leader (sphere exclusion) clustering of ECFP or FCFP fingerprints. A
+    compound joins the most similar leader with at least 'minsimilarity' Tanimoto similarity, otherwise it becomes
+    a new leader. At most 'max_leaders' leaders are kept, when full the least recently hit ('lru') or lowest scoring
+    ('score') leader is evicted. Only leaders and their counts are kept, not members."""
+
+    evictions = ['lru', 'score']
+
+    def __init__(self, nbmax=25, minscore=0.6, minsimilarity=0.6, radius=2, useFeatures=False, bits=2048,
+                 outputmode="binary", max_leaders=10000, eviction="lru", n_jobs=1, cache_size=100000, **kwargs):
+        assert eviction in self.evictions, f"eviction must be one of {self.evictions}"
+        super().__init__(nbmax=nbmax, minscore=minscore, generic=False, outputmode=outputmode, n_jobs=n_jobs,
+                         cache_size=cache_size)
+        self.minsimilarity = minsimilarity
+        self.radius = radius
+        self.useFeatures = useFeatures
+        self.bits = bits
+        self.max_leaders = max_leaders
+        self.eviction = eviction
+        self._morganfp = FingerprintIndex(chunk_size=max_leaders)
+        # Per leader row
+        self._leader_counts = np.zeros(max_leaders, dtype=np.int64)
+        self._leader_hits = np.zeros(max_leaders, dtype=np.int64)
+        self._leader_scores = np.zeros(max_leaders, dtype=np.float64)
+        self._tick = 0
+        self.evicted = 0
+
+    def getParameters(self):
+        parameters = super().getParameters()
+        parameters.update({'max_leaders': self.max_leaders, 'eviction': self.eviction})
+        return parameters
+
+    def fingerprint(self, smiles):
+        mol = Chem.MolFromSmiles(smiles)
+        if not mol:
+            return None
+        if self.bits > 0:
+            return AllChem.GetMorganFingerprintAsBitVect(mol, self.radius, nBits=self.bits,
+                                                         useFeatures=self.useFeatures)
+        return AllChem.GetMorganFingerprint(mol, self.radius, useFeatures=self.useFeatures)
+
+    def _evict(self):
+        """
+        Row of the leader to evict.
+        """
+        if self.eviction == "score":
+            return int(np.argmin(self._leader_scores))
+        return int(np.argmin(self._leader_hits))
+
+    def _update_memory(self, smiles, scaffolds, scores=None, fingerprints=None):
+        """
+        Hit the leader of each SMILES, or add it as a new leader if a fingerprint is given.
+        """
+        for i, smi in enumerate(smiles):
+            leader = scaffolds[i]
+            score = scores[i] if scores else {}
+            fp = fingerprints[i] if fingerprints is not None else None
+            if fp is not None:
+                if len(self._morganfp) < self.max_leaders:
+                    self._morganfp.add(leader, fp)
+                    row = len(self._morganfp) - 1
+                else:
+                    row = self._evict()
+                    self._morganfp.replace(self._morganfp.key(row), leader, fp)
+                    self.evicted += 1
+                self._leader_counts[row] = 0
+                self._leader_scores[row] = -np.inf
+            else:
+                row = self._morganfp.row(leader)
+            self._tick += 1
+            self._leader_counts[row] += 1
+            self._leader_hits[row] = self._tick
+            self._leader_scores[row] = max(self._leader_scores[row], score.get("total_score", 0.0))
+            if self._journal is not None:
+                self._journal.append(leader, smi, score, fp)
+
+    def has(self, scaffold, smiles):
+        return False
+
+    def count(self, scaffold):
+        row = self._morganfp.row(scaffold)
+        return int(self._leader_counts[row]) if row is not None else 0
+
+    def assign(self, smiles, scores):
+        """
+        Leaders are only found when committing (as adding a leader can evict another), so this only computes
+         fingerprints of molecules passing minscore, with clusters '' for these and None otherwise.
+        """
+        clusters = [None] * len(smiles)
+        fingerprints = [None] * len(smiles)
+        for i, score in enumerate(np.asarray(scores).tolist()):
+            if score >= self.minscore:
+                clusters[i] = ''
+        idxs = [i for i, cluster in enumerate(clusters) if cluster is not None]
+        for i, fingerprint in zip(idxs, self.parallel_map('fingerprint', [smiles[i] for i in idxs])):
+            fingerprints[i] = fingerprint
+        return clusters, fingerprints
+
+    def score_batch(self, smiles, scores, columns=None, clusters=None):
+        scores = np.asarray(scores)
+        clusters, fingerprints = clusters if clusters is not None else self.assign(smiles, scores)
+        # Invalid SMILES passing minscore are penalized
+        penalized = np.asarray([(c is not None) and (fp is None) for c, fp in zip(clusters, fingerprints)],
+                               dtype=bool)
+        idxs = [i for i, fp in enumerate(fingerprints) if fp is not None]
+        fps = [fingerprints[i] for i in idxs]
+
+        # Nearest leaders at the start of the batch, leaders added during the batch are compared to separately
+        best_rows, best_sims = self._morganfp.nearest(fps, n_jobs=self.n_jobs)
+        batch_sims = self._morganfp.pairwise(fps)
+        written = {}  # Rows (re)written during this batch: position in fps of the new leader
+
+        counts = np.zeros(len(smiles), dtype=np.int64)
+        score_list = scores.tolist()
+        columns = {k: np.asarray(v, dtype=np.float64).tolist() for k, v in (columns or {}).items()}
+        for k, i in enumerate(idxs):
+            row, sim = int(best_rows[k]), best_sims[k]
+            if row in written:
+                # Nearest leader was evicted during this batch, search again
+                row, sim = [x[0] for x in self._morganfp.nearest([fps[k]])]
+                row = int(row)
+            else:
+                for r, pos in written.items():
+                    if batch_sims[k, pos] > sim:
+                        row, sim = r, batch_sims[k, pos]
+
+            save_score = {"total_score": float(score_list[i])}
+            for key, column in columns.items():
+                save_score[key] = column[i]
+            if (row >= 0) and (sim >= self.minsimilarity):
+                leader = self._morganfp.key(row)
+                self._update_memory([smiles[i]], [leader], [save_score])
+            else:
+                leader = smiles[i]
+                self._update_memory([smiles[i]], [leader], [save_score], [fps[k]])
+                written[self._morganfp.row(leader)] = k
+            counts[i] = self.count(leader)
+
+        multipliers = self.calculate_outputs(counts)
+        multipliers[penalized] = 0
+        filtered = self._penalize(scores, multipliers)
+        return filtered, filtered == scores
+
+    def savetocsv(self, file):
+        """
+        Write current leaders to csv.
+        """
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Cluster", "SMILES", "Count", "BestScore", "LastHit"])
+            for row, leader in enumerate(self._morganfp.keys()):
+                writer.writerow([row, leader, int(self._leader_counts[row]), float(self._leader_scores[row]),
+                                 int(self._leader_hits[row])])
 
 
 class NoScaffoldFilter(ScaffoldFilter):
     """Don't penalize compounds. Only save them with more than 'minscore'. All other arguments are ignored."""
-    def __init__(self, minscore=0.6, minsimilarity=0.6, nbmax=25, outputmode="binary"):
-        super().__init__(minscore=minscore)
+    def __init__(self, minscore=0.6, minsimilarity=0.6, nbmax=25, outputmode="binary", n_jobs=1, cache_size=100000,
+                 **kwargs):
+        super().__init__(minscore=minscore, n_jobs=n_jobs, cache_size=cache_size)
 
-    def score(self, smiles, scores_dict: dict) -> np.array:
+    def assign(self, smiles, scores):
+        scaffolds = self.getScaffolds(smiles, generic=self.generic, strict=False)
+        clusters = [(scaffold if scaffold is not None else '') if score >= self.minscore else None
+                    for scaffold, score in zip(scaffolds, np.asarray(scores).tolist())]
+        return clusters, [None] * len(smiles)
+
+    def score_batch(self, smiles, scores, columns=None, clusters=None):
         """
         we only log the compounds
         """
-        scores = scores_dict.pop("total_score")
-        if not self.validScores(smiles, scores): return scores
-
-        for i, smile in enumerate(smiles):
-            score = scores[i]
-            try:
-                scaffold = self._scaffoldfunc(smile)
-            except Exception:
-                scaffold = ''
-            if score >= self.minscore:
-                save_score = {"total_score": float(score)}
-                for k in scores_dict:
-                    save_score[k] = float(scores_dict[k][i])
-                self._update_memory([smile], [scaffold], [save_score])
-        return scores
+        scores = np.asarray(scores)
+        if clusters is None:
+            clusters = self.assign(smiles, scores)
+        self._commit(smiles, scores, columns, *clusters, check_memory=False)
+        return scores.copy(), np.ones(len(smiles), dtype=bool)
+
+
+def scaffoldFilters():
+    """
+    All ScaffoldFilter subclasses by name.
+    """
+    filters = {}
+    stack = [ScaffoldFilter]
+    while stack:
+        cls = stack.pop()
+        filters[cls.__name__] = cls
+        stack.extend(cls.__subclasses__())
+    return filters
+
+
+def loadScaffoldFilter(path, **kwargs):
+    """
+    Rebuild a scaffold filter (any ScaffoldFilter subclass) and its memory from a journal.
+    :param path: Journal written with openJournal
+    :param kwargs: Override parameters recorded in the journal header (e.g. n_jobs, cache_size)
+    :return: Scaffold filter
+    """
+    header = ScaffoldJournal.header(path)
+    if header is None:
+        raise ValueError(f'No header found in {path}')
+
+    filters = scaffoldFilters()
+    if header["class"] not in filters:
+        raise ValueError(f'Unknown scaffold filter {header["class"]}')
+
+    parameters = dict(header.get("parameters", {}))
+    parameters.update(kwargs)
+    scaffold_filter = filters[header["class"]](**parameters)
+    scaffold_filter.loadJournal(path)
+    return scaffold_filter
@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Append-only on-disk journal of scaffold memory insertions, so a diversity filter can be restored in a resumed run
+"""
+
+import base64
+import json
+import logging
+import os
+
+from rdkit import DataStructs
+
+
+def encodeFingerprint(fp):
+    """
+    Serialize an RDKit fingerprint (bit vector or sparse count vector) to a JSON compatible dict.
+    """
+    return {"type": type(fp).__name__, "data": base64.b64encode(fp.ToBinary()).decode('ascii')}
+
+
+def decodeFingerprint(record):
+    """
+    Rebuild an RDKit fingerprint from encodeFingerprint.
+    """
+    return getattr(DataStructs, record["type"])(base64.b64decode(record["data"]))
+
+
+class ScaffoldJournal(object):
+    """
+    JSON lines file with one header line (filter class and parameters) followed by one line per memory insertion
+     i.e. {"scaffold": ..., "smiles": ..., "score": {...}, "fp": {...}}, where "fp" is only present for insertions
+     that started a new fingerprint cluster. Lines are buffered and written on flush.
+    """
+
+    def __init__(self, path, header=None):
+        """
+        :param path: Journal file, appended to if it exists
+        :param header: Dict written as the first line of a new journal
+        """
+        self.path = path
+        new = not os.path.exists(path) or (os.path.getsize(path) == 0)
+        truncated = False
+        if not new:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b'\n'
+        self._file = open(path, 'a')
+        self._buffer = []
+        if truncated:
+            # Terminate a partially written last line so it doesn't corrupt the next insertion
+            self._file.write('\n')
+        if new and (header is not None):
+            self._buffer.append(json.dumps({"header": header}))
+            self.flush()
+
+    def append(self, scaffold, smiles, score=None, fp=None):
+        record = {"scaffold": scaffold, "smiles": smiles, "score": score if score is not None else {}}
+        if fp is not None:
+            record["fp"] = encodeFingerprint(fp)
+        self._buffer.append(json.dumps(record))
+
+    def flush(self):
+        if self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+        self._file.flush()
+        return self
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+        return self
+
+    @staticmethod
+    def header(path):
+        """
+        Header of a journal, or None if it has none.
+        """
+        with open(path, 'r') as f:
+            line = f.readline()
+        try:
+            return json.loads(line).get("header")
+        except ValueError:
+            return None
+
+    @staticmethod
+    def read(path):
+        """
+        Iterate over insertions in a journal as (scaffold, smiles, score, fp or None). A truncated last line (e.g.
+         from a run that was killed mid-write) is skipped.
+        """
+        with open(path, 'r') as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning(f'Skipping unreadable line {n + 1} of {path}')
+                    continue
+                if "header" in record:
+                    continue
+                fp = decodeFingerprint(record["fp"]) if "fp" in record else None
+                yield record["scaffold"], record["smiles"], record["score"], fp
@@ -4,70 +4,231 @@ Adapted from
 https://github.com/tblaschke/reinvent-memory
 """
 
-from rdkit import Chem, rdBase
-from rdkit.Chem import AllChem
-from rdkit.Chem.Scaffolds import MurckoScaffold
+import logging
+from array import array
+
+import numpy as np
+from rdkit import rdBase
+
+from molscore.scaffold_memory.FingerprintIndex import FingerprintIndex
+from molscore.scaffold_memory.ScaffoldCache import ScaffoldCache
+from molscore.scaffold_memory.ScaffoldJournal import ScaffoldJournal
 
 rdBase.DisableLog('rdApp.error')
 
 
+class ScaffoldStore(object):
+    """
+    Compact storage of scaffolds and their member SMILES with scores. Scaffolds are interned to integer ids with
+     per-scaffold counts in a numpy array, members are rows of append-only typed arrays (SMILES and one float column
+     per score), each scaffold keeps a typed array of its member rows, and a dict from (scaffold id, SMILES) to row
+     backs membership checks.
+    """
+
+    def __init__(self, chunk_size=1024):
+        self.chunk_size = chunk_size
+        self._ids = {}
+        self._scaffolds = []
+        self._counts = np.zeros(chunk_size, dtype=np.int32)
+        self._member_rows = []
+        self._smiles = []
+        self._columns = {}
+        self._rows = {}
+
+    def __contains__(self, scaffold):
+        return scaffold in self._ids
+
+    def __len__(self):
+        return len(self._scaffolds)
+
+    def __iter__(self):
+        return iter(self._scaffolds)
+
+    def add(self, scaffold, smiles, score=None):
+        sid = self._ids.get(scaffold)
+        if sid is None:
+            sid = len(self._scaffolds)
+            self._ids[scaffold] = sid
+            self._scaffolds.append(scaffold)
+            self._member_rows.append(array('l'))
+            if sid >= len(self._counts):
+                self._counts = np.concatenate([self._counts, np.zeros(len(self._counts), dtype=np.int32)])
+
+        score = score if score is not None else {}
+        row = self._rows.get((sid, smiles))
+        if row is None:
+            # New member
+            row = len(self._smiles)
+            self._rows[(sid, smiles)] = row
+            self._member_rows[sid].append(row)
+            self._smiles.append(smiles)
+            self._counts[sid] += 1
+            for column in self._columns.values():
+                column.append(np.nan)
+        # New score columns are padded for previous members
+        for k in score:
+            if k not in self._columns:
+                self._columns[k] = array('d', [np.nan] * len(self._smiles))
+        for k, column in self._columns.items():
+            column[row] = float(score[k]) if k in score else np.nan
+
+    def has(self, scaffold, smiles):
+        sid = self._ids.get(scaffold)
+        return (sid is not None) and ((sid, smiles) in self._rows)
+
+    def count(self, scaffold):
+        sid = self._ids.get(scaffold)
+        return int(self._counts[sid]) if sid is not None else 0
+
+    def _score(self, row):
+        return {k: column[row] for k, column in self._columns.items() if not np.isnan(column[row])}
+
+    def members(self, scaffold):
+        """
+        Member SMILES and scores of a scaffold i.e. {smiles: {"total_score": ..., ...}}
+        """
+        sid = self._ids.get(scaffold)
+        if sid is None:
+            return {}
+        return {self._smiles[row]: self._score(row) for row in self._member_rows[sid]}
+
+    def to_dict(self):
+        """
+        Nested dict {scaffold: {smiles: score dict}} in insertion order.
+        """
+        return {scaffold: {self._smiles[row]: self._score(row) for row in rows}
+                for scaffold, rows in zip(self._scaffolds, self._member_rows)}
+
+    def columns(self):
+        """
+        Score column names in insertion order.
+        """
+        return list(self._columns.keys())
+
+    def iter_rows(self):
+        """
+        Iterate over members grouped by scaffold (in insertion order) as [cluster, scaffold, SMILES, *scores], with
+         scores in the order of columns() and NaN for missing scores.
+        """
+        columns = list(self._columns.values())
+        for sid, (scaffold, rows) in enumerate(zip(self._scaffolds, self._member_rows)):
+            for row in rows:
+                yield [sid, scaffold, self._smiles[row]] + [column[row] for column in columns]
+
+
 class ScaffoldMemory(object):
-    def __init__(self):
-        self._scaffolds = {}
-        self._morganfp = {}
+    def __init__(self, cache_size=100000, n_jobs=1):
+        self._scaffolds = ScaffoldStore()
+        self._morganfp = FingerprintIndex()
+        self._scaffoldcache = ScaffoldCache(max_size=cache_size, n_jobs=n_jobs)
+        self._journal = None
 
     def add(self, smiles, scores=None):
         if scores:
             assert len(smiles) == len(scores), "Score vector is not the same length as SMILES list"
-        scaffolds = [self.getScaffold(smi) for smi in smiles]
+        scaffolds = self.getScaffolds(smiles)
         self._update_memory(smiles, scaffolds, scores)
         return scaffolds
 
     def addGeneric(self, smiles, scores=None):
         if scores:
             assert len(smiles) == len(scores), "Score vector is not the same length as SMILES list"
-        scaffolds = [self.getGenericScaffold(smi) for smi in smiles]
+        scaffolds = self.getScaffolds(smiles, generic=True)
         self._update_memory(smiles, scaffolds, scores)
         return scaffolds
 
+    def getScaffolds(self, smiles, generic=False, strict=True):
+        """
+        Murcko (or generic) scaffolds for a batch of SMILES, from the scaffold cache.
+        :param strict: Raise if a scaffold can't be computed, otherwise return None for it
+        """
+        scaffolds = [s[1] if generic else s[0] for s in self._scaffoldcache.get_many(smiles)]
+        if strict and any(scaffold is None for scaffold in scaffolds):
+            raise ValueError('Could not compute scaffold')
+        return scaffolds
+
     def getScaffold(self, smile):
-        mol = Chem.MolFromSmiles(smile)
-        if mol:
-            scaffold = MurckoScaffold.GetScaffoldForMol(mol)
-            return Chem.MolToSmiles(scaffold, isomericSmiles=False)
-        else:
-            return ''
+        return self.getScaffolds([smile])[0]
 
     def getGenericScaffold(self, smile):
-        mol = Chem.MolFromSmiles(smile)
-        if mol:
-            scaffold = MurckoScaffold.MakeScaffoldGeneric(MurckoScaffold.GetScaffoldForMol(mol))
-            return Chem.MolToSmiles(scaffold, isomericSmiles=False)
-        else:
-            return ''
+        return self.getScaffolds([smile], generic=True)[0]
+
+    def shutdown(self):
+        self._scaffoldcache.shutdown()
+        self.closeJournal()
+        return self
+
+    def __getstate__(self):
+        # An open journal isn't copied, see openJournal
+        state = self.__dict__.copy()
+        state['_journal'] = None
+        return state
+
+    def journalHeader(self):
+        """
+        Header written to new journals, used to check (or rebuild) the memory a journal is loaded into.
+        """
+        return {"class": type(self).__name__}
+
+    def openJournal(self, path):
+        """
+        Record all subsequent memory insertions in an append-only journal.
+        """
+        self.closeJournal()
+        self._journal = ScaffoldJournal(path, header=self.journalHeader())
+        return self
+
+    def flushJournal(self):
+        if self._journal is not None:
+            self._journal.flush()
+        return self
+
+    def closeJournal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        return self
+
+    def loadJournal(self, path):
+        """
+        Replay the insertions recorded in a journal (including cluster fingerprints) into this memory.
+        :return: Number of insertions replayed
+        """
+        header = ScaffoldJournal.header(path)
+        if (header is not None) and (header.get("class") != type(self).__name__):
+            logging.warning(f'Loading journal written by {header.get("class")} into {type(self).__name__}')
+        # Don't journal the replayed insertions again
+        journal, self._journal = self._journal, None
+        n = 0
+        try:
+            for scaffold, smi, score, fp in ScaffoldJournal.read(path):
+                self._update_memory([smi], [scaffold], [score] if score else None, [fp] if fp is not None else None)
+                n += 1
+        finally:
+            self._journal = journal
+        return n
 
     def _update_memory(self, smiles, scaffolds, scores=None, fingerprints=None):
         for i, smi in enumerate(smiles):
             scaffold = scaffolds[i]
             if fingerprints is not None:
-                self._morganfp[scaffold] = fingerprints[i]
-            score = scores[i]
-            if scaffold in self._scaffolds:
-                self._scaffolds[scaffold][smi] = score
-            else:
-                self._scaffolds[scaffold] = {smi: score}
+                self._morganfp.add(scaffold, fingerprints[i])
+            score = scores[i] if scores else None
+            self._scaffolds.add(scaffold, smi, score)
+            if self._journal is not None:
+                self._journal.append(scaffold, smi, score, fingerprints[i] if fingerprints is not None else None)
 
     def has(self, scaffold, smiles):
-        if scaffold in self._scaffolds:
-            if smiles in self._scaffolds[scaffold]:
-                return True
-        return False
+        return self._scaffolds.has(scaffold, smiles)
+
+    def count(self, scaffold):
+        return self._scaffolds.count(scaffold)
 
     def getFingerprints(self):
         return self._morganfp
 
     def __getitem__(self, scaffold):
         if scaffold in self._scaffolds:
-            return self._scaffolds[scaffold]
+            return self._scaffolds.members(scaffold)
         else:
             return []
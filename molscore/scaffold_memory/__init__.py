@@ -1,10 +1,11 @@
 from molscore.scaffold_memory.ScaffoldFilter import IdenticalMurckoScaffold, IdenticalTopologicalScaffold,  \
-    CompoundSimilarity, ScaffoldSimilarityAP, ScaffoldSimilarityT
+    CompoundSimilarity, ScaffoldSimilarityAP, ScaffoldSimilarityT, LeaderClustering, loadScaffoldFilter
 
 all_scaffold_filters = [
     IdenticalMurckoScaffold,
     IdenticalTopologicalScaffold,
     CompoundSimilarity,
     ScaffoldSimilarityAP,
-    ScaffoldSimilarityT
+    ScaffoldSimilarityT,
+    LeaderClustering
 ]
\ No newline at end of file
@@ -21,26 +21,98 @@ from rdkit import Chem
 from rdkit.Chem import rdMolDescriptors
 import pickle
 
+import os
 import math
-from collections import defaultdict
+import tempfile
+import numpy as np
 
 import os.path as op
 
 _fscores = None
 
 
-def readFragmentScores(name='fpscores'):
+class FragmentScoreTable(object):
+    """
+    Fragment contributions stored as a sorted array of Morgan bit ids with a parallel array of scores.
+    The arrays are written once to .npy files and memory-mapped, so worker processes share the same pages
+    instead of each unpickling their own dict.
+    """
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, bits, default=-4.):
+        """
+        Vectorized lookup of fragment scores
+        :param bits: Array of Morgan bit ids
+        :param default: Score for bit ids not found in the table
+        :return: Array of scores
+        """
+        bits = np.asarray(bits, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.full(len(bits), default, dtype=np.float64)
+        idx = np.searchsorted(self.keys, bits)
+        idx[idx >= len(self.keys)] = 0
+        found = self.keys[idx] == bits
+        return np.where(found, self.values[idx], default)
+
+    def get(self, bit, default=-4.):
+        return float(self.lookup([bit], default=default)[0])
+
+
+def _tablePaths(name):
+    """
+    Find where to write the table, next to the pickle if the package directory is writable otherwise a temp dir.
+    """
+    directory, base = op.split(name)
+    if not os.access(directory, os.W_OK):
+        directory = op.join(tempfile.gettempdir(), 'molscore_sascore')
+        os.makedirs(directory, exist_ok=True)
+    return op.join(directory, f'{base}_keys.npy'), op.join(directory, f'{base}_values.npy')
+
+
+def buildFragmentTable(name='fpscores'):
+    """
+    Convert the pickled fragment scores to sorted key / value arrays on disk (only if missing or outdated).
+    :param name: Path prefix of the .pkl.gz file
+    :return: Paths to keys and values .npy files
+    """
     import gzip
-    global _fscores
-    # generate the full path filename:
     if name == "fpscores":
         name = op.join(op.dirname(__file__), name)
-    data = pickle.load(gzip.open('%s.pkl.gz' % name))
+    pkl_file = '%s.pkl.gz' % name
+    keys_file, values_file = _tablePaths(name)
+    if op.exists(keys_file) and op.exists(values_file) and \
+            (op.getmtime(keys_file) >= op.getmtime(pkl_file)) and (op.getmtime(values_file) >= op.getmtime(pkl_file)):
+        return keys_file, values_file
+
+    data = pickle.load(gzip.open(pkl_file))
     outDict = {}
     for i in data:
         for j in range(1, len(i)):
             outDict[i[j]] = float(i[0])
-    _fscores = outDict
+    keys = np.fromiter(outDict.keys(), dtype=np.int64, count=len(outDict))
+    values = np.fromiter(outDict.values(), dtype=np.float64, count=len(outDict))
+    order = np.argsort(keys)
+
+    # Write to a process specific temporary file and rename, so concurrent builders don't see partial files
+    for file, arr in [(values_file, values[order]), (keys_file, keys[order])]:
+        tmp_file = f'{file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_file, file)
+    return keys_file, values_file
+
+
+def readFragmentScores(name='fpscores'):
+    global _fscores
+    keys_file, values_file = buildFragmentTable(name)
+    _fscores = FragmentScoreTable(keys=np.load(keys_file, mmap_mode='r'),
+                                  values=np.load(values_file, mmap_mode='r'))
 
 
 def numBridgeheadsAndSpiro(mol, ri=None):
@@ -49,22 +121,7 @@ def numBridgeheadsAndSpiro(mol, ri=None):
     return nBridgehead, nSpiro
 
 
-def calculateScore(m):
-    if _fscores is None:
-        readFragmentScores()
-
-    # fragment score
-    fp = rdMolDescriptors.GetMorganFingerprint(m,
-                                               2)  # <- 2 is the *radius* of the circular fingerprint
-    fps = fp.GetNonzeroElements()
-    score1 = 0.
-    nf = 0
-    for bitId, v in fps.items():
-        nf += v
-        sfp = bitId
-        score1 += _fscores.get(sfp, -4) * v
-    score1 /= nf
-
+def _featureScore(m, nf_elements):
     # features score
     nAtoms = m.GetNumAtoms()
     nChiralCenters = len(Chem.FindMolChiralCenters(m, includeUnassigned=True))
@@ -93,11 +150,13 @@ def calculateScore(m):
     # not in the original publication, added in version 1.1
     # to make highly symmetrical molecules easier to synthetise
     score3 = 0.
-    if nAtoms > len(fps):
-        score3 = math.log(float(nAtoms) / len(fps)) * .5
+    if nAtoms > nf_elements:
+        score3 = math.log(float(nAtoms) / nf_elements) * .5
+
+    return score2 + score3
 
-    sascore = score1 + score2 + score3
 
+def _scaleScore(sascore):
     # need to transform "raw" value into scale between 1 and 10
     min = -4.0
     max = 2.5
@@ -113,6 +172,57 @@ def calculateScore(m):
     return sascore
 
 
+def calculateScore(m):
+    if m is None:
+        raise ValueError('Molecule is None')
+    sascore = calculateScores([m])[0]
+    if math.isnan(sascore):
+        # As the fragment score is averaged over fingerprint bits
+        raise ZeroDivisionError('Molecule has no fingerprint bits')
+    return sascore
+
+
+def calculateScores(mols):
+    """
+    Calculate SA scores for a batch of molecules, with a single vectorized fragment table lookup.
+    :param mols: List of rdkit mols (None values, and molecules without fingerprint bits, return NaN)
+    :return: List of SA scores
+    """
+    if _fscores is None:
+        readFragmentScores()
+
+    # fragment score
+    bits = []
+    counts = []
+    bounds = []
+    for m in mols:
+        if m is None:
+            bounds.append(None)
+            continue
+        fps = rdMolDescriptors.GetMorganFingerprint(m,
+                                                    2).GetNonzeroElements()  # <- 2 is the *radius* of the circular fingerprint
+        bounds.append((len(bits), len(bits) + len(fps)))
+        bits.extend(fps.keys())
+        counts.extend(fps.values())
+    counts = np.asarray(counts, dtype=np.float64)
+    contributions = _fscores.lookup(bits) * counts
+
+    sascores = []
+    for m, bound in zip(mols, bounds):
+        if bound is None:
+            sascores.append(float('nan'))
+            continue
+        start, stop = bound
+        nf = counts[start:stop].sum()
+        if nf == 0:
+            sascores.append(float('nan'))
+            continue
+        score1 = contributions[start:stop].sum() / nf
+        sascores.append(_scaleScore(float(score1) + _featureScore(m, stop - start)))
+
+    return sascores
+
+
 def processMols(mols):
     print('smiles\tName\tsa_score')
     for i, m in enumerate(mols):
@@ -2,10 +2,13 @@ from molscore.scoring_functions.glide import GlideDock, GlideDockFromROCS
 from molscore.scoring_functions.rocs import ROCS
 from molscore.scoring_functions.oedock import FRED
 from molscore.scoring_functions.tanimoto import TanimotoSimilarity
-#from molscore.scoring_functions.reinvent_svm import ActivityModel
-from molscore.scoring_functions.descriptors import RDKitDescriptors
+from molscore.scoring_functions.reinvent_svm import ActivityModel
+from molscore.scoring_functions.sklearn_model import SKLearnModel
+from molscore.scoring_functions.descriptors import RDKitDescriptors, BulkRDKitDescriptors
 from molscore.scoring_functions.substructure_filters import SubstructureFilters
 from molscore.scoring_functions.substructure_match import SubstructureMatch
+from molscore.scoring_functions.external_command import ExternalCommand
+from molscore.scoring_functions.surrogate import SurrogateScreen
 
 all_scoring_functions = [
     ROCS,
@@ -13,7 +16,11 @@ all_scoring_functions = [
     GlideDockFromROCS,
     FRED,
     RDKitDescriptors,
+    BulkRDKitDescriptors,
     TanimotoSimilarity,
     SubstructureFilters,
-    SubstructureMatch
+    SubstructureMatch,
+    ExternalCommand,
+    ActivityModel,
+    SKLearnModel
 ]
@@ -0,0 +1,185 @@
+"""
+On-disk store of multi-conformer molecules shared across scoring functions and runs
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+from rdkit.Chem import AllChem as Chem
+
+logger = logging.getLogger('conformer_store')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+class ConformerStore:
+    """
+    Store of serialized multi-conformer molecules (e.g. .oeb.gz bytes) in an SQLite file, indexed by canonical
+     isomeric SMILES and the options used to generate them, with least-recently-used eviction. The total size and
+     number of entries are kept in a one row table updated with each insert and delete, and last access times of
+     hits are written in batches.
+    """
+    def __init__(self, path: str, options: str = '', max_size: float = 1024.0, max_entries: int = None,
+                 access_batch: int = 100):
+        """
+        Store of serialized multi-conformer molecules indexed by canonical isomeric SMILES and generation options.
+        :param path: Path to store file (.db), created if it doesn't exist
+        :param options: String describing conformer generation options (e.g. Omega settings), part of the key
+        :param max_size: Maximum size of stored conformers in MB before least recently used entries are evicted
+        :param max_entries: Maximum number of stored molecules (default no limit)
+        :param access_batch: Number of hits before their last access times are written (also written on put and close)
+        """
+        self.path = os.path.abspath(path)
+        self.options = options
+        self.options_hash = hashlib.md5(options.encode()).hexdigest()
+        self.max_bytes = int(max_size * 1024 ** 2)
+        self.max_entries = max_entries
+        self.access_batch = access_batch
+        self._accessed = {}
+        self._conn = None
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS conformers ("
+                          "key TEXT PRIMARY KEY, smiles TEXT, options TEXT, data BLOB, "
+                          "nbytes INTEGER, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON conformers (last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                          "nbytes INTEGER, nentries INTEGER)")
+        # Stores created before totals were kept are summed once
+        self.conn.execute("INSERT OR IGNORE INTO totals SELECT 0, COALESCE(SUM(nbytes), 0), COUNT(*) FROM conformers")
+        self.conn.commit()
+
+    @property
+    def conn(self):
+        """
+        SQLite connection, re-opened in each process so the store can be used by forked workers.
+        """
+        if (self._conn is None) or (self._pid != os.getpid()):
+            self._conn = sqlite3.connect(self.path, timeout=60.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def canonicalize(smiles: str):
+        """
+        Canonical isomeric SMILES used as key (falls back to the input if RDKit can't parse it).
+        """
+        mol = Chem.MolFromSmiles(smiles)
+        if mol:
+            return Chem.MolToSmiles(mol, isomericSmiles=True)
+        return smiles
+
+    def key(self, smiles: str):
+        return f'{self.options_hash}:{self.canonicalize(smiles)}'
+
+    def get(self, smiles: str):
+        """
+        Fetch stored conformers.
+        :param smiles: SMILES string
+        :return: Serialized conformers (bytes) or None
+        """
+        key = self.key(smiles)
+        row = self.conn.execute("SELECT data FROM conformers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._accessed[key] = time.time()
+        if len(self._accessed) >= self.access_batch:
+            self.flush()
+        return bytes(row[0])
+
+    def flush(self):
+        """
+        Write pending last access times.
+        """
+        if self._accessed:
+            self.conn.executemany("UPDATE conformers SET last_access = ? WHERE key = ?",
+                                  [(t, key) for key, t in self._accessed.items()])
+            self.conn.commit()
+            self._accessed = {}
+        return self
+
+    def totals(self):
+        """
+        Total size in bytes and number of stored molecules.
+        """
+        return self.conn.execute("SELECT nbytes, nentries FROM totals WHERE id = 0").fetchone()
+
+    def put(self, smiles: str, data: bytes):
+        """
+        Store conformers and evict least recently used entries if over the size limits.
+        :param smiles: SMILES string
+        :param data: Serialized conformers
+        """
+        self.flush()
+        key = self.key(smiles)
+        # Lock for the read of any replaced entry and the update of totals
+        self.conn.execute("BEGIN IMMEDIATE")
+        old = self.conn.execute("SELECT nbytes FROM conformers WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO conformers VALUES (?, ?, ?, ?, ?, ?)",
+                          (key, self.canonicalize(smiles), self.options, sqlite3.Binary(data),
+                           len(data), time.time()))
+        self.conn.execute("UPDATE totals SET nbytes = nbytes + ?, nentries = nentries + ? WHERE id = 0",
+                          (len(data) - (old[0] if old is not None else 0), 0 if old is not None else 1))
+        self.conn.commit()
+        self.evict()
+        return self
+
+    def evict(self):
+        """
+        Remove least recently used entries until size limits are satisfied.
+        """
+        nbytes, nentries = self.totals()
+        if (nbytes <= self.max_bytes) and ((self.max_entries is None) or (nentries <= self.max_entries)):
+            return self
+
+        self.flush()
+        self.conn.execute("BEGIN IMMEDIATE")
+        nbytes, nentries = self.totals()
+        removed = 0
+        removed_bytes = 0
+        while (nbytes - removed_bytes > self.max_bytes) or \
+                ((self.max_entries is not None) and (nentries - removed > self.max_entries)):
+            # Oldest entries a few at a time from the last access index, rather than sorting the whole table
+            rows = self.conn.execute("SELECT key, nbytes FROM conformers ORDER BY last_access LIMIT 64").fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                if (nbytes - removed_bytes <= self.max_bytes) and \
+                        ((self.max_entries is None) or (nentries - removed <= self.max_entries)):
+                    break
+                self.conn.execute("DELETE FROM conformers WHERE key = ?", (key,))
+                removed_bytes += size
+                removed += 1
+        self.conn.execute("UPDATE totals SET nbytes = nbytes - ?, nentries = nentries - ? WHERE id = 0",
+                          (removed_bytes, removed))
+        self.conn.commit()
+        logger.debug(f'Evicted {removed} entries from conformer store')
+        return self
+
+    def __contains__(self, smiles: str):
+        return self.conn.execute("SELECT 1 FROM conformers WHERE key = ?", (self.key(smiles),)).fetchone() is not None
+
+    def __len__(self):
+        return self.totals()[1]
+
+    def close(self):
+        if self._conn is not None:
+            if self._pid == os.getpid():
+                self.flush()
+            self._conn.close()
+            self._conn = None
+        return self
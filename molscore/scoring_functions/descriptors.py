@@ -1,5 +1,9 @@
-from rdkit.Chem import Descriptors, QED, Crippen
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+from rdkit.Chem import Descriptors, QED, Crippen, rdMolDescriptors
 from rdkit.Chem import AllChem as Chem
+from rdkit.ML.Descriptors.MoleculeDescriptors import MolecularDescriptorCalculator
 from molscore.scoring_functions.SA_Score import sascorer
 
 
@@ -92,3 +96,102 @@ class RDKitDescriptors:
             results.append(result)
 
         return results
+
+
+class BulkRDKitDescriptors:
+    """
+    Scoring function class to compute the full RDKit descriptor catalogue in bulk.
+    """
+    # Descriptors not found in Descriptors._descList
+    extra_descriptors = {'NumAtomStereoCenters': rdMolDescriptors.CalcNumAtomStereoCenters,
+                         'NumUnspecifiedAtomStereoCenters': rdMolDescriptors.CalcNumUnspecifiedAtomStereoCenters,
+                         'NumLipinskiHBA': rdMolDescriptors.CalcNumLipinskiHBA,
+                         'NumLipinskiHBD': rdMolDescriptors.CalcNumLipinskiHBD,
+                         'NumSpiroAtoms': rdMolDescriptors.CalcNumSpiroAtoms,
+                         'NumBridgeheadAtoms': rdMolDescriptors.CalcNumBridgeheadAtoms,
+                         'NumAmideBonds': rdMolDescriptors.CalcNumAmideBonds,
+                         'FormalCharge': Chem.GetFormalCharge}
+
+    def __init__(self, prefix: str = 'desc', descriptors: list = None, n_jobs: int = 1,
+                 chunk_size: int = 500, **kwargs):
+        """
+        Scoring function class to compute the full RDKit descriptor catalogue in bulk. Descriptors are calculated
+         with RDKit's MolecularDescriptorCalculator in chunks across worker processes into a float32 matrix,
+         only columns referenced in scoring metrics are returned (if provided).
+        :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
+        :param descriptors: List of descriptor names to calculate (default all in Descriptors._descList plus extras)
+        :param n_jobs: Number of jobs for multiprocessing
+        :param chunk_size: Number of SMILES per chunk sent to each worker
+        :param kwargs: Ignored
+        """
+        self.prefix = prefix.replace(" ", "_")
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        available = [name for name, _ in Descriptors._descList] + list(self.extra_descriptors.keys())
+        if descriptors is None:
+            self.descriptors = available
+        else:
+            unknown = [d for d in descriptors if d not in available]
+            assert len(unknown) == 0, f"Unknown descriptors: {unknown}"
+            self.descriptors = list(descriptors)
+        self.score_metrics = self.descriptors
+
+    @classmethod
+    def calculate_descriptors(cls, smiles: list, descriptors: list):
+        """
+        Calculate a chunk of descriptors (class method for easier multiprocessing)
+        :param smiles: List of SMILES strings
+        :param descriptors: List of descriptor names
+        :return: ndarray of shape (len(smiles), len(descriptors)) and type np.float32
+        """
+        calc_names = [d for d in descriptors if d not in cls.extra_descriptors]
+        calc_idx = [i for i, d in enumerate(descriptors) if d not in cls.extra_descriptors]
+        extra_idx = [(i, cls.extra_descriptors[d]) for i, d in enumerate(descriptors)
+                     if d in cls.extra_descriptors]
+        calculator = MolecularDescriptorCalculator(calc_names)
+
+        X = np.zeros((len(smiles), len(descriptors)), dtype=np.float32)
+        for i, smi in enumerate(smiles):
+            mol = Chem.MolFromSmiles(smi)
+            if not mol:
+                continue
+            try:
+                X[i, calc_idx] = calculator.CalcDescriptors(mol)
+            # If any error is thrown leave as 0.0
+            except:
+                pass
+            for j, func in extra_idx:
+                try:
+                    X[i, j] = func(mol)
+                except:
+                    pass
+        # Replace nan and inf (e.g. Ipc, charge descriptors) with 0.0
+        X[~np.isfinite(X)] = 0.0
+        return X
+
+    def __call__(self, smiles: list, metrics: list = None, **kwargs):
+        """
+        Calculate the scores for BulkRDKitDescriptors
+        :param smiles: List of SMILES strings
+        :param metrics: List of metric names used for scoring, if provided only these descriptors are returned
+        :param kwargs: Ignored
+        :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
+        """
+        # Whitelist descriptors referenced by scoring metrics to avoid bloating results
+        descriptors = self.descriptors
+        if metrics is not None:
+            descriptors = [d for d in self.descriptors if f'{self.prefix}_{d}' in metrics]
+
+        calculate_p = partial(self.calculate_descriptors, descriptors=descriptors)
+        chunks = [smiles[i:i + self.chunk_size] for i in range(0, len(smiles), self.chunk_size)]
+        if self.n_jobs > 1 and len(chunks) > 1:
+            with Pool(self.n_jobs) as pool:
+                X = list(pool.imap(calculate_p, chunks))
+        else:
+            X = [calculate_p(chunk) for chunk in chunks]
+        X = np.vstack(X) if len(X) > 0 else np.zeros((0, len(descriptors)), dtype=np.float32)
+
+        columns = [f'{self.prefix}_{d}' for d in descriptors]
+        results = [dict(smiles=smi, **{c: float(v) for c, v in zip(columns, row)})
+                   for smi, row in zip(smiles, X)]
+        return results
@@ -0,0 +1,757 @@
+"""
+Pluggable executors to run jobs (e.g. external subprocess commands) for scoring functions
+"""
+
+import os
+import abc
+import time
+import uuid
+import queue
+import signal
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from functools import partial
+from multiprocessing.connection import wait
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+
+import numpy as np
+
+logger = logging.getLogger('executors')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+def _timed_call(fn, arg):
+    """
+    Call fn(arg) and return the result with its duration (module level for pickling to processes).
+    """
+    start = time.time()
+    result = fn(arg)
+    return result, time.time() - start
+
+
+def _kill(process):
+    try:
+        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.wait()
+
+
+def _run_attempt(command: str, timeout: float, cwd: str = None, cancel_file: str = None,
+                 poll_interval: float = 0.1):
+    """
+    Run a command until it exits, exceeds its timeout or cancel_file is created (module level so it can be run by
+     any executor, cancel_file must be visible to where it's run).
+    :return: (return code or None if killed, duration)
+    """
+    start = time.time()
+    if (cancel_file is not None) and os.path.exists(cancel_file):
+        return None, 0.0
+    process = subprocess.Popen(command.split(), preexec_fn=os.setsid, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while process.poll() is None:
+        if (time.time() - start > timeout) or ((cancel_file is not None) and os.path.exists(cancel_file)):
+            _kill(process)
+            return None, time.time() - start
+        time.sleep(poll_interval)
+    return process.returncode, time.time() - start
+
+
+def _recycling_worker(conn):
+    """
+    Worker process loop for recycled process pools, run (fn, arg) jobs sent over conn until None is received.
+    """
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        fn, arg = job
+        try:
+            conn.send((True, _timed_call(fn, arg)))
+        except Exception as e:
+            conn.send((False, e))
+    conn.close()
+
+
+def _worker_usage(pid: int):
+    """
+    Resident memory (MB) and number of open file descriptors of a process, read from /proc (None if unavailable).
+    """
+    memory = None
+    n_fds = None
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    memory = int(line.split()[1]) / 1024
+                    break
+        n_fds = len(os.listdir(f'/proc/{pid}/fd'))
+    except (OSError, ValueError):
+        pass
+    return memory, n_fds
+
+
+class Executor(abc.ABC):
+    """
+    Base executor, tracks queue depth and per-job durations, and worker recycling limits.
+    """
+    def __init__(self, max_memory: float = None, max_open_files: int = None, max_jobs_per_worker: int = None):
+        """
+        Base executor, tracks queue depth and per-job durations, and worker recycling limits.
+        :param max_memory: Recycle a worker once its resident memory exceeds this many MB
+        :param max_open_files: Recycle a worker once it has more than this many open file descriptors
+        :param max_jobs_per_worker: Recycle a worker after this many jobs
+        """
+        self.durations = []
+        self._queued = 0
+        self._lock = threading.Lock()
+        self.max_memory = max_memory
+        self.max_open_files = max_open_files
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.recycled = 0
+
+    @property
+    def recycling(self):
+        """
+        Whether any worker recycling limit is set.
+        """
+        return any(limit is not None for limit in [self.max_memory, self.max_open_files, self.max_jobs_per_worker])
+
+    def recycle_reason(self, memory: float = None, n_fds: int = None, jobs: int = None):
+        """
+        Why a worker with this usage should be recycled, or None if within limits.
+        """
+        if (self.max_memory is not None) and (memory is not None) and (memory > self.max_memory):
+            return f'memory {memory:.0f} MB > {self.max_memory} MB'
+        if (self.max_open_files is not None) and (n_fds is not None) and (n_fds > self.max_open_files):
+            return f'{n_fds} open files > {self.max_open_files}'
+        if (self.max_jobs_per_worker is not None) and (jobs is not None) and (jobs >= self.max_jobs_per_worker):
+            return f'{jobs} jobs >= {self.max_jobs_per_worker}'
+        return None
+
+    @property
+    def queue_depth(self):
+        """
+        Number of submitted jobs not yet finished.
+        """
+        return self._queued
+
+    def _submitted(self, n: int):
+        with self._lock:
+            self._queued += n
+
+    def _finished(self, duration: float = None):
+        with self._lock:
+            self._queued -= 1
+            if duration is not None:
+                self.durations.append(duration)
+
+    def stats(self):
+        """
+        Summary of queue depth and job durations.
+        :return: dict
+        """
+        durations = np.asarray(self.durations) if len(self.durations) > 0 else np.zeros(1)
+        return {'queue_depth': self.queue_depth, 'jobs': len(self.durations),
+                'mean_duration': float(durations.mean()), 'max_duration': float(durations.max()),
+                'recycled_workers': self.recycled}
+
+    def _timed_future(self, inner):
+        """
+        Future of the result of a future of (result, duration) from _timed_call, recording the duration.
+        """
+        future = Future()
+
+        def done(f):
+            try:
+                result, duration = f.result()
+            except Exception as e:
+                self._finished()
+                future.set_exception(e)
+            else:
+                self._finished(duration)
+                future.set_result(result)
+
+        inner.add_done_callback(done)
+        return future
+
+    @property
+    def capacity(self):
+        """
+        Number of jobs that can run at the same time.
+        """
+        return 1
+
+    @abc.abstractmethod
+    def submit(self, fn, arg):
+        """
+        Start fn(arg) without waiting for it.
+        :param fn: Function (must be picklable for process and dask backends)
+        :param arg: Argument
+        :return: concurrent.futures.Future of the result
+        """
+
+    def map(self, fn, iterable):
+        """
+        Run fn on each item and return results in order (raising the first error once all jobs have finished).
+        :param fn: Function (must be picklable for process and dask backends)
+        :param iterable: Arguments, one per job
+        :return: List of results
+        """
+        futures = [self.submit(fn, arg) for arg in iterable]
+        wait_futures(futures)
+        self.batch_finished()
+        return [future.result() for future in futures]
+
+    def batch_finished(self):
+        """
+        Called once a batch of submitted jobs has finished, e.g. to recycle workers between batches.
+        """
+        return self
+
+    def shutdown(self):
+        """
+        Release workers, safe to call more than once.
+        """
+        return self
+
+
+class SerialExecutor(Executor):
+    """
+    Run jobs one after another in the current process.
+    """
+    def submit(self, fn, arg):
+        self._submitted(1)
+        future = Future()
+        try:
+            result, duration = _timed_call(fn, arg)
+        except Exception as e:
+            self._finished()
+            future.set_exception(e)
+        else:
+            self._finished(duration)
+            future.set_result(result)
+        return future
+
+
+class PoolExecutor(Executor):
+    """
+    Run jobs in a local thread or process pool with a maximum concurrency.
+    """
+    def __init__(self, n_jobs: int = 1, backend: str = 'thread', **kwargs):
+        """
+        Run jobs in a local thread or process pool with a maximum concurrency.
+        :param n_jobs: Maximum number of concurrent jobs
+        :param backend: 'thread' (e.g. for subprocess commands) or 'process'
+        :param kwargs: Worker recycling limits for the process backend (see Executor)
+        """
+        super().__init__(**kwargs)
+        assert backend in ['thread', 'process']
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.pool = None
+        self._jobs = None
+        self._dispatcher = None
+        if self.recycling and (self.backend == 'thread'):
+            logger.warning('Worker recycling only applies to the process backend, ignoring')
+
+    @property
+    def capacity(self):
+        return self.n_jobs
+
+    def submit(self, fn, arg):
+        if (self.backend == 'process') and self.recycling:
+            return self._recycling_submit(fn, arg)
+
+        if self.pool is None:
+            if self.backend == 'thread':
+                self.pool = ThreadPoolExecutor(max_workers=self.n_jobs)
+            else:
+                self.pool = ProcessPoolExecutor(max_workers=self.n_jobs)
+        self._submitted(1)
+        return self._timed_future(self.pool.submit(_timed_call, fn, arg))
+
+    def _spawn(self):
+        """
+        Start a worker process with its own pipe, so it can be retired independently of the others.
+        """
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_recycling_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': conn, 'jobs': 0}
+
+    def _retire(self, worker: dict):
+        """
+        Ask an idle worker to exit once it's finished, and wait for it.
+        """
+        try:
+            worker['conn'].send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        worker['process'].join(timeout=30)
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+            worker['process'].join()
+        worker['conn'].close()
+        return self
+
+    def _recycling_submit(self, fn, arg):
+        """
+        Queue a job for persistent worker processes, see _dispatch.
+        """
+        if self.pool is None:
+            self.pool = [self._spawn() for _ in range(self.n_jobs)]
+            self._jobs = queue.Queue()
+            self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self._dispatcher.start()
+        self._submitted(1)
+        future = Future()
+        self._jobs.put((fn, arg, future))
+        return future
+
+    def _dispatch(self):
+        """
+        Give queued jobs to idle worker processes and collect their results until None is queued. Each worker is
+         checked against the recycling limits before it is given another job, so that only one idle worker is replaced
+         at a time while the others keep running.
+        """
+        busy = {}  # conn -> (worker, future)
+        idle = list(self.pool)
+        stopping = False
+        while busy or not stopping:
+            while idle and not stopping:
+                try:
+                    # Only block waiting for jobs when none are running
+                    job = self._jobs.get(timeout=0.01 if busy else None)
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                fn, arg, future = job
+                worker = idle.pop(0)
+                memory, n_fds = _worker_usage(worker['process'].pid)
+                reason = self.recycle_reason(memory=memory, n_fds=n_fds, jobs=worker['jobs'])
+                if reason is not None or not worker['process'].is_alive():
+                    logger.debug(f'Recycling worker {worker["process"].pid}: {reason or "exited"}')
+                    self._retire(worker)
+                    self.pool.remove(worker)
+                    worker = self._spawn()
+                    self.pool.append(worker)
+                    self.recycled += 1
+                try:
+                    worker['conn'].send((fn, arg))
+                except Exception as e:
+                    self._finished()
+                    future.set_exception(e)
+                    idle.append(worker)
+                    continue
+                worker['jobs'] += 1
+                busy[worker['conn']] = (worker, future)
+
+            if not busy:
+                continue
+            # Check for new jobs regularly while workers are idle
+            for conn in wait(list(busy.keys()), timeout=0.01 if (idle and not stopping) else None):
+                worker, future = busy.pop(conn)
+                try:
+                    ok, value = conn.recv()
+                except EOFError:
+                    ok, value = False, RuntimeError(f'Worker {worker["process"].pid} exited unexpectedly')
+                if ok:
+                    result, duration = value
+                    self._finished(duration)
+                    future.set_result(result)
+                else:
+                    self._finished()
+                    future.set_exception(value)
+                idle.append(worker)
+
+    def shutdown(self):
+        if isinstance(self.pool, list):
+            self._jobs.put(None)
+            self._dispatcher.join()
+            for worker in self.pool:
+                self._retire(worker)
+            self.pool = None
+            self._jobs = None
+            self._dispatcher = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        return self
+
+
+class DaskExecutor(Executor):
+    """
+    Run jobs on a Dask cluster.
+    """
+    # Workers are recycled after this many jobs if no limit is set, as leaking workers used to be contained by
+    #  restarting the cluster every 250 steps
+    default_max_jobs_per_worker = 1000
+
+    def __init__(self, cluster: str, **kwargs):
+        """
+        Run jobs on a Dask cluster.
+        :param cluster: Dask scheduler address
+        :param kwargs: Worker recycling limits (see Executor), max_jobs_per_worker defaults to
+         default_max_jobs_per_worker if no limit is set
+        """
+        super().__init__(**kwargs)
+        if not self.recycling:
+            self.max_jobs_per_worker = self.default_max_jobs_per_worker
+        from dask.distributed import Client
+        self.cluster = cluster
+        self.client = Client(self.cluster)
+        self.worker_jobs = {}
+        self._warned = False
+        self._batch = []  # Futures since the last batch_finished, to count jobs per worker
+
+    @property
+    def capacity(self):
+        return max(1, sum(info.get('nthreads', 1) for info in self.client.scheduler_info()['workers'].values()))
+
+    def submit(self, fn, arg):
+        self._submitted(1)
+        future = self.client.submit(partial(_timed_call, fn), arg, pure=False)
+        if self.recycling:
+            self._batch.append(future)
+        return self._timed_future(future)
+
+    def batch_finished(self):
+        if self.recycling and self._batch:
+            for addresses in self.client.who_has(self._batch).values():
+                for address in addresses:
+                    self.worker_jobs[address] = self.worker_jobs.get(address, 0) + 1
+            self._batch = []
+            self.recycle()
+        return self
+
+    def recycle(self):
+        """
+        Restart the worker furthest over the recycling limits, one worker per call so the rest keep running warm.
+         Workers without a nanny can't be restarted (retiring them would shrink the cluster), so are left running.
+        """
+        candidates = []
+        for address, info in self.client.scheduler_info()['workers'].items():
+            if not info.get('nanny'):
+                if not self._warned:
+                    logger.warning('Dask workers without a nanny can\'t be restarted, skipping worker recycling')
+                    self._warned = True
+                continue
+            metrics = info.get('metrics', {})
+            memory = metrics.get('memory')
+            memory = memory / 1024 ** 2 if memory is not None else None
+            reason = self.recycle_reason(memory=memory, n_fds=metrics.get('num_fds'),
+                                         jobs=self.worker_jobs.get(address, 0))
+            if reason is not None:
+                candidates.append((memory or 0, address, reason))
+        if not candidates:
+            return self
+
+        _, address, reason = max(candidates)
+        logger.debug(f'Recycling worker {address}: {reason}')
+        if hasattr(self.client, 'restart_workers'):
+            self.client.restart_workers([address])
+            self.worker_jobs.pop(address, None)
+            self.recycled += 1
+        else:
+            # Older distributed can only restart all workers (via their nannies)
+            n_workers = len(self.client.scheduler_info()['workers'])
+            self.client.restart()
+            self.worker_jobs = {}
+            self.recycled += n_workers
+        return self
+
+    def shutdown(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        return self
+
+
+all_executors = ['serial', 'thread', 'process', 'dask']
+
+
+def get_executor(executor: str = None, n_jobs: int = 1, cluster: str = None, **kwargs):
+    """
+    Setup an executor by name.
+    :param executor: 'serial', 'thread', 'process' or 'dask' (default 'dask' if cluster is provided else 'serial')
+    :param n_jobs: Maximum number of concurrent jobs for local pools
+    :param cluster: Dask scheduler address
+    :param kwargs: Worker recycling limits i.e. max_memory, max_open_files, max_jobs_per_worker
+    :return: Executor
+    """
+    if executor is None:
+        executor = 'dask' if cluster is not None else 'serial'
+    assert executor in all_executors, f'Executor must be one of {all_executors}'
+
+    if executor == 'serial':
+        return SerialExecutor()
+    if executor in ['thread', 'process']:
+        return PoolExecutor(n_jobs=n_jobs, backend=executor, **kwargs)
+    assert cluster is not None, 'Dask executor requires a cluster address'
+    return DaskExecutor(cluster=cluster, **kwargs)
+
+
+class ScheduledJob:
+    """
+    A command for the AdaptiveScheduler.
+    """
+    def __init__(self, command: str, features: list = None, speculate=None, timeout: float = None):
+        """
+        A command for the AdaptiveScheduler.
+        :param command: Command line command
+        :param features: Job size features used to learn durations (e.g. [heavy atoms, rotatable bonds])
+        :param speculate: Optional callable returning (command, on_win, cwd), a duplicate of the command writing to a
+         separate location, a callable to move its output into place if the duplicate finishes first, and a working
+         directory to run it in (or None)
+        :param timeout: Timeout for this job until durations are learnt (default the scheduler's default_timeout)
+        """
+        self.command = command
+        self.features = list(features) if features is not None else []
+        self.speculate = speculate
+        self.timeout = timeout
+        self.done = False
+        self.success = False
+        self.speculated = False
+        self.retries = 0
+
+
+class AdaptiveScheduler:
+    """
+    Run commands with an executor and timeouts learnt from previous job durations, and speculatively re-execute
+     stragglers when workers are idle at the end of a batch.
+    """
+    def __init__(self, n_jobs: int = None, percentile: float = 95.0, margin: float = 1.5,
+                 default_timeout: float = 120.0, min_timeout: float = 10.0, max_timeout: float = 3600.0,
+                 min_history: int = 20, max_history: int = 5000, speculative: bool = True, max_retries: int = 1,
+                 executor: Executor = None, poll_interval: float = 0.1):
+        """
+        Run commands with an executor and timeouts learnt from previous job durations, and speculatively re-execute
+         stragglers when workers are idle at the end of a batch.
+        :param n_jobs: Maximum number of concurrent commands (default the executor's capacity)
+        :param percentile: Percentile of predicted duration used as timeout
+        :param margin: Multiplier applied to the percentile duration
+        :param default_timeout: Timeout used until enough durations have been observed, unless set per job
+        :param min_timeout: Lower bound on timeouts
+        :param max_timeout: Upper bound on timeouts
+        :param min_history: Number of observed durations before timeouts are learnt
+        :param max_history: Number of most recent durations to learn from
+        :param speculative: Relaunch the slowest outstanding jobs on idle workers and take whichever finishes first
+        :param max_retries: Number of times a job is rerun after exiting with an error
+        :param executor: Executor to run commands with (default a local thread pool of n_jobs)
+        :param poll_interval: Seconds between polling running commands
+        """
+        self._own_executor = executor is None
+        self.executor = executor if executor is not None else PoolExecutor(n_jobs=n_jobs or 1, backend='thread')
+        self.n_jobs = n_jobs
+        self.percentile = percentile
+        self.margin = margin
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_history = min_history
+        self.max_history = max_history
+        self.speculative = speculative
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.history_X = []
+        self.history_y = []
+        self.durations = []
+        self._coef = None
+        self._quantile = None
+        self.speculations = 0
+        self.speculative_wins = 0
+        self.timeouts = 0
+        self.failures = 0
+
+    def record(self, features: list, duration: float):
+        """
+        Record an observed duration for job features.
+        """
+        self.history_X.append([1.0] + list(features))
+        self.history_y.append(np.log(max(duration, 1e-3)))
+        self.durations.append(duration)
+        self.history_X = self.history_X[-self.max_history:]
+        self.history_y = self.history_y[-self.max_history:]
+        self._coef = None
+        return self
+
+    def fit(self):
+        """
+        Fit log(duration) as a linear function of job features, and the residual percentile.
+        """
+        X = np.asarray(self.history_X, dtype=np.float64)
+        y = np.asarray(self.history_y, dtype=np.float64)
+        self._coef = np.linalg.lstsq(X, y, rcond=None)[0]
+        self._quantile = float(np.percentile(y - X.dot(self._coef), self.percentile))
+        return self
+
+    def expected_duration(self, features: list):
+        """
+        Predicted (median) duration for job features, or None if not enough history.
+        """
+        if len(self.history_y) < self.min_history:
+            return None
+        if self._coef is None:
+            self.fit()
+        return float(np.exp(np.dot([1.0] + list(features), self._coef)))
+
+    def predict_timeout(self, features: list, default: float = None):
+        """
+        Timeout at a high percentile of predicted duration for job features.
+        :param default: Timeout until enough durations have been observed (default default_timeout)
+        """
+        expected = self.expected_duration(features)
+        if expected is None:
+            return default if default is not None else self.default_timeout
+        timeout = expected * np.exp(self._quantile) * self.margin
+        return float(min(max(timeout, self.min_timeout), self.max_timeout))
+
+    def _submit(self, job: ScheduledJob, i: int, command: str, cancel_file: str, cwd: str = None, on_win=None):
+        """
+        Submit an attempt of a job to the executor with its current timeout.
+        :return: [job index, future, submit time, cancel file, on_win]
+        """
+        timeout = self.predict_timeout(job.features, default=job.timeout)
+        future = self.executor.submit(partial(_run_attempt, timeout=timeout, cwd=cwd, cancel_file=cancel_file,
+                                              poll_interval=self.poll_interval), command)
+        return [i, future, time.time(), cancel_file, on_win]
+
+    def run(self, jobs: list, cancel_dir: str = None):
+        """
+        Run jobs to completion. Each attempt is given its timeout when submitted, attempts that lose to another
+         attempt of the same job are stopped by creating a cancel file they check for.
+        :param jobs: List of ScheduledJob
+        :param cancel_dir: Directory for cancel files, must be visible to where commands are run (default a local
+         temporary directory)
+        :return: List of bools, whether each job exited successfully (return code 0) within its timeout
+        """
+        n_jobs = self.n_jobs or self.executor.capacity
+        temporary = cancel_dir is None
+        cancel_dir = tempfile.mkdtemp(prefix='scheduler_') if temporary else cancel_dir
+        os.makedirs(cancel_dir, exist_ok=True)
+        token = uuid.uuid4().hex
+        n_attempts = 0
+        pending = list(range(len(jobs)))
+        running = []  # [job index, future, submit time, cancel file, on_win or None]
+        wins = {}  # Job index -> on_win of a speculative attempt, called once other attempts have stopped
+
+        def cancel_file():
+            nonlocal n_attempts
+            n_attempts += 1
+            return os.path.join(cancel_dir, f'{token}_{n_attempts}.cancel')
+
+        try:
+            while pending or running:
+                # Fill idle workers with pending jobs
+                while pending and (len(running) < n_jobs):
+                    i = pending.pop(0)
+                    running.append(self._submit(jobs[i], i, jobs[i].command, cancel_file()))
+
+                # Near the end of a batch, use idle workers to duplicate the slowest outstanding job
+                if self.speculative and not pending and (len(running) < n_jobs):
+                    candidates = []
+                    for i, future, start, _, _ in running:
+                        expected = self.expected_duration(jobs[i].features)
+                        if (jobs[i].speculate is not None) and not jobs[i].speculated and not jobs[i].done and \
+                                (expected is not None):
+                            elapsed = time.time() - start
+                            if elapsed > expected:
+                                candidates.append((elapsed / expected, i))
+                    if candidates:
+                        _, i = max(candidates)
+                        command, on_win, cwd = jobs[i].speculate()
+                        jobs[i].speculated = True
+                        self.speculations += 1
+                        running.append(self._submit(jobs[i], i, command, cancel_file(), cwd=cwd, on_win=on_win))
+                        logger.debug(f'Speculatively relaunched job {i}')
+
+                wait_futures([attempt[1] for attempt in running], timeout=self.poll_interval,
+                             return_when=FIRST_COMPLETED)
+
+                # Check finished attempts
+                finished = [attempt for attempt in running if attempt[1].done()]
+                running = [attempt for attempt in running if not attempt[1].done()]
+                for i, future, start, _, on_win in finished:
+                    if jobs[i].done:
+                        continue  # Stopped after another attempt won
+                    others = [attempt for attempt in running if attempt[0] == i]
+                    try:
+                        returncode, duration = future.result()
+                    except Exception as e:
+                        logger.debug(f'Job {i} could not be run: {e}')
+                        returncode, duration = -1, None
+
+                    if returncode == 0:
+                        jobs[i].done = True
+                        jobs[i].success = True
+                        self.record(jobs[i].features, duration)
+                        # Stop other attempts of this job, output is moved into place once they have
+                        for attempt in others:
+                            open(attempt[3], 'w').close()
+                        if on_win is not None:
+                            wins[i] = on_win
+                    elif returncode is None:
+                        logger.debug(f'Job {i} timed out after {duration:.1f}s')
+                        self.timeouts += 1
+                        # Not recorded, the duration is censored at the timeout
+                        if not others:
+                            jobs[i].done = True
+                    else:
+                        logger.debug(f'Job {i} failed with return code {returncode}')
+                        self.failures += 1
+                        # Not recorded, let any other attempt finish, otherwise retry
+                        if others:
+                            continue
+                        if jobs[i].retries < self.max_retries:
+                            jobs[i].retries += 1
+                            pending.append(i)
+                        else:
+                            jobs[i].done = True
+
+                for i in [i for i in wins if not any(attempt[0] == i for attempt in running)]:
+                    wins.pop(i)()
+                    self.speculative_wins += 1
+        finally:
+            if temporary:
+                shutil.rmtree(cancel_dir, ignore_errors=True)
+            else:
+                for name in os.listdir(cancel_dir):
+                    if name.startswith(token):
+                        os.remove(os.path.join(cancel_dir, name))
+            self.executor.batch_finished()
+
+        return [job.success for job in jobs]
+
+    def shutdown(self):
+        """
+        Shutdown the executor if it was created by the scheduler.
+        """
+        if self._own_executor:
+            self.executor.shutdown()
+        return self
+
+    def stats(self):
+        """
+        Summary of learnt durations, timeouts and speculative execution.
+        :return: dict
+        """
+        durations = np.asarray(self.durations) if len(self.durations) > 0 else np.zeros(1)
+        return {'jobs': len(self.durations), 'mean_duration': float(durations.mean()),
+                'max_duration': float(durations.max()), 'timeouts': self.timeouts, 'failures': self.failures,
+                'speculations': self.speculations, 'speculative_wins': self.speculative_wins}
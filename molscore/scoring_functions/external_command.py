@@ -0,0 +1,330 @@
+"""
+Generic scoring function that streams batches of molecules to long-running external worker processes
+"""
+
+import os
+import re
+import csv
+import time
+import queue
+import shlex
+import signal
+import logging
+import threading
+import subprocess
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+
+from rdkit.Chem import AllChem as Chem
+
+logger = logging.getLogger('external_command')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+END = '__END__'
+
+
+class ExternalWorker:
+    """
+    A long-running external process that reads a batch of records from stdin and writes results to stdout, each
+     followed by a line containing only __END__.
+    """
+    def __init__(self, command: str, timeout: float = 120.0, max_restarts: int = 5):
+        """
+        A long-running external process communicating over stdin/stdout.
+        :param command: Command to start the worker
+        :param timeout: Seconds to wait for the results of a batch before killing and restarting the worker
+        :param max_restarts: Maximum number of consecutive restarts (i.e. without a successful batch in between)
+         before giving up
+        """
+        self.command = command
+        self.timeout = timeout
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.failed = False
+        self.process = None
+        self.lines = None
+        self.reader = None
+
+    def start(self):
+        self.process = subprocess.Popen(shlex.split(self.command), preexec_fn=os.setsid, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        universal_newlines=True, bufsize=1)
+        # Read stdout in a thread so reads can time out
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, args=(self.process.stdout, self.lines), daemon=True)
+        self.reader.start()
+        logger.debug(f'Started worker {self.process.pid}: {self.command}')
+        return self
+
+    @staticmethod
+    def _read(stdout, lines):
+        for line in iter(stdout.readline, ''):
+            lines.put(line)
+        lines.put(None)  # EOF
+
+    def alive(self):
+        return (self.process is not None) and (self.process.poll() is None)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                pass
+            self.process.wait()
+            self.process = None
+        return self
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        if self.restarts > self.max_restarts:
+            self.failed = True
+            raise RuntimeError(f'Worker exceeded {self.max_restarts} restarts: {self.command}')
+        logger.warning(f'Restarting worker ({self.restarts}/{self.max_restarts}): {self.command}')
+        return self.start()
+
+    def reset(self):
+        """
+        Allow a worker that has given up to be started again, with a fresh restart count.
+        """
+        self.stop()
+        self.restarts = 0
+        self.failed = False
+        return self
+
+    def run(self, payload: str):
+        """
+        Send a batch and wait for its output, a successful batch resets the restart count.
+        :param payload: Input records
+        :return: Output (str) or None if the worker timed out or died
+        """
+        if self.failed:
+            raise RuntimeError(f'Worker exceeded {self.max_restarts} restarts: {self.command}')
+        if not self.alive():
+            if self.process is None:
+                self.start()
+            else:
+                self.restart()
+        try:
+            self.process.stdin.write(payload)
+            if not payload.endswith('\n'):
+                self.process.stdin.write('\n')
+            self.process.stdin.write(f'{END}\n')
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            logger.warning('Worker closed stdin')
+            self.restart()
+            return None
+
+        output = []
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.time(), 0.0))
+            except queue.Empty:
+                logger.warning(f'Worker timed out after {self.timeout}s')
+                self.restart()
+                return None
+            if line is None:
+                logger.warning('Worker exited unexpectedly')
+                self.restart()
+                return None
+            if line.rstrip('\n') == END:
+                self.restarts = 0
+                return ''.join(output)
+            output.append(line)
+
+
+class ExternalCommand:
+    """
+    Score molecules with an external program run as long-running worker processes, so that start-up is paid once.
+     Batches of SMILES or SDF records are written to a worker's stdin followed by a line containing only __END__, the
+     worker must write its results to stdout followed by a line containing only __END__.
+    """
+    input_formats = ['smiles', 'sdf']
+    output_formats = ['csv', 'sdf', 'regex']
+
+    def __init__(self, prefix: str, command: str, output_fields: list, input_format: str = 'smiles',
+                 output_format: str = 'csv', id_field: str = 'name', regex: str = None, batch_size: int = 50,
+                 timeout: float = 120.0, n_workers: int = 1, max_restarts: int = 5, **kwargs):
+        """
+        Score molecules with an external program run as long-running worker processes.
+        :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
+        :param command: Command to start a worker, '{worker_id}' is substituted with the worker index
+        :param output_fields: Names of metrics to read from output (CSV columns, SDF tags or regex groups)
+        :param input_format: 'smiles' (lines of '{smiles} {name}') or 'sdf' (3D records titled with {name})
+        :param output_format: 'csv' (with a header), 'sdf' or 'regex' (applied to each output line)
+        :param id_field: CSV column or regex group identifying the molecule name (SDF uses the record title)
+        :param regex: Regular expression with named groups for id_field and output_fields
+        :param batch_size: Number of molecules sent to a worker at a time
+        :param timeout: Seconds to wait for a batch before killing and restarting the worker
+        :param n_workers: Number of worker processes (maximum concurrent batches)
+        :param max_restarts: Maximum number of consecutive restarts per worker, a worker exceeding it is retired and
+         scoring fails once all workers are retired
+        :param kwargs: Ignored
+        """
+        self.prefix = prefix.replace(" ", "_")
+        assert input_format in self.input_formats, f'Input format must be one of {self.input_formats}'
+        assert output_format in self.output_formats, f'Output format must be one of {self.output_formats}'
+        if output_format == 'regex':
+            assert regex is not None, 'Regex output format requires a regex'
+        self.command = command
+        self.output_fields = output_fields if isinstance(output_fields, list) else [output_fields]
+        self.score_metrics = self.output_fields
+        self.input_format = input_format
+        self.output_format = output_format
+        self.id_field = id_field
+        self.regex = re.compile(regex) if regex is not None else None
+        self.batch_size = batch_size
+        self.timeout = float(timeout)
+        self.n_workers = n_workers
+        self.max_restarts = max_restarts
+        self.workers = queue.Queue()
+        self.all_workers = []
+        self.pool = None
+
+    def start_workers(self):
+        for i in range(self.n_workers):
+            worker = ExternalWorker(command=self.command.replace('{worker_id}', str(i)), timeout=self.timeout,
+                                    max_restarts=self.max_restarts)
+            worker.start()
+            self.all_workers.append(worker)
+            self.workers.put(worker)
+        self.pool = ThreadPoolExecutor(max_workers=self.n_workers)
+        return self
+
+    def write_input(self, names: list, smiles: list):
+        """
+        Format a batch as SMILES lines or SDF records.
+        """
+        if self.input_format == 'smiles':
+            return ''.join([f'{smi} {name}\n' for smi, name in zip(smiles, names)])
+
+        sio = StringIO()
+        w = Chem.SDWriter(sio)
+        for smi, name in zip(smiles, names):
+            mol = Chem.MolFromSmiles(smi)
+            if mol is None:
+                continue
+            mol = Chem.AddHs(mol)
+            if Chem.EmbedMolecule(mol, randomSeed=0xf00d) != 0:
+                logger.debug(f'Could not embed {smi}')
+                continue
+            mol.SetProp('_Name', name)
+            w.write(mol)
+        w.close()
+        return sio.getvalue()
+
+    def read_output(self, output: str):
+        """
+        Parse worker output into {name: {field: value}}.
+        """
+        results = {}
+        if self.output_format == 'csv':
+            for row in csv.DictReader(StringIO(output)):
+                results[row.get(self.id_field)] = {k: row.get(k) for k in self.output_fields}
+
+        elif self.output_format == 'sdf':
+            supp = Chem.SDMolSupplier()
+            supp.SetData(output, sanitize=False)
+            for mol in supp:
+                if mol is None:
+                    continue
+                props = mol.GetPropsAsDict()
+                results[mol.GetProp('_Name')] = {k: props.get(k) for k in self.output_fields}
+
+        else:
+            for line in output.splitlines():
+                match = self.regex.search(line)
+                if match:
+                    groups = match.groupdict()
+                    results[groups.get(self.id_field)] = {k: groups.get(k) for k in self.output_fields}
+        return results
+
+    def _check_workers(self):
+        if all(worker.failed for worker in self.all_workers):
+            raise RuntimeError(f'All {len(self.all_workers)} workers exceeded {self.max_restarts} restarts: '
+                               f'{self.command}')
+
+    def _next_worker(self):
+        """
+        Wait for a free worker, raising if all workers have been retired.
+        """
+        while True:
+            self._check_workers()
+            try:
+                return self.workers.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+    def run_batch(self, names: list, smiles: list):
+        """
+        Run a batch on the next free worker, retiring the worker if it gives up.
+        :return: {name: {field: value}}
+        """
+        worker = self._next_worker()
+        try:
+            output = worker.run(self.write_input(names, smiles))
+        except RuntimeError as e:
+            logger.error(e)
+            output = None
+        finally:
+            # Workers that gave up aren't returned to the queue
+            if not worker.failed:
+                self.workers.put(worker)
+        if worker.failed:
+            self._check_workers()
+        if output is None:
+            return {}
+        try:
+            return self.read_output(output)
+        except Exception as e:
+            logger.warning(f'Could not parse worker output: {e}')
+            return {}
+
+    @staticmethod
+    def _to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def shutdown(self):
+        """
+        Stop worker processes.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        for worker in self.all_workers:
+            worker.stop()
+        self.all_workers = []
+        self.workers = queue.Queue()
+        return self
+
+    def __call__(self, smiles: list, **kwargs):
+        """
+        Calculate scores for ExternalCommand
+        :param smiles: List of SMILES strings
+        :param kwargs: Ignored
+        :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
+        """
+        if self.pool is None:
+            self.start_workers()
+
+        names = [f'mol{i}' for i in range(len(smiles))]
+        batches = [(names[i:i + self.batch_size], smiles[i:i + self.batch_size])
+                   for i in range(0, len(smiles), self.batch_size)]
+        results = {}
+        for batch_results in self.pool.map(lambda batch: self.run_batch(*batch), batches):
+            results.update(batch_results)
+        logger.debug(f'Parsed results for {len(results)}/{len(smiles)} molecules')
+
+        return [{'smiles': smi, **{f'{self.prefix}_{k}': self._to_float(results.get(name, {}).get(k))
+                                   for k in self.output_fields}}
+                for smi, name in zip(smiles, names)]
@@ -1,15 +1,17 @@
 
 import os
-import glob
 import gzip
+import shutil
 import logging
+from functools import partial
 
-from openeye import oechem
-from dask.distributed import Client
 from rdkit.Chem import AllChem as Chem
+from rdkit.Chem import Descriptors
 
 from molscore.scoring_functions.rocs import ROCS
 from molscore.scoring_functions.utils import timedSubprocess
+from molscore.scoring_functions.executors import get_executor, SerialExecutor, AdaptiveScheduler, ScheduledJob
+from molscore.utils.pose_store import PoseStore
 
 logger = logging.getLogger('glide')
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
@@ -19,18 +21,52 @@ ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
 
+def _run_command(cmd: str, timeout: float):
+    """
+    Run a command with its own timedSubprocess, so concurrent jobs don't share process state.
+    """
+    return timedSubprocess(timeout=timeout).run(cmd)
+
+
 class GlideDock:
     """
     A scoring function class to conduct ligand preparation with Glide, parallelised with Dask.
     """
     def __init__(self, prefix: str, glide_template: str, cluster: str = None,
-                 timeout: float = 120.0, **kwargs):
+                 timeout: float = 120.0, ligprep_shards: int = None, glide_shards: int = None,
+                 executor: str = None, n_jobs: int = 1, adaptive_timeout: bool = False,
+                 timeout_percentile: float = 95.0, speculative: bool = True, scratch_dir: str = None,
+                 archive_poses: bool = False, steps_per_archive: int = 1, max_worker_memory: float = None,
+                 max_worker_open_files: int = None, max_jobs_per_worker: int = None, **kwargs):
         """
         A scoring function class to conduct ligand preparation with Glide, parallelised with Dask.
         :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
         :param glide_template: Path to a template docking file (.in)
         :param cluster: Dask scheduler address
         :param timeout: Timeout before kill a docking process and returning a score of 0.0
+        :param ligprep_shards: Split SMILES into this many multi-line files with one LigPrep process each,
+         instead of one LigPrep process per molecule (default None)
+        :param glide_shards: Dock all variants in this many multi-ligand Glide jobs, instead of one Glide job per
+         variant (default None)
+        :param executor: How to run LigPrep and Glide commands, 'serial', 'thread', 'process' or 'dask'
+         (default 'dask' if cluster is provided otherwise 'serial')
+        :param n_jobs: Maximum number of concurrent commands for local thread or process executors
+        :param adaptive_timeout: Run commands (with the executor) with timeouts learnt from previous successful
+         durations (as a function of heavy atoms and rotatable bonds), 'timeout' is used until enough durations are
+         observed, commands exiting with an error are retried once
+        :param timeout_percentile: Percentile of predicted duration used as adaptive timeout
+        :param speculative: With adaptive timeouts, relaunch the slowest outstanding commands on idle workers near the
+         end of a step and take whichever finishes first
+        :param scratch_dir: Directory for intermediate files (e.g. /dev/shm), must be visible to where commands are
+         run, only the step log and best poses are written to the save directory (default None i.e. save directory)
+        :param archive_poses: Append best poses to an indexed compressed file ({prefix}_poses_{step}.sdf.gz) instead
+         of writing one file per molecule, see molscore.utils.pose_store.PoseStore
+        :param steps_per_archive: Number of steps per pose archive
+        :param max_worker_memory: Recycle an executor worker (process or dask) once its resident memory exceeds this
+         many MB, workers are recycled one at a time between jobs
+        :param max_worker_open_files: Recycle an executor worker once it has more than this many open files
+        :param max_jobs_per_worker: Recycle an executor worker after this many jobs (default 1000 for dask if no
+         other limit is set)
         :param kwargs: Ignored
         """
         # Read in glide template (.in)
@@ -50,10 +86,34 @@ class GlideDock:
         self.glide_env = os.path.join(os.environ['SCHRODINGER'], 'glide')
         self.ligprep_env = os.path.join(os.environ['SCHRODINGER'], 'ligprep')
         self.timeout = float(timeout)
+        self.ligprep_shards = ligprep_shards
+        self.glide_shards = glide_shards
         self.cluster = cluster
-        if self.cluster is not None:
-            self.client = Client(self.cluster)
+        self.executor = get_executor(executor=executor, n_jobs=n_jobs, cluster=self.cluster,
+                                     max_memory=max_worker_memory, max_open_files=max_worker_open_files,
+                                     max_jobs_per_worker=max_jobs_per_worker)
+        self.client = getattr(self.executor, 'client', None)
+        self.adaptive_timeout = adaptive_timeout
+        self.ligprep_scheduler = None
+        self.glide_scheduler = None
+        if self.adaptive_timeout:
+            if isinstance(self.executor, SerialExecutor) and (n_jobs > 1):
+                logger.warning('Adaptive timeouts run commands with the serial executor one at a time, set executor '
+                               'to \'thread\' to run n_jobs commands at a time')
+            self.ligprep_scheduler = AdaptiveScheduler(percentile=timeout_percentile, default_timeout=self.timeout,
+                                                       speculative=speculative, executor=self.executor)
+            self.glide_scheduler = AdaptiveScheduler(percentile=timeout_percentile, default_timeout=self.timeout,
+                                                     speculative=speculative, executor=self.executor)
+        self.scratch_dir = os.path.abspath(scratch_dir) if scratch_dir is not None else None
+        self.archive_poses = archive_poses
+        self.steps_per_archive = steps_per_archive
+        self.pose_store = None
+        self.save_directory = None
+        self.smiles = None
         self.variants = None
+        self.variant_mols = None
+        self.poses = None
+        self.best_poses = None
         self.docking_results = None
 
     @staticmethod
@@ -83,12 +143,132 @@ class GlideDock:
 
         return glide_in
 
+    def ligprep_command(self, smi_in: str, sdf_out: str):
+        """
+        Prepare ligprep command line command.
+        :param smi_in: Input SMILES file
+        :param sdf_out: Output sdf file
+        :return: Command
+        """
+        command = " ".join((self.ligprep_env,
+                            f"-ismi {smi_in}",
+                            f"-osd {sdf_out}",
+                            "-ph 7.0",
+                            "-pht 1.0",
+                            "-bff 16",
+                            "-s 8",
+                            "-epik",
+                            "-WAIT",
+                            "-NOJOBID"))
+        return command
+
+    def setup_directory(self, directory: str, step: str):
+        """
+        Create the save directory for this step and the working directory for intermediate files.
+        :param directory: Directory to save files and logs into
+        :param step: Step
+        """
+        self.save_directory = os.path.join(os.path.abspath(directory), 'GlideDock', step)
+        os.makedirs(self.save_directory, exist_ok=True)
+        if self.archive_poses and ((self.pose_store is None) or
+                                   (self.pose_store.directory != os.path.dirname(self.save_directory))):
+            self.pose_store = PoseStore(os.path.dirname(self.save_directory), prefix=self.prefix,
+                                        steps_per_archive=self.steps_per_archive)
+        if self.scratch_dir is not None:
+            self.directory = os.path.join(self.scratch_dir, f'GlideDock_{self.prefix}_{os.getpid()}', step)
+            os.makedirs(self.directory, exist_ok=True)
+        else:
+            self.directory = self.save_directory
+        return self
+
+    @staticmethod
+    def job_features(smiles: list):
+        """
+        Job size features used to learn command durations i.e. total heavy atoms and rotatable bonds.
+        :param smiles: List of SMILES strings in the job
+        :return: [heavy atoms, rotatable bonds]
+        """
+        heavy_atoms = 0
+        rotatable_bonds = 0
+        for smi in smiles:
+            mol = Chem.MolFromSmiles(smi) if smi else None
+            if mol:
+                heavy_atoms += mol.GetNumHeavyAtoms()
+                rotatable_bonds += Descriptors.NumRotatableBonds(mol)
+        return [heavy_atoms, rotatable_bonds]
+
+    def run_commands(self, commands: list, timeout: float, scheduler: AdaptiveScheduler = None,
+                     features: list = None, speculate: list = None):
+        """
+        Run commands with the executor, through the adaptive scheduler if enabled, otherwise with a static timeout.
+        :param commands: List of commands
+        :param timeout: Static timeout, or per-job timeout until the adaptive scheduler has learnt durations
+        :param scheduler: AdaptiveScheduler
+        :param features: List of job features per command
+        :param speculate: List of callables preparing a speculative duplicate per command
+        """
+        if self.adaptive_timeout and (scheduler is not None):
+            jobs = [ScheduledJob(command, features=f, speculate=spec, timeout=timeout)
+                    for command, f, spec in zip(commands, features, speculate)]
+            _ = scheduler.run(jobs, cancel_dir=os.path.join(self.directory, 'speculative'))
+            shutil.rmtree(os.path.join(self.directory, 'speculative'), ignore_errors=True)
+            logger.debug(f'Scheduler stats: {scheduler.stats()}')
+        else:
+            _ = self.executor.map(partial(_run_command, timeout=timeout), commands)
+            logger.debug(f'Executor stats: {self.executor.stats()}')
+        return self
+
+    def speculative_ligprep(self, smi_in: str, sdf_out: str):
+        """
+        Prepare a duplicate ligprep command with its own job name and working directory, writing to a separate
+         directory.
+        :return: (command, callable to move output into place, working directory)
+        """
+        spec_dir = os.path.join(self.directory, 'speculative', os.path.basename(smi_in).rsplit('.', 1)[0])
+        os.makedirs(spec_dir, exist_ok=True)
+        # LigPrep names the job after its input, so copy it rather than sharing the primary's
+        spec_in = os.path.join(spec_dir, 'speculative_' + os.path.basename(smi_in))
+        shutil.copyfile(smi_in, spec_in)
+        spec_out = os.path.join(spec_dir, os.path.basename(sdf_out))
+
+        def on_win():
+            if os.path.exists(spec_out):
+                os.replace(spec_out, sdf_out)
+
+        return self.ligprep_command(spec_in, spec_out), on_win, spec_dir
+
+    def speculative_glide(self, glide_in_file: str):
+        """
+        Prepare a duplicate glide command writing to (and run in) a separate directory.
+        :return: (command, callable to move output into place, working directory)
+        """
+        spec_dir = os.path.join(self.directory, 'speculative')
+        os.makedirs(spec_dir, exist_ok=True)
+        with open(glide_in_file, 'r') as f:
+            glide_in = self.modify_glide_in(f.readlines(), 'OUTPUTDIR', spec_dir)
+        spec_in_file = os.path.join(spec_dir, os.path.basename(glide_in_file))
+        with open(spec_in_file, 'wt') as f:
+            [f.write(line) for line in glide_in]
+        out_name = os.path.basename(glide_in_file).replace('.in', '_lib.sdfgz')
+
+        def on_win():
+            if os.path.exists(os.path.join(spec_dir, out_name)):
+                os.replace(os.path.join(spec_dir, out_name), os.path.join(self.directory, out_name))
+
+        return self.glide_env + ' -WAIT -NOJOBID -NOLOCAL ' + spec_in_file, on_win, spec_dir
+
     def run_ligprep(self, smiles: list):
         """
         Call ligprep to prepare molecules.
         :param smiles: List of SMILES strings
         """
+        self.smiles = dict(zip(self.file_names, smiles))
+        if self.ligprep_shards:
+            return self.run_ligprep_sharded(smiles)
+
         ligprep_commands = []
+        features = []
+        speculate = []
         # Write out smiles to sdf files and prepare ligprep commands
         for smi, name in zip(smiles, self.file_names):
             smi_in = os.path.join(self.directory, f'{name}.smi')
@@ -97,38 +277,77 @@ class GlideDock:
             with open(smi_in, 'w') as f:
                 f.write(smi)
 
-            command = " ".join((self.ligprep_env,
-                                f"-ismi {smi_in}",
-                                f"-osd {sdf_out}",
-                                "-ph 7.0",
-                                "-pht 1.0",
-                                "-bff 16",
-                                "-s 8",
-                                "-epik",
-                                "-WAIT",
-                                "-NOJOBID"))
-            ligprep_commands.append(command)
+            ligprep_commands.append(self.ligprep_command(smi_in, sdf_out))
+            features.append(self.job_features([smi]))
+            speculate.append(partial(self.speculative_ligprep, smi_in, sdf_out))
 
         # Initialize subprocess
         logger.debug('LigPrep called')
-        p = timedSubprocess(timeout=self.timeout).run
+        self.run_commands(ligprep_commands, timeout=self.timeout, scheduler=self.ligprep_scheduler,
+                          features=features, speculate=speculate)
+        logger.debug('LigPrep finished')
+        return self
 
-        # Run commands either using Dask or sequentially
-        if self.cluster is not None:
-            futures = self.client.map(p, ligprep_commands)
-            _ = self.client.gather(futures)
-        else:
-            _ = [p(command) for command in ligprep_commands]
+    def run_ligprep_sharded(self, smiles: list):
+        """
+        Call ligprep on a few multi-line SMILES files and demultiplex output back to {name}_ligprep.sdf by title.
+        :param smiles: List of SMILES strings
+        """
+        n_shards = max(1, min(self.ligprep_shards, len(smiles)))
+        step = self.file_names[0].split("_")[0]
+        shards = [list(zip(smiles, self.file_names))[i::n_shards] for i in range(n_shards)]
+
+        ligprep_commands = []
+        shard_files = []
+        features = []
+        speculate = []
+        for i, shard in enumerate(shards):
+            smi_in = os.path.join(self.directory, f'{step}_shard{i}.smi')
+            sdf_out = os.path.join(self.directory, f'{step}_shard{i}_ligprep.sdf')
+            with open(smi_in, 'w') as f:
+                f.writelines([f'{smi} {name}\n' for smi, name in shard])
+            ligprep_commands.append(self.ligprep_command(smi_in, sdf_out))
+            shard_files.append((smi_in, sdf_out))
+            features.append(self.job_features([smi for smi, _ in shard]))
+            speculate.append(partial(self.speculative_ligprep, smi_in, sdf_out))
+
+        # Initialize subprocess, each shard gets time proportional to its size
+        logger.debug(f'LigPrep called on {n_shards} shards')
+        self.run_commands(ligprep_commands, timeout=self.timeout * max(len(shard) for shard in shards),
+                          scheduler=self.ligprep_scheduler, features=features, speculate=speculate)
         logger.debug('LigPrep finished')
+
+        # Demultiplex output by title
+        names = set(self.file_names)
+        for smi_in, sdf_out in shard_files:
+            if os.path.exists(sdf_out):
+                records = {}
+                with open(sdf_out, 'r') as f:
+                    record = []
+                    for line in f:
+                        record.append(line)
+                        if line.startswith('$$$$'):
+                            title = record[0].strip()
+                            if title in names:
+                                records.setdefault(title, []).extend(record)
+                            else:
+                                logger.debug(f'Unrecognised title in LigPrep output: {title}')
+                            record = []
+                for name, lines in records.items():
+                    with open(os.path.join(self.directory, f'{name}_ligprep.sdf'), 'w') as f:
+                        f.writelines(lines)
+                os.remove(sdf_out)
+            os.remove(smi_in)
         return self
 
     @property
     def split_sdf(self):
         """
-        Split ligprep output sdf so that each variant can be independently run.
+        Split ligprep output sdf so that each variant can be independently run (or kept in memory if sharding).
         """
         # Read in ligprep output files and split to individual variants
         self.variants = {name: [] for name in self.file_names}
+        self.variant_mols = {}
         for name in self.file_names:
             out_file = os.path.join(self.directory, f'{name}_ligprep.sdf')
 
@@ -142,6 +361,9 @@ class GlideDock:
                         variant = variant.split(':')[1]
                     variant = variant.split('-')[1]
                     self.variants[name].append(variant)
+                    if self.glide_shards:
+                        self.variant_mols[f'{name}-{variant}'] = mol
+                        continue
                     w = Chem.rdmolfiles.SDWriter(os.path.join(self.directory, f'{name}-{variant}_ligprep.sdf'))
                     w.write(mol)
                     w.flush()
@@ -154,7 +376,12 @@ class GlideDock:
         """
         Write GLIDE new input files and submit each to Glide
         """
+        if self.glide_shards:
+            return self.run_glide_sharded()
+
         glide_commands = []
+        features = []
+        speculate = []
         for name in self.file_names:
             for variant in self.variants[name]:
                 # Set some file paths
@@ -175,17 +402,132 @@ class GlideDock:
                 command = self.glide_env + ' -WAIT -NOJOBID -NOLOCAL ' + \
                           os.path.join(self.directory, f'{name}-{variant}.in')
                 glide_commands.append(command)
+                features.append(self.job_features([self.smiles.get(name)]))
+                speculate.append(partial(self.speculative_glide, os.path.join(self.directory, f'{name}-{variant}.in')))
 
         # Initialize subprocess
         logger.debug('Glide called')
-        p = timedSubprocess(timeout=self.timeout).run
+        self.run_commands(glide_commands, timeout=self.timeout, scheduler=self.glide_scheduler,
+                          features=features, speculate=speculate)
+        logger.debug('Glide finished')
+        return self
 
-        if self.cluster is not None:
-            futures = self.client.map(p, glide_commands)
-            _ = self.client.gather(futures)
-        else:
-            _ = [p(command) for command in glide_commands]
+    def run_glide_sharded(self):
+        """
+        Write all variants into a few multi-ligand sdf files titled {name}-{variant}, dock each with one Glide job,
+         and recover per-variant poses from the output by title.
+        """
+        step = self.file_names[0].split("_")[0]
+        all_variants = [f'{name}-{variant}' for name in self.file_names for variant in self.variants[name]]
+        self.poses = {}
+        if len(all_variants) == 0:
+            return self
+        n_shards = max(1, min(self.glide_shards, len(all_variants)))
+
+        glide_commands = []
+        shard_names = []
+        features = []
+        speculate = []
+        for i in range(n_shards):
+            shard_name = f'{step}_glide_shard{i}'
+            w = Chem.rdmolfiles.SDWriter(os.path.join(self.directory, f'{shard_name}_ligprep.sdf'))
+            for name_variant in all_variants[i::n_shards]:
+                # Variants in memory from split_sdf, otherwise written to file (e.g. by ROCS)
+                mol = self.variant_mols.get(name_variant) if self.variant_mols else None
+                if mol is None:
+                    variant_file = os.path.join(self.directory, f'{name_variant}_ligprep.sdf')
+                    if not os.path.exists(variant_file):
+                        continue
+                    mol = next(Chem.rdmolfiles.ForwardSDMolSupplier(variant_file, sanitize=False, removeHs=False),
+                               None)
+                    if mol is None:
+                        continue
+                mol.SetProp('_Name', name_variant)
+                w.write(mol)
+            w.flush()
+            w.close()
+
+            glide_in = self.glide_options.copy()
+            glide_in = self.modify_glide_in(glide_in,
+                                            'LIGANDFILE',
+                                            os.path.join(self.directory, f'{shard_name}_ligprep.sdf'))
+            glide_in = self.modify_glide_in(glide_in,
+                                            'OUTPUTDIR',
+                                            os.path.join(self.directory))
+            with open(os.path.join(self.directory, f'{shard_name}.in'), 'wt') as f:
+                [f.write(line) for line in glide_in]
+            glide_commands.append(self.glide_env + ' -WAIT -NOJOBID -NOLOCAL ' +
+                                  os.path.join(self.directory, f'{shard_name}.in'))
+            shard_names.append(shard_name)
+            features.append(self.job_features([self.smiles.get(name_variant.rsplit('-', 1)[0])
+                                               for name_variant in all_variants[i::n_shards]]))
+            speculate.append(partial(self.speculative_glide, os.path.join(self.directory, f'{shard_name}.in')))
+
+        # Initialize subprocess, each shard gets time proportional to its size
+        logger.debug(f'Glide called on {n_shards} shards')
+        self.run_commands(glide_commands, timeout=self.timeout * len(all_variants[0::n_shards]),
+                          scheduler=self.glide_scheduler, features=features, speculate=speculate)
         logger.debug('Glide finished')
+
+        # Recover best pose per variant by title
+        for shard_name in shard_names:
+            out_file = os.path.join(self.directory, f'{shard_name}_lib.sdfgz')
+            if os.path.exists(out_file):
+                try:
+                    with gzip.open(out_file) as f:
+                        for mol in Chem.ForwardSDMolSupplier(f, sanitize=False, removeHs=False):
+                            if mol is None:
+                                continue
+                            title = mol.GetProp('_Name')
+                            dscore = mol.GetPropsAsDict()['r_i_docking_score']
+                            if (title not in self.poses) or \
+                                    (dscore < self.poses[title].GetPropsAsDict()['r_i_docking_score']):
+                                self.poses[title] = mol
+                except:
+                    logger.debug(f'Error processing {shard_name}_lib.sdfgz file')
+        return self
+
+    def read_poses(self, name: str, variant: str):
+        """
+        Read docked poses for a variant, either from its output file or poses recovered from sharded output.
+        :param name: File name
+        :param variant: LigPrep variant
+        :return: List of rdkit mols or None if no output exists
+        """
+        if self.glide_shards:
+            if f'{name}-{variant}' in self.poses:
+                return [self.poses[f'{name}-{variant}']]
+            return None
+
+        out_file = os.path.join(self.directory, f'{name}-{variant}_lib.sdfgz')
+        if os.path.exists(out_file):
+            with gzip.open(out_file) as f:
+                # Kept as written by Glide (i.e. with hydrogens) when poses are written back out
+                return [mol for mol in Chem.ForwardSDMolSupplier(f, sanitize=False, removeHs=False)]
+        return None
+
+    def write_poses(self, best_variants: list):
+        """
+        Write the best pose of each molecule to the save directory, either as {name}-{variant}_lib.sdfgz or appended
+         to the pose store keyed by {name} if archiving poses.
+        :param best_variants: List of {name}-{variant}
+        """
+        poses = []
+        for name, name_variant in zip(self.file_names, best_variants):
+            if name in self.best_poses:
+                mol = self.best_poses[name]
+                mol.SetProp('_Name', name_variant)
+                poses.append((name, name_variant, mol))
+
+        if self.archive_poses:
+            step = os.path.basename(self.save_directory)
+            self.pose_store.add(step, [(name, mol) for name, _, mol in poses])
+        else:
+            for _, name_variant, mol in poses:
+                with gzip.open(os.path.join(self.save_directory, f'{name_variant}_lib.sdfgz'), 'wt') as f:
+                    w = Chem.rdmolfiles.SDWriter(f)
+                    w.write(mol)
+                    w.close()
         return self
 
     def get_docking_scores(self, smiles: list, return_best_variant: bool = False):
@@ -198,6 +540,7 @@ class GlideDock:
         # Read in docked file
         best_variants = self.file_names.copy()
         best_score = {name: None for name in self.file_names}
+        self.best_poses = {}
 
         # For each molecule
         for i, (smi, name) in enumerate(zip(smiles, self.file_names)):
@@ -205,51 +548,50 @@ class GlideDock:
 
             # For each variant
             for variant in self.variants[name]:
-                out_file = os.path.join(self.directory, f'{name}-{variant}_lib.sdfgz')
 
-                if os.path.exists(out_file):
+                # Try to load it in, and grab the score
+                try:
+                    glide_out = self.read_poses(name, variant)
 
-                    # Try to load it in, and grab the score
-                    try:
-                        with gzip.open(out_file) as f:
-                            glide_out = Chem.ForwardSDMolSupplier(f)
-
-                            for mol in glide_out:  # should just be one
-                                dscore = mol.GetPropsAsDict()['r_i_docking_score']
-
-                                # If molecule doesn't have a score yet append it and the variant
-                                if best_score[name] is None:
-                                    best_score[name] = dscore
-                                    best_variants[i] = f'{name}-{variant}'
-                                    docking_result.update({f'{self.prefix}_' + k: v
-                                                           for k, v in mol.GetPropsAsDict().items()
-                                                           if k in self.score_metrics})
-                                    logger.debug(f'Docking score for {name}-{variant}: {dscore}')
-
-                                # If docking score is better change it...
-                                elif dscore < best_score[name]:
-                                    best_score[name] = dscore
-                                    best_variants[i] = f'{name}-{variant}'
-                                    docking_result.update({f'{self.prefix}_' + k: v
-                                                           for k, v in mol.GetPropsAsDict().items()
-                                                           if k in self.score_metrics})
-                                    logger.debug(f'Found better {name}-{variant}: {dscore}')
-
-                                # Otherwise ignore
-                                else:
-                                    pass
-
-                    # If parsing the molecule threw an error and nothing stored, append 0
-                    except:
-                        logger.debug(f'Error processing {name}-{variant}_lib.sdfgz file')
+                    # If output doesn't exist and nothing stored, append 0
+                    if glide_out is None:
+                        logger.debug(f'{name}-{variant}_lib.sdfgz does not exist')
                         if best_score[name] is None:  # Only if no other score for prefix
                             best_variants[i] = f'{name}-{variant}'
                             docking_result.update({f'{self.prefix}_' + k: 0.0 for k in self.score_metrics})
                             logger.debug(f'Returning 0.0 unless a successful variant is found')
+                        continue
+
+                    for mol in glide_out:  # should just be one
+                        dscore = mol.GetPropsAsDict()['r_i_docking_score']
 
-                # If path doesn't exist and nothing store, append 0
-                else:
-                    logger.debug(f'{name}-{variant}_lib.sdfgz does not exist')
+                        # If molecule doesn't have a score yet append it and the variant
+                        if best_score[name] is None:
+                            best_score[name] = dscore
+                            best_variants[i] = f'{name}-{variant}'
+                            self.best_poses[name] = mol
+                            docking_result.update({f'{self.prefix}_' + k: v
+                                                   for k, v in mol.GetPropsAsDict().items()
+                                                   if k in self.score_metrics})
+                            logger.debug(f'Docking score for {name}-{variant}: {dscore}')
+
+                        # If docking score is better change it...
+                        elif dscore < best_score[name]:
+                            best_score[name] = dscore
+                            best_variants[i] = f'{name}-{variant}'
+                            self.best_poses[name] = mol
+                            docking_result.update({f'{self.prefix}_' + k: v
+                                                   for k, v in mol.GetPropsAsDict().items()
+                                                   if k in self.score_metrics})
+                            logger.debug(f'Found better {name}-{variant}: {dscore}')
+
+                        # Otherwise ignore
+                        else:
+                            pass
+
+                # If parsing the molecule threw an error and nothing stored, append 0
+                except:
+                    logger.debug(f'Error processing {name}-{variant}_lib.sdfgz file')
                     if best_score[name] is None:  # Only if no other score for prefix
                         best_variants[i] = f'{name}-{variant}'
                         docking_result.update({f'{self.prefix}_' + k: 0.0 for k in self.score_metrics})
@@ -266,41 +608,36 @@ class GlideDock:
 
         return self
 
-    def remove_files(self, keep: list = [], parallel: bool = True):
+    def remove_files(self, keep: list = []):
         """
-        Remove some of the log files and molecule files.
-        :param keep: List of filenames to keep pose files for.
-        :param parallel: Whether to run using Dask (requires scheduler address during initialisation).
+        Remove intermediate files in a single pass over the working directory and write the best poses to the save
+         directory. Every file in the step's working directory is removed except the step log (i.e. including shard
+         and any other files not named after a molecule), so nothing else should be written there.
+        :param keep: List of {name}-{variant} to keep the best pose for
         """
-        # If no cluster is provided ensure parallel is False
-        if (parallel is True) and (self.cluster is None):
-            parallel = False
-
-        keep_poses = [f'{k}_lib.sdfgz' for k in keep]
-        logger.debug(f'Keeping pose files: {keep_poses}')
-        del_files = []
-        for name in self.file_names:
-            # Grab files
-            files = glob.glob(os.path.join(self.directory, f'{name}*'))
-            logger.debug(f'Glob found {len(files)} files')
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('log.txt'):
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    # No need to stop if files can't be found and deleted
+                    except FileNotFoundError:
+                        pass
+        logger.debug(f'Removed {removed} files')
+        if self.directory != self.save_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+        logger.debug(f'Keeping poses: {keep}')
+        self.write_poses(keep)
+        return self
 
-            if len(files) > 0:
-                try:
-                    files = [file for file in files
-                             if not ("log.txt" in file) and not any([p in file for p in keep_poses])]
-
-                    if parallel:
-                        [del_files.append(file) for file in files]
-                    else:
-                        [os.remove(file) for file in files]
-                # No need to stop if files can't be found and deleted
-                except FileNotFoundError:
-                    logger.debug('File not found.')
-                    pass
-                
-        if parallel:
-            futures = self.client.map(os.remove, del_files)
-            _ = self.client.gather(futures)
+    def shutdown(self):
+        """
+        Shutdown the executor.
+        """
+        self.executor.shutdown()
         return self
 
     def __call__(self, smiles: list, directory: str, file_names: list, **kwargs):
@@ -315,25 +652,18 @@ class GlideDock:
         # Assign some attributes
         step = file_names[0].split("_")[0]  # Assume first Prefix is step
 
-        # Create log directory
-        self.directory = os.path.join(os.path.abspath(directory), 'GlideDock', step)
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
+        # Create log and working directories
+        self.setup_directory(directory, step)
         self.file_names = file_names
         self.docking_results = []  # make sure no carry over
 
         # Add logging file handler
-        fh = logging.FileHandler(os.path.join(self.directory, f'{step}_log.txt'))
+        fh = logging.FileHandler(os.path.join(self.save_directory, f'{step}_log.txt'))
         fh.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         fh.setFormatter(formatter)
         logger.addHandler(fh)
 
-        # Refresh Dask every few hundred iterations
-        if self.cluster is not None:
-            if int(step) % 250 == 0:
-                self.client.restart()
-
         # Run protocol
         self.run_ligprep(smiles=smiles)
         self.split_sdf  # Catch any erroneous smiles with no output ligprep file
@@ -341,13 +671,17 @@ class GlideDock:
         best_variants = self.get_docking_scores(smiles=smiles, return_best_variant=True)
 
         # Cleanup
-        self.remove_files(keep=best_variants, parallel=True)
+        self.remove_files(keep=best_variants)
         fh.close()
         logger.removeHandler(fh)
         self.directory = None
+        self.save_directory = None
         self.file_names = None
         self.variants = None
-        
+        self.variant_mols = None
+        self.poses = None
+        self.best_poses = None
+
         # Check
         assert len(smiles) == len(self.docking_results)
 
@@ -359,7 +693,8 @@ class GlideDockFromROCS(GlideDock, ROCS):
     A Scoring function class that uses ROCS to align molecules to ligand (co-crystallised), and score in place.
     """
     def __init__(self, prefix: str, glide_template: str, ref_file: str, cluster: str = None,
-                 timeout: float = 120.0, **kwargs):
+                 timeout: float = 120.0, ligprep_shards: int = None, glide_shards: int = None, n_jobs: int = 1,
+                 conformer_store: str = None, conformer_store_size: float = 1024.0, executor: str = None, **kwargs):
         """
         A Scoring function class that uses ROCS to align molecules to ligand (co-crystallised), and score in place.
         :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
@@ -367,10 +702,20 @@ class GlideDockFromROCS(GlideDock, ROCS):
         :param ref_file: Path to reference file to overlay query to (.pdb)
         :param cluster: Dask scheduler address
         :param timeout: Timeout before kill a docking process and returning a score of 0.0
-        :param kwargs: Ignored
+        :param ligprep_shards: Split SMILES into this many multi-line files with one LigPrep process each
+        :param glide_shards: Dock all aligned variants in this many multi-ligand Glide jobs
+        :param n_jobs: Number of worker processes for ROCS alignment, and concurrent commands for local executors
+        :param conformer_store: Path to a conformer store (.db) to reuse Omega conformers across calls and runs
+        :param conformer_store_size: Maximum size of the conformer store in MB
+        :param executor: How to run LigPrep and Glide commands, 'serial', 'thread', 'process' or 'dask'
+         (default 'dask' if cluster is provided otherwise 'serial')
+        :param kwargs: Additional GlideDock parameters (e.g. adaptive_timeout)
         """
-        GlideDock.__init__(self, prefix=prefix, glide_template=glide_template, cluster=cluster, timeout=timeout)
-        ROCS.__init__(self, prefix=prefix, ref_file=ref_file)
+        GlideDock.__init__(self, prefix=prefix, glide_template=glide_template, cluster=cluster, timeout=timeout,
+                           ligprep_shards=ligprep_shards, glide_shards=glide_shards, executor=executor,
+                           n_jobs=n_jobs, **kwargs)
+        ROCS.__init__(self, prefix=prefix, ref_file=ref_file, n_jobs=n_jobs, conformer_store=conformer_store,
+                      conformer_store_size=conformer_store_size)
 
         self.prefix = prefix.replace(" ", "")
         # Make sure glide template contains 'mininplace' method
@@ -388,30 +733,25 @@ class GlideDockFromROCS(GlideDock, ROCS):
 
         # Assign some attributes
         step = file_names[0].split("_")[0]  # Assume first Prefix is step
-        self.directory = os.path.join(os.path.abspath(directory), 'GlideDock', step)
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
+        self.setup_directory(directory, step)
         self.file_names = file_names
         self.docking_results = []
 
         # Add logging file handler
-        fh = logging.FileHandler(os.path.join(self.directory, f'{step}_log.txt'))
+        fh = logging.FileHandler(os.path.join(self.save_directory, f'{step}_log.txt'))
         fh.setLevel(logging.DEBUG)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         fh.setFormatter(formatter)
         logger.addHandler(fh)
 
-        # Refresh Dask every few hundred iterations
-        if self.cluster is not None:
-            if int(step) % 250 == 0:
-                self.client.restart()
-
         # Prepare ligands
         self.run_ligprep(smiles)
 
-        # Read sdf files and run ROCS and write for docking
+        # Read sdf files and run ROCS (in parallel) and write for docking
         results = []
         rocs_results = {}
+        rocs_smiles = []
+        rocs_variants = []
         self.variants = {name: [] for name in self.file_names}
         for name in self.file_names:
             out_file = os.path.join(self.directory, f'{name}_ligprep.sdf')
@@ -421,38 +761,35 @@ class GlideDockFromROCS(GlideDock, ROCS):
                     if mol:
                         variant = mol.GetPropsAsDict()['s_lp_Variant'].split("-")[1]
                         self.variants[name].append(variant)
-                        self.setup_smi(Chem.MolToSmiles(mol, isomericSmiles=True))
-                        self.run_omega()
-
-                        # Hack to catch 'valid molecules' that have no coordinates after omega init
-                        if len(self.fitmol.GetCoords()) == 0:
-                            rocs_results[f'{name}_{variant}'] = {f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics}
-                            continue
-
-                        # Run ROCS and write each variants best overlay
-                        self.run_ROCS()
-                        rocs_results[f'{name}_{variant}'] = {m: getattr(self.rocs_results, m)()
-                                                             for m in self.rocs_metrics}
-                        self.get_best_overlay()
-                        ofs = oechem.oemolostream(os.path.join(self.directory, f'{name}-{variant}_ligprep.sdf'))
-                        if oechem.OEAddExplicitHydrogens(self.best_overlay):
-                            oechem.OEWriteMolecule(ofs, self.best_overlay)
-                        ofs.close()
-                        logger.debug(f'Split and aligned {name} -> {name}-{variant}')
+                        rocs_smiles.append(Chem.MolToSmiles(mol, isomericSmiles=True))
+                        rocs_variants.append((name, variant))
+
+        # Each variant's best overlay is written by the workers
+        overlay_files = [os.path.join(self.directory, f'{name}-{variant}_ligprep.sdf')
+                         for name, variant in rocs_variants]
+        for (name, variant), (result, _) in zip(rocs_variants,
+                                                self.score_parallel(rocs_smiles, overlay_files=overlay_files)):
+            result.pop('smiles')
+            rocs_results[f'{name}-{variant}'] = result
+            logger.debug(f'Split and aligned {name} -> {name}-{variant}')
 
         self.run_glide()
         best_variants = self.get_docking_scores(smiles, return_best_variant=True)
         for result, best_variant in zip(self.docking_results, best_variants):
-            result.update(rocs_results[best_variant])
+            result.update(rocs_results.get(best_variant, {f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics}))
             results.append(result)
 
         # Cleanup
-        self.remove_files(keep=best_variants, parallel=True)
+        self.remove_files(keep=best_variants)
         fh.close()
         logger.removeHandler(fh)
         self.directory = None
+        self.save_directory = None
         self.file_names = None
         self.variants = None
+        self.variant_mols = None
+        self.poses = None
+        self.best_poses = None
         self.fitmol = None
         self.rocs_results = None
         self.best_overlay = None
@@ -462,6 +799,14 @@ class GlideDockFromROCS(GlideDock, ROCS):
         assert len(smiles) == len(results)
         return results
 
+    def shutdown(self):
+        """
+        Shutdown the executor and ROCS workers.
+        """
+        GlideDock.shutdown(self)
+        ROCS.shutdown(self)
+        return self
+
 
 #class GlideDockFromGlide(GlideDock):
     # TODO implement inplace glide docking from previous dock
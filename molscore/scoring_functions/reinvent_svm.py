@@ -2,34 +2,32 @@
 Adapted from
 https://github.com/MarcusOlivecrona/REINVENT
 """
-from __future__ import print_function, division
-import numpy as np
 from rdkit import Chem
-from rdkit import rdBase
-from rdkit.Chem import AllChem
-from sklearn.externals import joblib
-rdBase.DisableLog('rdApp.error')
 
+from molscore.scoring_functions.sklearn_model import SKLearnModel, fold_fingerprints
 
-class ActivityModel:
+
+class ActivityModel(SKLearnModel):
     """ This particular class uses the SVM taken from the REINVENT publication and
      refactors code used for fingerprint generation.
      https://github.com/MarcusOlivecrona/REINVENT
     """
 
-    def __init__(self, prefix: str, cpath: str, **kwargs):
+    def __init__(self, prefix: str, cpath: str, n_jobs: int = 1, chunk_size: int = 1000, **kwargs):
         """
         This particular class uses the SVM taken from the REINVENT publication and
              refactors code used for fingerprint generation.
                   https://github.com/MarcusOlivecrona/REINVENT
         :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
         :param cpath: File path to scikit-learn model (probably only works with reinvent clf.pkl)
+        :param n_jobs: Number of worker processes
+        :param chunk_size: Number of molecules featurized and predicted at a time
         :param kwargs: Ignored
         """
+        super().__init__(prefix=prefix, model_path=cpath, method='predict_proba', radius=3, n_bits=2048,
+                         use_features=True, use_counts=True, n_jobs=n_jobs, chunk_size=chunk_size)
         self.clf_path = cpath
-        self.prefix = prefix.replace(" ", "_")
-        self.clf = joblib.load(self.clf_path)
-        self.score_metrics = ['pred_prob']
+        self.clf = self.model
 
     def __call__(self, smiles, **kwargs):
         """
@@ -40,44 +38,13 @@ class ActivityModel:
         """
         # If just a single str
         if isinstance(smiles, str):
-            results = {'smiles': smiles}
-            mol = Chem.MolFromSmiles(smiles)
-
-            if mol:
-                fp = ActivityModel.fingerprints_from_mol(mol)
-                score = self.clf.predict_proba(fp)[:, 1]
-                results.update({f'{self.prefix}_pred_prob': float(score[0])})
-            else:
-                results.update({f'{self.prefix}_pred_prob': 0.0})
-            return results
+            return super().__call__([smiles])[0]
 
         elif isinstance(smiles, list):
-            results = []
-            valid = []
-            fps = []
-
-            # Calculate fingerprints
-            for i, smi in enumerate(smiles):
-                result = {'smiles': smi}
-                mol = Chem.MolFromSmiles(smi)
-                if mol:
-                    fp = ActivityModel.fingerprints_from_mol(mol)
-                    fps.append(fp.reshape(-1))
-                    valid.append(i)
-                else:
-                    result.update({f'{self.prefix}_pred_prob': 0.0})
-                results.append(result)
-
-            # Grab prediction
-            y_prob = self.clf.predict_proba(np.asarray(fps))[:, 1]
-            for i, prob in zip(valid, y_prob):
-                results[i].update({f'{self.prefix}_pred_prob': prob})
-
-            return results
+            return super().__call__(smiles)
 
         else:
-            print('smiles not provided in correct format')
-            raise
+            raise TypeError('smiles not provided in correct format')
 
     @classmethod
     def fingerprints_from_mol(cls, mol: Chem.rdchem.Mol):
@@ -86,11 +53,4 @@ class ActivityModel:
         :param mol: rdkit mol
         :return: fp (ndarray)
         """
-        fp = AllChem.GetMorganFingerprint(mol, 3, useCounts=True, useFeatures=True)
-        size = 2048
-        nfp = np.zeros((1, size), np.int32)
-        for idx, v in fp.GetNonzeroElements().items():
-            nidx = idx % size
-            nfp[0, nidx] += int(v)
-        return nfp
-
+        return fold_fingerprints([mol], radius=3, n_bits=2048, use_features=True, use_counts=True)
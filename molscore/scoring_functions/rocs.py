@@ -1,4 +1,5 @@
 import logging
+from multiprocessing import Pool
 
 from rdkit.Chem import AllChem as Chem
 
@@ -6,6 +7,8 @@ from openeye import oechem
 from openeye import oeomega
 from openeye import oeshape
 
+from molscore.scoring_functions.conformer_store import ConformerStore
+
 logger = logging.getLogger('ROCS')
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 logger.setLevel(logging.DEBUG)
@@ -13,17 +16,59 @@ ch = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 logger.addHandler(ch)
 
+# Per worker process ROCS instance (OpenEye objects can't be pickled so each worker builds its own)
+_worker_rocs = None
+
+
+def omega_options_string(options, depth: int = 2):
+    """
+    Describe the scalar settings of Omega options (and nested option objects) as a string, e.g. to key stored
+     conformers by the settings that generated them.
+    :param options: oeomega.OEOmegaOptions
+    :param depth: Levels of nested option objects to include
+    :return: String e.g. 'OEOmegaOptions:MaxSearchTime=1.0;StrictStereo=False;...'
+    """
+    settings = []
+    for name in sorted(dir(options)):
+        if not name.startswith('Get'):
+            continue
+        try:
+            value = getattr(options, name)()
+        except Exception:
+            # Getters that require arguments
+            continue
+        if isinstance(value, (bool, int, float, str)):
+            settings.append(f'{name[3:]}={value}')
+        elif (depth > 0) and type(value).__name__.endswith('Options'):
+            settings.append(f'{name[3:]}=({omega_options_string(value, depth - 1)})')
+    return f'{type(options).__name__}:' + ';'.join(settings)
+
+
+def _init_worker(prefix: str, ref_file: str, conformer_store: str, conformer_store_size: float):
+    global _worker_rocs
+    _worker_rocs = ROCS(prefix=prefix, ref_file=ref_file, n_jobs=1, conformer_store=conformer_store,
+                        conformer_store_size=conformer_store_size)
+
+
+def _worker_score(args):
+    smi, overlay_file = args
+    return _worker_rocs.score_smiles(smi, overlay_file=overlay_file)
+
 
 class ROCS:
     """
     Shape alignment on generated molecules. 
     """
-    def __init__(self, prefix: str, ref_file: str, **kwargs):
+    def __init__(self, prefix: str, ref_file: str, n_jobs: int = 1, chunk_size: int = 4,
+                 conformer_store: str = None, conformer_store_size: float = 1024.0, **kwargs):
         """
         Shape alignment on generated molecules to a reference molecule
         :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
         :param ref_file: Path to reference file to overlay query to (.pdb)
-        :param return_best_overlay: Whether to also return best overlay (for use with docking)
+        :param n_jobs: Number of worker processes, each with its own Omega instance and reference molecule
+        :param chunk_size: Number of SMILES streamed to a worker at a time
+        :param conformer_store: Path to a conformer store (.db) to reuse Omega conformers across calls and runs
+        :param conformer_store_size: Maximum size of the conformer store in MB
         :param kwargs: Ignored
         """
 
@@ -40,25 +85,49 @@ class ROCS:
         self.fitmol = None
         self.rocs_results = None
         self.best_overlay = None
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.pool = None
 
         omegaOpts = oeomega.OEOmegaOptions()
         omegaOpts.SetStrictStereo(False)
         omegaOpts.SetMaxSearchTime(1.0)
         self.omega = oeomega.OEOmega(omegaOpts)
 
+        # Conformers are keyed by SMILES and Omega options
+        self.fitsmi = None
+        self.conformer_store = None
+        self.conformer_store_path = conformer_store
+        self.conformer_store_size = conformer_store_size
+        if self.conformer_store_path is not None:
+            self.conformer_store = ConformerStore(path=self.conformer_store_path,
+                                                  options=omega_options_string(omegaOpts),
+                                                  max_size=self.conformer_store_size)
+
     def setup_smi(self, smiles: str):
         """
         Load SMILES string into OE mol object
         :param smiles: SMILES string
         :return:
         """
+        self.fitsmi = smiles
         self.fitmol = oechem.OEMol()
         oechem.OESmilesToMol(self.fitmol, smiles)
 
         return self
 
     def run_omega(self):
-        """Run omega on query mol"""
+        """Run omega on query mol, or read conformers from the conformer store if previously generated"""
+        if self.conformer_store is not None:
+            data = self.conformer_store.get(self.fitsmi)
+            if data is not None:
+                self.fitmol = oechem.OEMol()
+                oechem.OEReadMolFromBytes(self.fitmol, '.oeb.gz', data)
+                return self
+            if self.omega(self.fitmol):
+                self.conformer_store.put(self.fitsmi, oechem.OEWriteMolToBytes('.oeb.gz', self.fitmol))
+            return self
+
         self.omega(self.fitmol)
         return self
 
@@ -77,6 +146,74 @@ class ROCS:
                 self.best_overlay = conf
         return self
 
+    def score_smiles(self, smi: str, overlay_file: str = None):
+        """
+        Run omega and ROCS for a single SMILES string.
+        :param smi: SMILES string
+        :param overlay_file: Optionally write the best overlay (with explicit hydrogens) to this file
+        :return: (result dict, best overlay as .oeb bytes or None)
+        """
+        result = {'smiles': smi}
+        overlay = None
+        if Chem.MolFromSmiles(smi):
+            try:
+                self.setup_smi(smi)
+                self.run_omega()
+
+                # Hack to catch 'valid molecules' that have no coordinates after omega initialisation
+                if len(self.fitmol.GetCoords()) == 0:
+                    result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
+                    return result, overlay
+
+                self.run_ROCS()
+                rocs_results = {metric: getattr(self.rocs_results, metric)() for metric in self.rocs_metrics}
+                result.update({f'{self.prefix}_{m}': v for m, v in rocs_results.items()})
+
+                self.get_best_overlay()
+                if overlay_file is not None:
+                    ofs = oechem.oemolostream(overlay_file)
+                    if oechem.OEAddExplicitHydrogens(self.best_overlay):
+                        oechem.OEWriteMolecule(ofs, self.best_overlay)
+                    ofs.close()
+                overlay = oechem.OEWriteMolToBytes('.oeb', oechem.OEMol(self.best_overlay))
+
+            except:
+                logger.debug(f'{smi}: Can\'t process molecule')
+                result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
+        else:
+            logger.debug(f'{smi}: rdkit molecule is None type')
+            result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
+
+        return result, overlay
+
+    def score_parallel(self, smiles: list, overlay_files: list = None):
+        """
+        Stream SMILES in chunks to a pool of workers, each with its own Omega instance and reference molecule.
+        :param smiles: List of SMILES strings
+        :param overlay_files: Optional list of files to write best overlays to
+        :return: List of (result dict, best overlay as .oeb bytes or None)
+        """
+        if overlay_files is None:
+            overlay_files = [None] * len(smiles)
+        if self.n_jobs <= 1:
+            return [self.score_smiles(smi, overlay_file=f) for smi, f in zip(smiles, overlay_files)]
+
+        if self.pool is None:
+            self.pool = Pool(self.n_jobs, initializer=_init_worker,
+                             initargs=(self.prefix, self.ref_file, self.conformer_store_path,
+                                       self.conformer_store_size))
+        return list(self.pool.imap(_worker_score, zip(smiles, overlay_files), chunksize=self.chunk_size))
+
+    def shutdown(self):
+        """
+        Terminate worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self
+
     def __call__(self, smiles: list, return_best_overlay: bool = False, **kwargs):
         """
         Calculate ROCS metrics for a list of smiles compared to a reference molecule.
@@ -88,36 +225,14 @@ class ROCS:
         results = []
         best_overlays = []
 
-        for smi in smiles:
-            result = {'smiles': smi}
-
-            if Chem.MolFromsmiles(smi):
-                try:
-                    self.setup_smi(smi)
-                    self.run_omega()
-
-                    # Hack to catch 'valid molecules' that have no coordinates after omega initialisation
-                    if len(self.fitmol.GetCoords()) == 0:
-                        result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
-                        continue
-
-                    self.run_ROCS()
-                    rocs_results = {metric: getattr(self.rocs_results, metric)() for metric in self.rocs_metrics}
-                    result.update({f'{self.prefix}_{m}': v for m, v in rocs_results.items()})
-                    results.append(result)
-
-                    if return_best_overlay:
-                        self.get_best_overlay()
-                        best_overlays.append(self.best_overlay)
-
-                except:
-                    logger.debug(f'{smi}: Can\'t process molecule')
-                    result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
-                    results.append(result)
-            else:
-                logger.debug(f'{smi}: rdkit molecule is None type')
-                result.update({f'{self.prefix}_{m}': 0.0 for m in self.rocs_metrics})
-                results.append(result)
+        for result, overlay in self.score_parallel(smiles):
+            results.append(result)
+            if return_best_overlay:
+                best_overlay = None
+                if overlay is not None:
+                    best_overlay = oechem.OEMol()
+                    oechem.OEReadMolFromBytes(best_overlay, '.oeb', overlay)
+                best_overlays.append(best_overlay)
 
         if return_best_overlay:
             assert len(results) == len(best_overlays)
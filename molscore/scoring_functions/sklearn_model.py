@@ -0,0 +1,165 @@
+"""
+Score molecules with a pre-trained scikit-learn model on folded Morgan fingerprints
+"""
+
+import logging
+import numpy as np
+from multiprocessing import Pool
+from rdkit import Chem
+from rdkit import rdBase
+from rdkit.Chem import AllChem
+
+rdBase.DisableLog('rdApp.error')
+
+logger = logging.getLogger('sklearn_model')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+# Per worker process state, set once by the pool initializer
+_worker_model = None
+
+
+def _init_worker(model_path: str, fp_kwargs: dict, method: str):
+    global _worker_model
+    _worker_model = SKLearnModel(prefix='worker', model_path=model_path, method=method, n_jobs=1, **fp_kwargs)
+
+
+def _worker_predict(smiles: list):
+    return _worker_model.predict(smiles)
+
+
+def fold_fingerprints(mols: list, radius: int = 3, n_bits: int = 2048, use_features: bool = True,
+                      use_counts: bool = True):
+    """
+    Morgan fingerprints folded into n_bits (unfolded id modulo n_bits, summing counts) for a batch of molecules,
+     written into one preallocated int32 matrix.
+    :param mols: List of rdkit mols
+    :param radius: Morgan radius
+    :param n_bits: Number of folded bins
+    :param use_features: Use feature invariants (FCFP)
+    :param use_counts: Keep counts, otherwise binarize
+    :return: matrix [n_mols x n_bits]
+    """
+    rows = []
+    cols = []
+    vals = []
+    for i, mol in enumerate(mols):
+        elements = AllChem.GetMorganFingerprint(mol, radius, useCounts=True,
+                                                useFeatures=use_features).GetNonzeroElements()
+        rows.append(np.full(len(elements), i, dtype=np.int64))
+        cols.append(np.fromiter(elements.keys(), dtype=np.int64, count=len(elements)))
+        vals.append(np.fromiter(elements.values(), dtype=np.int32, count=len(elements)))
+
+    X = np.zeros((len(mols), n_bits), dtype=np.int32)
+    if rows:
+        # Unbuffered add so ids folding into the same bin are summed
+        np.add.at(X, (np.concatenate(rows), np.concatenate(cols) % n_bits), np.concatenate(vals))
+    if not use_counts:
+        np.minimum(X, 1, out=X)
+    return X
+
+
+def fingerprint_matrix(smiles: list, **kwargs):
+    """
+    Folded Morgan fingerprints for a batch of SMILES, see fold_fingerprints.
+    :param smiles: List of SMILES strings
+    :param kwargs: Passed to fold_fingerprints
+    :return: (matrix [n_valid x n_bits], list of valid indexes)
+    """
+    mols = []
+    valid = []
+    for i, smi in enumerate(smiles):
+        mol = Chem.MolFromSmiles(smi)
+        if mol:
+            mols.append(mol)
+            valid.append(i)
+    return fold_fingerprints(mols, **kwargs), valid
+
+
+class SKLearnModel:
+    """
+    Score molecules with a pre-trained scikit-learn model (saved with joblib) on folded Morgan fingerprints.
+    """
+    def __init__(self, prefix: str, model_path: str, method: str = 'predict_proba', radius: int = 3,
+                 n_bits: int = 2048, use_features: bool = True, use_counts: bool = True, n_jobs: int = 1,
+                 chunk_size: int = 1000, **kwargs):
+        """
+        Score molecules with a pre-trained scikit-learn model on folded Morgan fingerprints.
+        :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
+        :param model_path: Path to a joblib dumped scikit-learn model, saved uncompressed it is memory mapped so
+         worker processes share it
+        :param method: 'predict_proba' (probability of the positive class) or 'predict'
+        :param radius: Morgan radius
+        :param n_bits: Number of folded fingerprint bins
+        :param use_features: Use feature invariants (FCFP)
+        :param use_counts: Use counts, otherwise binary
+        :param n_jobs: Number of worker processes (started on first use and kept until shutdown)
+        :param chunk_size: Number of molecules featurized and predicted at a time
+        :param kwargs: Ignored
+        """
+        assert method in ['predict_proba', 'predict']
+        self.prefix = prefix.replace(" ", "_")
+        self.model_path = model_path
+        self.method = method
+        self.fp_kwargs = {'radius': radius, 'n_bits': n_bits, 'use_features': use_features,
+                          'use_counts': use_counts}
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.score_metrics = ['pred_prob' if method == 'predict_proba' else 'pred']
+        # Imported here so molscore doesn't require scikit-learn/joblib unless this scoring function is used
+        try:
+            import joblib
+        except ImportError:
+            from sklearn.externals import joblib
+        self.model = joblib.load(self.model_path, mmap_mode='r')
+        self.pool = None
+
+    def predict(self, smiles: list):
+        """
+        Predict a list of SMILES in chunks.
+        :param smiles: List of SMILES strings
+        :return: List of predictions (0.0 for invalid SMILES)
+        """
+        predictions = np.zeros(len(smiles), dtype=np.float64)
+        for start in range(0, len(smiles), self.chunk_size):
+            X, valid = fingerprint_matrix(smiles[start:start + self.chunk_size], **self.fp_kwargs)
+            if len(valid) == 0:
+                continue
+            if self.method == 'predict_proba':
+                y = self.model.predict_proba(X)[:, 1]
+            else:
+                y = self.model.predict(X)
+            predictions[start + np.asarray(valid)] = y
+        return predictions.tolist()
+
+    def shutdown(self):
+        """
+        Terminate worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self
+
+    def __call__(self, smiles: list, **kwargs):
+        """
+        Calculate scores for SKLearnModel given a list of SMILES
+        :param smiles: List of SMILES strings
+        :param kwargs: Ignored
+        :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
+        """
+        if (self.n_jobs <= 1) or (len(smiles) <= self.chunk_size):
+            predictions = self.predict(smiles)
+        else:
+            if self.pool is None:
+                self.pool = Pool(self.n_jobs, initializer=_init_worker,
+                                 initargs=(self.model_path, self.fp_kwargs, self.method))
+            chunks = [smiles[i:i + self.chunk_size] for i in range(0, len(smiles), self.chunk_size)]
+            predictions = [p for chunk in self.pool.map(_worker_predict, chunks) for p in chunk]
+
+        metric = f'{self.prefix}_{self.score_metrics[0]}'
+        return [{'smiles': smi, metric: float(p)} for smi, p in zip(smiles, predictions)]
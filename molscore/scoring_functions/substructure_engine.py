@@ -0,0 +1,152 @@
+"""
+Precompiled SMARTS matching shared by SubstructureFilters and SubstructureMatch
+"""
+
+import logging
+from multiprocessing import Pool
+
+from rdkit import Chem
+from rdkit import DataStructs
+from rdkit.Chem import FilterCatalog
+
+logger = logging.getLogger('substructure_engine')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+# Per worker process state, set once by the pool initializer
+_worker_engine = None
+
+
+def _init_worker(smarts: list, use_pattern_fp: bool, use_filter_catalog: bool):
+    global _worker_engine
+    _worker_engine = SubstructureEngine(smarts=smarts, n_jobs=1, use_pattern_fp=use_pattern_fp,
+                                        use_filter_catalog=use_filter_catalog)
+
+
+def _worker_match(args):
+    smi, method = args
+    return _worker_engine.match_smiles(smi, method=method)
+
+
+class SubstructureEngine:
+    """
+    Compile and de-duplicate SMARTS patterns once, then match them against SMILES in a persistent pool of workers.
+    """
+    methods = ['any', 'all', 'flags', 'counts']
+
+    def __init__(self, smarts: list, n_jobs: int = 1, use_pattern_fp: bool = True,
+                 use_filter_catalog: bool = False):
+        """
+        Compile and de-duplicate SMARTS patterns once, then match them against SMILES in a persistent pool of workers.
+        :param smarts: List of SMARTS strings
+        :param n_jobs: Number of worker processes (workers are started on first use and kept until shutdown)
+        :param use_pattern_fp: Screen patterns with RDKit pattern fingerprints to skip impossible matches
+        :param use_filter_catalog: Use an RDKit FilterCatalog for 'any' matching
+        """
+        self.n_jobs = n_jobs
+        self.use_pattern_fp = use_pattern_fp
+        self.use_filter_catalog = use_filter_catalog
+        self.pool = None
+
+        # De-duplicate (preserving order) and compile, dropping invalid patterns
+        self.smarts = []
+        self.patterns = []
+        for sub in dict.fromkeys(smarts):
+            patt = Chem.MolFromSmarts(sub)
+            if patt:
+                self.smarts.append(sub)
+                self.patterns.append(patt)
+            else:
+                logger.warning(f'Could not parse SMARTS {sub}, ignoring')
+        if len(self.smarts) < len(smarts):
+            logger.debug(f'Compiled {len(self.smarts)} unique patterns from {len(smarts)} SMARTS')
+
+        self.pattern_fps = None
+        if self.use_pattern_fp:
+            self.pattern_fps = [Chem.PatternFingerprint(patt) for patt in self.patterns]
+
+        self.catalog = None
+        if self.use_filter_catalog:
+            self.catalog = FilterCatalog.FilterCatalog()
+            for sub in self.smarts:
+                self.catalog.AddEntry(FilterCatalog.FilterCatalogEntry(sub, FilterCatalog.SmartsMatcher(sub, sub, 1)))
+
+    def _candidates(self, mol: Chem.rdchem.Mol):
+        """
+        Indexes of patterns that could match this molecule i.e. pattern fingerprint bits are a subset of the mol's
+        """
+        if self.pattern_fps is None:
+            return range(len(self.patterns))
+        mol_fp = Chem.PatternFingerprint(mol)
+        return [i for i, pfp in enumerate(self.pattern_fps) if DataStructs.AllProbeBitsMatch(pfp, mol_fp)]
+
+    def match_mol(self, mol: Chem.rdchem.Mol, method: str = 'any'):
+        """
+        Match compiled patterns against a molecule.
+        :param mol: rdkit mol
+        :param method: 'any' or 'all' return a bool (short-circuiting), 'flags' or 'counts' return a list per pattern
+        :return: bool or list
+        """
+        candidates = set(self._candidates(mol))
+
+        if method == 'any':
+            if self.catalog is not None:
+                return self.catalog.HasMatch(mol)
+            return any(mol.HasSubstructMatch(self.patterns[i]) for i in sorted(candidates))
+
+        if method == 'all':
+            if len(candidates) < len(self.patterns):
+                return False
+            return all(mol.HasSubstructMatch(patt) for patt in self.patterns)
+
+        if method == 'flags':
+            return [int((i in candidates) and mol.HasSubstructMatch(patt))
+                    for i, patt in enumerate(self.patterns)]
+
+        if method == 'counts':
+            return [len(mol.GetSubstructMatches(patt)) if i in candidates else 0
+                    for i, patt in enumerate(self.patterns)]
+
+        raise ValueError(f'Unknown method {method}, must be one of {self.methods}')
+
+    def match_smiles(self, smi: str, method: str = 'any'):
+        """
+        Match compiled patterns against a SMILES string.
+        :param smi: SMILES string
+        :param method: 'any', 'all', 'flags' or 'counts'
+        :return: (SMILES, match) where match is None if the SMILES could not be parsed
+        """
+        mol = Chem.MolFromSmiles(smi)
+        if not mol:
+            return smi, None
+        return smi, self.match_mol(mol, method=method)
+
+    def __call__(self, smiles: list, method: str = 'any'):
+        """
+        Match compiled patterns against a list of SMILES, in parallel if n_jobs > 1.
+        :param smiles: List of SMILES strings
+        :param method: 'any', 'all', 'flags' or 'counts'
+        :return: List of (SMILES, match)
+        """
+        assert method in self.methods, f'Method must be one of {self.methods}'
+        if self.n_jobs <= 1:
+            return [self.match_smiles(smi, method=method) for smi in smiles]
+
+        if self.pool is None:
+            self.pool = Pool(self.n_jobs, initializer=_init_worker,
+                             initargs=(self.smarts, self.use_pattern_fp, self.use_filter_catalog))
+        chunksize = max(1, len(smiles) // (self.n_jobs * 4))
+        return list(self.pool.imap(_worker_match, [(smi, method) for smi in smiles], chunksize=chunksize))
+
+    def shutdown(self):
+        """
+        Terminate worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self
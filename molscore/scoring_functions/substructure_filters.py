@@ -3,9 +3,7 @@ Adapted from
 https://github.com/MolecularAI/Reinvent
 """
 
-from rdkit import Chem
-from functools import partial
-from multiprocessing import Pool
+from molscore.scoring_functions.substructure_engine import SubstructureEngine
 
 
 class SubstructureFilters:
@@ -13,7 +11,7 @@ class SubstructureFilters:
     Scoring function class to penalise undesirable substructures in a molecule.
     """
     def __init__(self, prefix: str, az_filters: bool = False, custom_filters: list = [],
-                 n_jobs: int = 1, **kwargs):
+                 n_jobs: int = 1, per_pattern: str = None, use_filter_catalog: bool = False, **kwargs):
         """
         Scoring function class to check for undesirable substructures in a molecule.
 
@@ -22,10 +20,14 @@ class SubstructureFilters:
         (https://github.com/MolecularAI/Reinvent)
         :param custom_filters: A list of smarts to define custom substructure filters.
         :param n_jobs: Number of jobs for multiprocessing
+        :param per_pattern: Additionally return per pattern 'flags' or 'counts' as metrics (default None)
+        :param use_filter_catalog: Use an RDKit FilterCatalog for matching
         :param kwargs: Ignored
         """
         self.prefix = prefix.replace(" ", "_")
         self.n_jobs = n_jobs
+        assert per_pattern in [None, 'flags', 'counts']
+        self.per_pattern = per_pattern
         self.smarts = []
         az_smarts = [
             "[*;r8]",
@@ -39,17 +41,7 @@ class SubstructureFilters:
             "[*;r16]",
             "[*;r17]",
             "[#8][#8]",
-            "[#6;+]", "[#7;!n][S;!$(S(=O)=O)]",
-            "[#7;!n][#7;!n]",
-            "C#C",
-            "C(=[O,S])[O,S]",
-            "[#7;!n][C;!$(C(=[O,N])[N,O])][#16;!s]",
-            "[#7;!n][C;!$(C(=[O,N])[N,O])][#7;!n]",
-            "[#7;!n][C;!$(C(=[O,N])[N,O])][#8;!o]",
-            "[#8;!o][C;!$(C(=[O,N])[N,O])][#16;!s]",
-            "[#8;!o][C;!$(C(=[O,N])[N,O])][#8;!o]",
-            "[#16;!s][C;!$(C(=[O,N])[N,O])][#16;!s]",
-            "[#16][#16]",
+            "[#6;+]",
             "[#7;!n][S;!$(S(=O)=O)]",
             "[#7;!n][#7;!n]",
             "C#C",
@@ -59,30 +51,17 @@ class SubstructureFilters:
             "[#7;!n][C;!$(C(=[O,N])[N,O])][#8;!o]",
             "[#8;!o][C;!$(C(=[O,N])[N,O])][#16;!s]",
             "[#8;!o][C;!$(C(=[O,N])[N,O])][#8;!o]",
-            "[#16;!s][C;!$(C(=[O,N])[N,O])][#16;!s]"
+            "[#16;!s][C;!$(C(=[O,N])[N,O])][#16;!s]",
+            "[#16][#16]"
         ]
         if az_filters:
             self.smarts += az_smarts
         if len(custom_filters) > 0:
             self.smarts += custom_filters
 
-    @staticmethod
-    def match_substructure(smi: str, smarts_filters: list):
-        """
-        Method to return a score for a given SMILES string and SMARTS patterns as filters
-         (static method for easier multiprocessing)
-        :param smi: SMILES string
-        :param smarts_filters: List of SMARTS strings
-        :return: (SMILES, score)
-        """
-        mol = Chem.MolFromSmiles(smi)
-        if mol:
-            match = any([mol.HasSubstructMatch(Chem.MolFromSmarts(sub)) for sub in
-                         smarts_filters if Chem.MolFromSmarts(sub)])
-            match = not match  # revert, not matching substructure filters should be good i.e. 1
-        else:
-            match = 0
-        return smi, int(match)
+        # Compile patterns once, workers are persistent across calls
+        self.engine = SubstructureEngine(smarts=self.smarts, n_jobs=self.n_jobs,
+                                         use_filter_catalog=use_filter_catalog)
 
     def __call__(self, smiles: list, **kwargs):
         """
@@ -91,8 +70,26 @@ class SubstructureFilters:
         :param kwargs: Ignored
         :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
         """
-        with Pool(self.n_jobs) as pool:
-            match_substructure_p = partial(self.match_substructure, smarts_filters=self.smarts)
-            results = [{'smiles': smi, f'{self.prefix}_substructure_filters': match}
-                       for smi, match in pool.imap(match_substructure_p, smiles)]
+        results = []
+        method = 'any' if self.per_pattern is None else self.per_pattern
+        for smi, match in self.engine(smiles, method=method):
+            result = {'smiles': smi}
+            if match is None:
+                result[f'{self.prefix}_substructure_filters'] = 0
+                if self.per_pattern is not None:
+                    result.update({f'{self.prefix}_{sub}': 0 for sub in self.engine.smarts})
+            elif self.per_pattern is None:
+                # Revert, not matching substructure filters should be good i.e. 1
+                result[f'{self.prefix}_substructure_filters'] = int(not match)
+            else:
+                result[f'{self.prefix}_substructure_filters'] = int(not any(match))
+                result.update({f'{self.prefix}_{sub}': m for sub, m in zip(self.engine.smarts, match)})
+            results.append(result)
         return results
+
+    def shutdown(self):
+        """
+        Terminate persistent worker processes.
+        """
+        self.engine.shutdown()
+        return self
@@ -3,9 +3,7 @@ Adapted from
 https://github.com/MolecularAI/Reinvent
 """
 
-from rdkit import Chem
-from functools import partial
-from multiprocessing import Pool
+from molscore.scoring_functions.substructure_engine import SubstructureEngine
 
 
 class SubstructureMatch:
@@ -13,13 +11,14 @@ class SubstructureMatch:
     Scoring function class to reward desirable substructures in a molecule.
     """
     def __init__(self, prefix: str, smarts: list = [],
-                 n_jobs: int = 1, method: str = 'any', **kwargs):
+                 n_jobs: int = 1, method: str = 'any', per_pattern: str = None, **kwargs):
         """
         Scoring function class to reward desirable substructures in a molecule.
         :param prefix: Name (to help keep track metrics, if using a scoring function class more than once)
         :param smarts: List of SMARTS strings that define desirable substructures
         :param n_jobs: Number of jobs for multiprocessing
         :param method: To give reward for 'any' match, or only for 'all' matches
+        :param per_pattern: Additionally return per pattern 'flags' or 'counts' as metrics (default None)
         :param kwargs: Ignored
         """
         self.prefix = prefix.replace(" ", "_")
@@ -27,28 +26,11 @@ class SubstructureMatch:
         self.smarts = smarts
         assert method in ['any', 'all']
         self.method = method
+        assert per_pattern in [None, 'flags', 'counts']
+        self.per_pattern = per_pattern
 
-    @staticmethod
-    def match_substructure(smi: str, smarts: list, method: str):
-        """
-        Method to return a score for a given SMILES string, SMARTS patterns and method ('all' or 'any')
-         (static method for easier multiprocessing)
-        :param smi: SMILES string
-        :param smarts: List of SMARTS strings
-        :param method: Require to match either 'any' or 'all' SMARTS
-        :return: (SMILES, score)
-        """
-        mol = Chem.MolFromSmiles(smi)
-        if mol:
-            if method == 'any':
-                match = any([mol.HasSubstructMatch(Chem.MolFromSmarts(sub)) for sub in
-                             smarts if Chem.MolFromSmarts(sub)])
-            if method == 'all':
-                match = all([mol.HasSubstructMatch(Chem.MolFromSmarts(sub)) for sub in
-                             smarts if Chem.MolFromSmarts(sub)])
-        else:
-            match = 0
-        return smi, int(match)
+        # Compile patterns once, workers are persistent across calls
+        self.engine = SubstructureEngine(smarts=self.smarts, n_jobs=self.n_jobs)
 
     def __call__(self, smiles: list, **kwargs):
         """
@@ -57,8 +39,28 @@ class SubstructureMatch:
         :param kwargs: Ignored
         :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
         """
-        with Pool(self.n_jobs) as pool:
-            match_substructure_p = partial(self.match_substructure, smarts=self.smarts, method=self.method)
-            results = [{'smiles': smi, f'{self.prefix}_substructure_match': match}
-                       for smi, match in pool.imap(match_substructure_p, smiles)]
+        results = []
+        method = self.method if self.per_pattern is None else self.per_pattern
+        for smi, match in self.engine(smiles, method=method):
+            result = {'smiles': smi}
+            if match is None:
+                result[f'{self.prefix}_substructure_match'] = 0
+                if self.per_pattern is not None:
+                    result.update({f'{self.prefix}_{sub}': 0 for sub in self.engine.smarts})
+            elif self.per_pattern is None:
+                result[f'{self.prefix}_substructure_match'] = int(match)
+            else:
+                if self.method == 'any':
+                    result[f'{self.prefix}_substructure_match'] = int(any(match))
+                else:
+                    result[f'{self.prefix}_substructure_match'] = int(all(match))
+                result.update({f'{self.prefix}_{sub}': m for sub, m in zip(self.engine.smarts, match)})
+            results.append(result)
         return results
+
+    def shutdown(self):
+        """
+        Terminate persistent worker processes.
+        """
+        self.engine.shutdown()
+        return self
@@ -0,0 +1,222 @@
+"""
+Online surrogate model to pre-screen molecules before an expensive scoring function (e.g. docking)
+"""
+
+import logging
+import numpy as np
+from rdkit import DataStructs
+from rdkit.Chem import AllChem as Chem
+
+logger = logging.getLogger('surrogate')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+class BayesianRidge:
+    """
+    Bayesian linear regression with a fixed prior precision, updated online from sufficient statistics so the cost
+     of an update doesn't grow with the number of observations.
+    """
+    def __init__(self, n_features: int, alpha: float = 1.0):
+        """
+        Bayesian linear regression with a fixed prior precision.
+        :param n_features: Number of features
+        :param alpha: Prior precision (ridge penalty)
+        """
+        self.n_features = n_features
+        self.alpha = alpha
+        self.XtX = np.zeros((n_features + 1, n_features + 1), dtype=np.float64)
+        self.Xty = np.zeros(n_features + 1, dtype=np.float64)
+        self.yty = 0.0
+        self.n = 0
+        self.coef = None
+        self.cov = None
+        self.noise = 1.0
+
+    @staticmethod
+    def _design(X: np.ndarray):
+        return np.hstack([np.ones((X.shape[0], 1)), X])
+
+    def update(self, X: np.ndarray, y: np.ndarray):
+        """
+        Add observations and refit the posterior.
+        :param X: Features (n_samples x n_features)
+        :param y: Targets (n_samples)
+        """
+        X = self._design(np.asarray(X, dtype=np.float64))
+        y = np.asarray(y, dtype=np.float64)
+        self.XtX += X.T.dot(X)
+        self.Xty += X.T.dot(y)
+        self.yty += y.dot(y)
+        self.n += len(y)
+
+        # Posterior with intercept unpenalized
+        precision = self.XtX + self.alpha * np.eye(self.n_features + 1)
+        precision[0, 0] -= self.alpha
+        precision[0, 0] += 1e-6
+        self.cov = np.linalg.inv(precision)
+        self.coef = self.cov.dot(self.Xty)
+        # Noise variance from residual sum of squares
+        rss = self.yty - 2 * self.coef.dot(self.Xty) + self.coef.dot(self.XtX).dot(self.coef)
+        self.noise = max(rss / max(self.n - 1, 1), 1e-6)
+        return self
+
+    def predict(self, X: np.ndarray):
+        """
+        Predictive mean and standard deviation.
+        :param X: Features (n_samples x n_features)
+        :return: (mean, std)
+        """
+        X = self._design(np.asarray(X, dtype=np.float64))
+        mean = X.dot(self.coef)
+        var = self.noise * (1 + np.einsum('ij,jk,ik->i', X, self.cov, X))
+        return mean, np.sqrt(var)
+
+
+class SurrogateScreen:
+    """
+    Wrap an expensive scoring function with an online-trained surrogate model. The surrogate is trained on the
+     wrapped function's results and, once trained, only molecules selected by the acquisition function (up to a
+     budget per call) are sent to the wrapped function, the rest are assigned the surrogate prediction.
+    """
+    acquisitions = ['ucb', 'greedy', 'uncertainty', 'random']
+
+    def __init__(self, function, target: str, maximize: bool = False, budget: float = 0.2,
+                 acquisition: str = 'ucb', kappa: float = 1.0, min_train: int = 200, radius: int = 2,
+                 bits: int = 1024, alpha: float = 1.0, seed: int = 123, **kwargs):
+        """
+        Wrap an expensive scoring function with an online-trained surrogate model.
+        :param function: Scoring function instance
+        :param target: Metric to predict (including prefix e.g. 'DRD2_r_i_docking_score')
+        :param maximize: Whether higher target values are better (e.g. False for docking score)
+        :param budget: Number (>= 1) or fraction (< 1) of molecules per call sent to the scoring function
+        :param acquisition: How to select molecules for the scoring function, 'ucb' (promising or uncertain),
+         'greedy' (promising), 'uncertainty' (uncertain) or 'random'
+        :param kappa: Weight of uncertainty in 'ucb'
+        :param min_train: Number of scored molecules before the surrogate is used, all molecules are sent to the
+         scoring function before this
+        :param radius: Radius of Morgan fingerprints
+        :param bits: Number of Morgan fingerprint bits
+        :param alpha: Prior precision of the Bayesian ridge model
+        :param seed: Random seed for 'random' acquisition
+        :param kwargs: Ignored
+        """
+        assert acquisition in self.acquisitions, f'Acquisition must be one of {self.acquisitions}'
+        self.function = function
+        self.target = target
+        self.maximize = maximize
+        self.budget = budget
+        self.acquisition = acquisition
+        self.kappa = kappa
+        self.min_train = min_train
+        self.radius = radius
+        self.bits = bits
+        self.model = BayesianRidge(n_features=bits, alpha=alpha)
+        self.rng = np.random.RandomState(seed)
+        self.predicted_metric = f'{target}_predicted'
+        self.uncertainty_metric = f'{target}_uncertainty'
+
+    def __getattr__(self, name):
+        # Delegate e.g. prefix, score_metrics to the wrapped scoring function
+        if name == 'function':
+            raise AttributeError(name)
+        return getattr(self.function, name)
+
+    def featurize(self, smiles: list):
+        """
+        Morgan fingerprint bit matrix (invalid SMILES are all zeros).
+        """
+        X = np.zeros((len(smiles), self.bits), dtype=np.uint8)
+        for i, smi in enumerate(smiles):
+            mol = Chem.MolFromSmiles(smi)
+            if mol:
+                fp = Chem.GetMorganFingerprintAsBitVect(mol, radius=self.radius, nBits=self.bits)
+                DataStructs.ConvertToNumpyArray(fp, X[i])
+        return X
+
+    def n_budget(self, n: int):
+        if self.budget >= 1:
+            return min(int(self.budget), n)
+        return min(int(np.ceil(self.budget * n)), n)
+
+    def select(self, mean: np.ndarray, std: np.ndarray, n: int):
+        """
+        Indexes of molecules to send to the scoring function.
+        """
+        if self.acquisition == 'random':
+            return self.rng.choice(len(mean), size=n, replace=False)
+        direction = 1.0 if self.maximize else -1.0
+        if self.acquisition == 'ucb':
+            utility = direction * mean + self.kappa * std
+        elif self.acquisition == 'greedy':
+            utility = direction * mean
+        else:
+            utility = std
+        return np.argsort(-utility, kind='stable')[:n]
+
+    def update(self, X: np.ndarray, results: list):
+        """
+        Train the surrogate on scoring function results.
+        """
+        y = np.asarray([r.get(self.target, np.nan) for r in results], dtype=np.float64)
+        mask = np.isfinite(y)
+        if mask.any():
+            self.model.update(X[mask], y[mask])
+        return self
+
+    def get_state(self):
+        """
+        Surrogate model state, see MolScore.snapshot.
+        """
+        return {'model': self.model, 'rng': self.rng.get_state()}
+
+    def set_state(self, state: dict):
+        self.model = state['model']
+        self.rng.set_state(state['rng'])
+        return self
+
+    def shutdown(self):
+        if hasattr(self.function, 'shutdown'):
+            self.function.shutdown()
+        return self
+
+    def __call__(self, smiles: list, directory: str, file_names: list, **kwargs):
+        """
+        Calculate scores with the wrapped scoring function for selected molecules, and surrogate predictions for the
+         rest.
+        :param smiles: List of SMILES strings
+        :param directory: Directory to save files and logs into
+        :param file_names: List of corresponding file names for SMILES to match files to index
+        :param kwargs: Passed to the scoring function
+        :return: List of dicts i.e. [{'smiles': smi, 'metric': 'value', ...}, ...]
+        """
+        X = self.featurize(smiles)
+        index = {smi: i for i, smi in enumerate(smiles)}
+
+        # Not enough data yet, score everything
+        if (self.model.n < self.min_train) or (self.n_budget(len(smiles)) >= len(smiles)):
+            results = self.function(smiles=smiles, directory=directory, file_names=file_names, **kwargs)
+            self.update(X[[index[r['smiles']] for r in results]], results)
+            for r in results:
+                r.update({self.predicted_metric: 'false', self.uncertainty_metric: 0.0})
+            return results
+
+        mean, std = self.model.predict(X)
+        selected = np.sort(self.select(mean, std, self.n_budget(len(smiles))))
+        selected_set = set(selected.tolist())
+        logger.debug(f'Sending {len(selected)}/{len(smiles)} molecules to {type(self.function).__name__}')
+
+        results = self.function(smiles=[smiles[i] for i in selected], directory=directory,
+                                file_names=[file_names[i] for i in selected], **kwargs)
+        self.update(X[[index[r['smiles']] for r in results]], results)
+        for r in results:
+            r.update({self.predicted_metric: 'false', self.uncertainty_metric: 0.0})
+
+        for i, smi in enumerate(smiles):
+            if i not in selected_set:
+                results.append({'smiles': smi, self.target: float(mean[i]), self.predicted_metric: 'true',
+                                self.uncertainty_metric: float(std[i])})
+        return results
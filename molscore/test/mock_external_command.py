@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Stand-in external worker for testing ExternalCommand. Reads batches of SMILES lines ('{smiles} {name}') or SDF
+ records from stdin terminated by a line containing only __END__, and writes a score per molecule (SMILES length or
+ number of atoms) as CSV, SDF or plain text lines followed by __END__. Exits with an error on a batch containing
+ the --crash SMILES.
+"""
+
+import sys
+import time
+import argparse
+
+END = '__END__'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mock external scoring worker')
+    parser.add_argument('--input', default='smiles', choices=['smiles', 'sdf'])
+    parser.add_argument('--output', default='csv', choices=['csv', 'sdf', 'regex'])
+    parser.add_argument('--startup', type=float, default=0.0, help='Seconds to sleep on start up')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to sleep per batch')
+    parser.add_argument('--crash', help='Exit with an error on a batch containing this SMILES')
+    return parser.parse_args()
+
+
+def read_batch():
+    lines = []
+    for line in sys.stdin:
+        if line.rstrip('\n') == END:
+            return lines
+        lines.append(line)
+    return None  # EOF
+
+
+def score_smiles(lines):
+    scores = []
+    for line in lines:
+        if line.strip():
+            smi, name = line.split()
+            scores.append((name, len(smi)))
+    return scores
+
+
+def score_sdf(lines):
+    scores = []
+    record = []
+    for line in lines:
+        if line.startswith('$$$$'):
+            name = record[0].strip()
+            n_atoms = int(record[3][:3])
+            scores.append((name, n_atoms))
+            record = []
+        else:
+            record.append(line)
+    return scores
+
+
+def write_scores(scores, output):
+    if output == 'csv':
+        sys.stdout.write('name,score\n')
+        for name, score in scores:
+            sys.stdout.write(f'{name},{score}\n')
+    elif output == 'sdf':
+        for name, score in scores:
+            sys.stdout.write(f'{name}\n  mock\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n'
+                             f'>  <score>\n{score}\n\n$$$$\n')
+    else:
+        for name, score in scores:
+            sys.stdout.write(f'Molecule {name} scored {score}\n')
+    sys.stdout.write(f'{END}\n')
+    sys.stdout.flush()
+
+
+def main():
+    args = parse_args()
+    time.sleep(args.startup)
+    while True:
+        lines = read_batch()
+        if lines is None:
+            break
+        if (args.crash is not None) and any(line.split()[:1] == [args.crash] for line in lines):
+            sys.exit(1)
+        time.sleep(args.delay)
+        scores = score_smiles(lines) if args.input == 'smiles' else score_sdf(lines)
+        write_scores(scores, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Stand-in for Schrodinger's LigPrep for testing GlideDock. Reads a SMILES file (lines of '{smiles}' or
+ '{smiles} {name}') and writes an SDF record per variant, titled by name (or the input file name) with an
+ s_lp_Variant property. Molecules with a nitrogen get two variants, SMILES that can't be parsed are skipped
+ (with no output file if none can be).
+"""
+
+import os
+import argparse
+
+from rdkit import Chem
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mock LigPrep')
+    parser.add_argument('-ismi', required=True, help='Input SMILES file')
+    parser.add_argument('-osd', required=True, help='Output sdf file')
+    # Ignore the other LigPrep options e.g. -ph 7.0 -epik -WAIT
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    default_title = os.path.basename(args.ismi).rsplit('.', 1)[0]
+    records = []
+    with open(args.ismi, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            title = fields[1] if len(fields) > 1 else default_title
+            mol = Chem.MolFromSmiles(fields[0])
+            if mol is None:
+                continue
+            n_variants = 2 if any(atom.GetSymbol() == 'N' for atom in mol.GetAtoms()) else 1
+            mol.SetProp('_Name', title)
+            for k in range(1, n_variants + 1):
+                records.append(Chem.MolToMolBlock(mol) + f'>  <s_lp_Variant>\n{title}-{k}\n\n$$$$\n')
+    if records:
+        with open(args.osd, 'w') as f:
+            f.writelines(records)
+
+
+if __name__ == '__main__':
+    main()
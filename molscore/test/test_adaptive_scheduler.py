@@ -0,0 +1,58 @@
+import os
+import sys
+
+from molscore.scoring_functions.executors import AdaptiveScheduler, ScheduledJob, get_executor
+
+
+def python_command(code):
+    return f'{sys.executable} -c {code}'
+
+
+def test_failed_commands_are_retried_not_recorded():
+    executor = get_executor('thread', n_jobs=2)
+    scheduler = AdaptiveScheduler(executor=executor, max_retries=1, poll_interval=0.01)
+    try:
+        results = scheduler.run([ScheduledJob(python_command('pass'), features=[1], timeout=10.0),
+                                 ScheduledJob(python_command('exit(3)'), features=[1], timeout=10.0)])
+        assert results == [True, False]
+        assert scheduler.failures == 2
+        # Only the successful command is learnt from
+        assert len(scheduler.history_y) == 1
+        # Every attempt went through the executor
+        assert executor.stats()['jobs'] == 3
+    finally:
+        executor.shutdown()
+
+
+def test_timeouts_are_not_recorded():
+    scheduler = AdaptiveScheduler(n_jobs=1, poll_interval=0.01)
+    try:
+        assert scheduler.run([ScheduledJob(python_command("__import__('time').sleep(5)"), features=[1],
+                                           timeout=0.5)]) == [False]
+        assert scheduler.timeouts == 1
+        assert len(scheduler.history_y) == 0
+    finally:
+        scheduler.shutdown()
+
+
+def test_speculative_attempt_wins(tmp_path):
+    spec_dir = tmp_path / 'speculative'
+    won = []
+
+    def speculate():
+        spec_dir.mkdir(exist_ok=True)
+        return python_command('pass'), lambda: won.append(True), str(spec_dir)
+
+    scheduler = AdaptiveScheduler(n_jobs=2, min_history=2, poll_interval=0.01)
+    try:
+        for _ in range(2):
+            scheduler.record([1], 0.05)
+        results = scheduler.run([ScheduledJob(python_command("__import__('time').sleep(30)"), features=[1],
+                                              speculate=speculate, timeout=60.0)], cancel_dir=str(tmp_path))
+        assert results == [True]
+        assert won == [True]
+        assert scheduler.speculative_wins == 1
+        # The slow attempt was stopped and its cancel file removed
+        assert os.listdir(str(tmp_path)) == ['speculative']
+    finally:
+        scheduler.shutdown()
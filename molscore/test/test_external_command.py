@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+
+from molscore.scoring_functions.external_command import ExternalWorker, ExternalCommand
+
+MOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_external_command.py')
+
+
+def mock_command(*args):
+    return ' '.join([sys.executable, MOCK] + list(args))
+
+
+def test_worker_runs_batches():
+    worker = ExternalWorker(mock_command())
+    try:
+        assert worker.run('CCO mol0\nC mol1\n') == 'name,score\nmol0,3\nmol1,1\n'
+        assert worker.run('CCCC mol0\n') == 'name,score\nmol0,4\n'
+        assert worker.restarts == 0
+    finally:
+        worker.stop()
+
+
+def test_worker_timeout_restarts():
+    worker = ExternalWorker(mock_command('--delay', '5'), timeout=0.5, max_restarts=2)
+    try:
+        assert worker.run('CCO mol0\n') is None
+        assert worker.restarts == 1
+        assert worker.alive()
+    finally:
+        worker.stop()
+
+
+def test_worker_crash_restarts():
+    worker = ExternalWorker(mock_command('--crash', 'CCN'), timeout=10.0, max_restarts=2)
+    try:
+        assert worker.run('CCN mol0\n') is None
+        assert worker.restarts == 1
+        # The restarted worker handles the next batch
+        assert worker.run('CCO mol0\n') == 'name,score\nmol0,3\n'
+    finally:
+        worker.stop()
+
+
+def test_worker_gives_up_after_max_restarts():
+    worker = ExternalWorker(mock_command('--crash', 'CCN'), timeout=10.0, max_restarts=1)
+    try:
+        assert worker.run('CCN mol0\n') is None
+        with pytest.raises(RuntimeError):
+            worker.run('CCN mol0\n')
+        # Stays failed rather than silently starting again
+        with pytest.raises(RuntimeError):
+            worker.run('CCO mol0\n')
+        assert not worker.alive()
+        worker.reset()
+        assert worker.run('CCO mol0\n') == 'name,score\nmol0,3\n'
+    finally:
+        worker.stop()
+
+
+def test_worker_restarts_reset_after_success():
+    worker = ExternalWorker(mock_command('--crash', 'CCN'), timeout=10.0, max_restarts=1)
+    try:
+        for _ in range(3):
+            assert worker.run('CCN mol0\n') is None
+            assert worker.restarts == 1
+            assert worker.run('CCO mol0\n') == 'name,score\nmol0,3\n'
+            assert worker.restarts == 0
+        assert not worker.failed
+    finally:
+        worker.stop()
+
+
+def test_external_command_scores_failed_batches_zero():
+    scorer = ExternalCommand(prefix='mock', command=mock_command('--crash', 'CCN'), output_fields=['score'],
+                             batch_size=1, timeout=10.0, n_workers=1, max_restarts=1)
+    try:
+        for _ in range(3):
+            results = scorer(['CCO', 'CCN', 'CCCC'])
+            assert [r['mock_score'] for r in results] == [3.0, 0.0, 4.0]
+    finally:
+        scorer.shutdown()
+
+
+def test_external_command_retires_failed_workers():
+    scorer = ExternalCommand(prefix='mock', command=mock_command('--crash', 'CCN'), output_fields=['score'],
+                             batch_size=1, timeout=10.0, n_workers=2, max_restarts=0)
+    try:
+        # The first worker to crash gives up and is retired, the other scores the rest
+        results = scorer(['CCO', 'CCN', 'CCCC', 'CCO'])
+        assert [r['mock_score'] for r in results] == [3.0, 0.0, 4.0, 3.0]
+        assert sum(worker.failed for worker in scorer.all_workers) == 1
+        # Raise rather than scoring every molecule 0 once all workers have given up
+        with pytest.raises(RuntimeError):
+            scorer(['CCN', 'CCO'])
+    finally:
+        scorer.shutdown()
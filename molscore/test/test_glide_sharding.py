@@ -0,0 +1,59 @@
+import os
+import sys
+import stat
+
+import pytest
+
+from molscore.scoring_functions.glide import GlideDock
+
+MOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_ligprep.py')
+
+# Multiple variants, a repeated SMILES and an invalid SMILES (no LigPrep output)
+SMILES = ['c1ccccc1CC', 'c1ccncc1CO', 'CCN', 'c1ccccc1CC', 'xyz', 'OCC(=O)O', 'C1CCNCC1']
+
+
+@pytest.fixture
+def schrodinger(tmp_path, monkeypatch):
+    # $SCHRODINGER/ligprep runs the stand-in
+    directory = tmp_path / 'schrodinger'
+    directory.mkdir()
+    ligprep = directory / 'ligprep'
+    ligprep.write_text(f'#!/bin/sh\nexec {sys.executable} {MOCK} "$@"\n')
+    ligprep.chmod(ligprep.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('SCHRODINGER', str(directory))
+    template = tmp_path / 'glide.in'
+    template.write_text('GRIDFILE grid.zip\nPRECISION SP\n')
+    return str(template)
+
+
+def ligprep_outputs(template, directory, **kwargs):
+    gd = GlideDock(prefix='test', glide_template=template, **kwargs)
+    try:
+        gd.file_names = [f'0_{i}' for i in range(len(SMILES))]
+        gd.setup_directory(directory, '0')
+        gd.run_ligprep(SMILES)
+        gd.split_sdf
+        outputs = {}
+        for name in gd.file_names:
+            path = os.path.join(gd.directory, f'{name}_ligprep.sdf')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    outputs[name] = f.read()
+        return outputs, gd.variants, sorted(os.listdir(gd.directory))
+    finally:
+        gd.shutdown()
+
+
+@pytest.mark.parametrize('shards', [1, 3, 20])
+@pytest.mark.parametrize('executor', ['serial', 'thread'])
+def test_sharded_ligprep_matches_unsharded(schrodinger, tmp_path, shards, executor):
+    outputs, variants, _ = ligprep_outputs(schrodinger, str(tmp_path / 'unsharded'), executor=executor, n_jobs=2)
+    sharded_outputs, sharded_variants, files = ligprep_outputs(schrodinger, str(tmp_path / 'sharded'),
+                                                               executor=executor, n_jobs=2, ligprep_shards=shards)
+
+    assert set(outputs) == {'0_0', '0_1', '0_2', '0_3', '0_5', '0_6'}
+    assert sharded_outputs == outputs
+    assert sharded_variants == variants
+    assert variants['0_1'] == ['1', '2'] and variants['0_4'] == []
+    # Shard inputs and outputs are removed after demultiplexing
+    assert not [f for f in files if 'shard' in f]
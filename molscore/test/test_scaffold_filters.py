@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from molscore.scaffold_memory import all_scaffold_filters, IdenticalMurckoScaffold, ScaffoldSimilarityAP, \
+    LeaderClustering
+
+# Repeated and similar scaffolds, a duplicate molecule, one below minscore and an invalid SMILES
+SMILES = [
+    'c1ccccc1CC', 'c1ccccc1CO', 'c1ccccc1CN', 'c1ccccc1CC', 'c1ccncc1CC', 'C1CCCCC1O', 'c1ccccc1CCl',
+    'c1ccc2ccccc2c1C', 'xyz', 'c1ccccc1C(=O)O', 'C1CCCCC1N', 'c1ccncc1CO', 'c1ccc2ccccc2c1O', 'c1ccccc1CF',
+    'c1ccccc1Cc1ccccc1', 'c1ccccc1Cc1ccncc1', 'c1ccc2ncccc2c1'
+]
+SCORES = [0.9, 0.8, 0.7, 0.9, 0.65, 0.3, 0.95, 0.85, 0.9, 0.75, 0.8, 0.7, 0.6, 0.99, 0.8, 0.9, 0.7]
+OUTPUTMODES = ['binary', 'linear', 'sigmoid']
+
+FILTERS = [(cls, {}) for cls in all_scaffold_filters] + [
+    (ScaffoldSimilarityAP, {'lsh': True}),
+    # A single band of many hashes, so similar scaffolds are rarely candidates
+    (ScaffoldSimilarityAP, {'lsh': True, 'num_perm': 32, 'bands': 1}),
+    (LeaderClustering, {'max_leaders': 2})
+]
+
+
+def memory_rows(sf, tmp_path, name):
+    path = str(tmp_path / name)
+    sf.savetocsv(path)
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('outputmode', OUTPUTMODES)
+@pytest.mark.parametrize('cls,kwargs', FILTERS, ids=lambda p: getattr(p, '__name__', str(p)))
+def test_batch_matches_sequential(cls, kwargs, outputmode, tmp_path):
+    batch = cls(nbmax=2, minscore=0.6, minsimilarity=0.6, outputmode=outputmode, **kwargs)
+    sequential = cls(nbmax=2, minscore=0.6, minsimilarity=0.6, outputmode=outputmode, **kwargs)
+    try:
+        steps = {'step': np.arange(len(SMILES))}
+        filtered, passes = batch.score_batch(SMILES, np.array(SCORES), steps)
+
+        seq_filtered, seq_passes = [], []
+        for i, (smi, score) in enumerate(zip(SMILES, SCORES)):
+            f, p = sequential.score_batch([smi], np.array([score]), {'step': [i]})
+            seq_filtered.append(f[0])
+            seq_passes.append(p[0])
+
+        np.testing.assert_allclose(filtered, seq_filtered)
+        assert passes.tolist() == seq_passes
+        assert memory_rows(batch, tmp_path, 'batch.csv') == memory_rows(sequential, tmp_path, 'sequential.csv')
+    finally:
+        batch.shutdown()
+        sequential.shutdown()
+
+
+@pytest.mark.parametrize('outputmode', OUTPUTMODES)
+def test_calculate_outputs_matches_calculate_output(outputmode):
+    sf = IdenticalMurckoScaffold(nbmax=4, outputmode=outputmode)
+    counts = np.arange(7)
+    np.testing.assert_allclose(sf.calculate_outputs(counts), [sf.calculate_output(int(n)) for n in counts])
+
+
+def test_identical_murcko_binary():
+    sf = IdenticalMurckoScaffold(nbmax=2, minscore=0.6, outputmode='binary')
+    try:
+        scores = sf.score(['c1ccccc1CC', 'c1ccccc1CO', 'c1ccccc1CN', 'c1ccccc1CC', 'c1ccccc1C', 'xyz'],
+                          {'total_score': [0.9, 0.8, 0.7, 0.9, 0.5, 0.9], 'step': [1] * 6})
+        # 3rd member of the benzene bucket is over nbmax, the duplicate is already in memory, below minscore isn't
+        #  penalized and invalid SMILES share the '' bucket
+        assert scores == [0.9, 0.8, 0.0, 0.0, 0.5, 0.9]
+        assert sf.count('c1ccccc1') == 3
+        assert sf.count('') == 1
+    finally:
+        sf.shutdown()
@@ -0,0 +1,47 @@
+from molscore.scaffold_memory.ScaffoldMemory import ScaffoldStore, ScaffoldMemory
+
+MEMBERS = [('a', 'x', 1.0), ('b', 'y', 2.0), ('a', 'z', 3.0), ('c', 'w', 4.0), ('a', 'x', 5.0)]
+
+
+def reference(members):
+    # The plain nested dict storage ScaffoldStore replaced
+    d = {}
+    for scaffold, smi, score in members:
+        d.setdefault(scaffold, {})[smi] = {'total_score': score}
+    return d
+
+
+def test_store_matches_nested_dict():
+    # Small chunks so the counts array grows
+    store = ScaffoldStore(chunk_size=2)
+    for scaffold, smi, score in MEMBERS:
+        store.add(scaffold, smi, {'total_score': score})
+    expected = reference(MEMBERS)
+
+    assert store.to_dict() == expected
+    assert list(store) == list(expected)
+    for scaffold, members in expected.items():
+        assert store.members(scaffold) == members
+        assert store.count(scaffold) == len(members)
+        assert all(store.has(scaffold, smi) for smi in members)
+    assert store.members('d') == {}
+    assert not store.has('b', 'x')
+    assert [row[:3] for row in store.iter_rows()] == [[0, 'a', 'x'], [0, 'a', 'z'], [1, 'b', 'y'], [2, 'c', 'w']]
+
+
+def test_store_pads_new_score_columns():
+    store = ScaffoldStore()
+    store.add('a', 'x', {'total_score': 1.0})
+    store.add('a', 'z', {'total_score': 2.0, 'step': 3})
+    assert store.columns() == ['total_score', 'step']
+    assert store.members('a') == {'x': {'total_score': 1.0}, 'z': {'total_score': 2.0, 'step': 3.0}}
+
+
+def test_memory_getitem():
+    memory = ScaffoldMemory()
+    scaffolds = memory.add(['c1ccccc1CC', 'c1ccccc1CO', 'C1CCCCC1'], [{'total_score': 0.5}, {'total_score': 0.7}, {}])
+    assert scaffolds == ['c1ccccc1', 'c1ccccc1', 'C1CCCCC1']
+    assert memory['c1ccccc1'] == {'c1ccccc1CC': {'total_score': 0.5}, 'c1ccccc1CO': {'total_score': 0.7}}
+    assert memory['C1CCCCC1'] == {'C1CCCCC1': {}}
+    assert memory['C1CC1'] == []
+    memory.shutdown()
@@ -15,6 +15,7 @@ import base64
 from io import BytesIO
 
 from molscore.utils import dash_utils as utils
+from molscore.utils.pose_store import PoseStore
 
 # Load in iterations files
 it_path = os.path.join(os.path.abspath(sys.argv[1]), 'iterations')
@@ -42,6 +43,7 @@ else:
 
 # Setup docked files if present
 docked_path = os.path.join(os.path.abspath(sys.argv[1]), 'GlideDock')
+pose_stores = {}  # prefix -> (index files and sizes, PoseStore)
 
 
 def update_files(path, files, df):
@@ -61,6 +63,20 @@ def update_files(path, files, df):
             return df, files
 
 
+def update_pose_stores(path, stores):
+    # One store per archive prefix, only (re)loading the index when its files are new or have grown
+    idx_files = {}
+    for idx in glob(os.path.join(path, '*_poses_*.sdf.gz.idx')):
+        idx_files.setdefault(os.path.basename(idx).split('_poses_')[0], []).append(idx)
+    for prefix, files in idx_files.items():
+        signature = sorted((f, os.path.getsize(f)) for f in files)
+        if prefix not in stores:
+            stores[prefix] = (signature, PoseStore(path, prefix=prefix))
+        elif stores[prefix][0] != signature:
+            stores[prefix] = (signature, stores[prefix][1].load_index())
+    return [store for _, store in stores.values()]
+
+
 app = dash.Dash(__name__)
 
 app.layout = html.Div([
@@ -225,6 +241,7 @@ def display_selected_sdf(selectedData):
     global pdb_styles_dict
     global main_df
     global docked_path
+    global pose_stores
 
     if not os.path.exists(docked_path):
         return pdb_dict, pdb_styles_dict
@@ -235,11 +252,15 @@ def display_selected_sdf(selectedData):
         # Grab step and batch idx from selectedData
         idxs = [point['pointIndex'] for point in selectedData['points']]
         steps_batches = [(main_df.loc[idx, 'step'], main_df.loc[idx, 'batch_idx']) for idx in idxs]
-        # Grab sdf's for respective molecules
-        query_sdfs = [os.path.join(docked_path, f'{step}', f'{step}_{batch_idx}-*') for step, batch_idx in steps_batches]
-        glob_sdfs = [glob(sdf) for sdf in query_sdfs]
-        # Unpack list of lists
-        return_sdfs = [item for sublist in glob_sdfs for item in sublist]
+        # Grab poses from pose archives if present, otherwise sdf's for respective molecules
+        return_sdfs = []
+        stores = update_pose_stores(docked_path, pose_stores)
+        for step, batch_idx in steps_batches:
+            poses = [ps.get(f'{step}_{batch_idx}') for ps in stores if f'{step}_{batch_idx}' in ps]
+            if len(poses) > 0:
+                return_sdfs.extend([pose for pose in poses if pose is not None])
+            else:
+                return_sdfs.extend(glob(os.path.join(docked_path, f'{step}', f'{step}_{batch_idx}-*')))
         # Calculate new combined_dict and styles_dict
         sdf_dict = utils.sdf_to_dict(return_sdfs, max_pdb_index)
         combined_model_dict = {"atoms": pdb_dict['atoms'] + sdf_dict['atoms'],
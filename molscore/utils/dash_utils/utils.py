@@ -25,7 +25,7 @@ def sdf_to_dict(sdf_path, seed_index=0):
      # Bonds absolutely refers to atom list index, where if theres a keyerror
      # i.e. no corresponding atom, throws b or y not available error
      # However, doesn't render unless the atom serial number doesn't match up with atom index ...
-    :param sdf_path:
+    :param sdf_path: Path or list of paths (or rdkit mols)
     :param seed_index:
     :return:
     """
@@ -82,8 +82,12 @@ def sdf_to_dict(sdf_path, seed_index=0):
         bonds = []
         sdf_index = 0
         for i, p in enumerate(sdf_path):
+            # Already loaded e.g. from a pose store
+            if isinstance(p, Chem.rdchem.Mol):
+                mol = p
+                p = mol.GetProp('_Name') if mol.HasProp('_Name') else 'pose'
             # Load with rdkit
-            if 'gz' in os.path.basename(p):
+            elif 'gz' in os.path.basename(p):
                 with gzip.open(p) as f:
                     supp = Chem.rdmolfiles.ForwardSDMolSupplier(f, removeHs=False)
                     for i, mol in enumerate(supp):
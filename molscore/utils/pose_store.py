@@ -0,0 +1,125 @@
+"""
+Append-only store of docked poses in compressed multi-record files with an offset index
+"""
+
+import os
+import gzip
+import logging
+from io import StringIO
+from glob import glob
+
+from rdkit import Chem
+
+logger = logging.getLogger('pose_store')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+class PoseStore:
+    """
+    Store poses in one compressed file per step (or per N steps), each pose is written as a separate gzip member
+     so the file is a normal .sdf.gz, and an index ({archive}.idx) records the key, offset and length of each member
+     so single poses can be read without decompressing the whole file.
+    """
+    def __init__(self, directory: str, prefix: str = 'poses', steps_per_archive: int = 1):
+        """
+        Store poses in one compressed file per step (or per N steps) with an offset index.
+        :param directory: Directory to write archives to (e.g. save_dir/GlideDock)
+        :param prefix: Archive name prefix i.e. {prefix}_poses_{step}.sdf.gz
+        :param steps_per_archive: Number of steps per archive
+        """
+        self.directory = os.path.abspath(directory)
+        self.prefix = prefix
+        self.steps_per_archive = max(1, int(steps_per_archive))
+        self.index = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.load_index()
+
+    def archive_path(self, step: int):
+        """
+        Path of the archive holding poses for a step.
+        """
+        start = (int(step) // self.steps_per_archive) * self.steps_per_archive
+        return os.path.join(self.directory, f'{self.prefix}_poses_{start}.sdf.gz')
+
+    def load_index(self):
+        """
+        Read index files of existing archives in the directory.
+        """
+        self.index = {}
+        for idx_file in glob(os.path.join(self.directory, f'{self.prefix}_poses_*.sdf.gz.idx')):
+            archive = idx_file[:-len('.idx')]
+            with open(idx_file, 'rt') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    key, offset, length = line.split('\t')
+                    self.index[key] = (archive, int(offset), int(length))
+        return self
+
+    def add(self, step: int, poses: list):
+        """
+        Append poses to the archive for this step.
+        :param step: Step
+        :param poses: List of (key, rdkit mol) where key is e.g. {step}_{batch_idx}
+        """
+        if len(poses) == 0:
+            return self
+        archive = self.archive_path(step)
+        offset = os.path.getsize(archive) if os.path.exists(archive) else 0
+        index_lines = []
+        with open(archive, 'ab') as f:
+            for key, mol in poses:
+                sio = StringIO()
+                w = Chem.SDWriter(sio)
+                w.write(mol)
+                w.close()
+                member = gzip.compress(sio.getvalue().encode())
+                f.write(member)
+                self.index[key] = (archive, offset, len(member))
+                index_lines.append(f'{key}\t{offset}\t{len(member)}\n')
+                offset += len(member)
+        # Index is written after the data so it never points past the end of the archive
+        with open(f'{archive}.idx', 'at') as f:
+            f.writelines(index_lines)
+        return self
+
+    def get_block(self, key: str):
+        """
+        Read the SD record for a key.
+        :param key: e.g. {step}_{batch_idx}
+        :return: SD record string or None
+        """
+        if key not in self.index:
+            return None
+        archive, offset, length = self.index[key]
+        with open(archive, 'rb') as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length)).decode()
+
+    def get(self, key: str, removeHs: bool = False):
+        """
+        Read the pose for a key.
+        :param key: e.g. {step}_{batch_idx}
+        :param removeHs: Remove hydrogens
+        :return: rdkit mol or None
+        """
+        block = self.get_block(key)
+        if block is None:
+            return None
+        supp = Chem.SDMolSupplier()
+        supp.SetData(block, removeHs=removeHs)
+        return next(iter(supp), None)
+
+    def keys(self):
+        return list(self.index.keys())
+
+    def __contains__(self, key: str):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,193 @@
+"""
+Queryable SQLite copy of MolScore results, populated every step, for fast top-k, per-step and per-scaffold lookups
+"""
+
+import os
+import sqlite3
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+from rdkit.Chem import AllChem as Chem
+
+from molscore.scaffold_memory.ScaffoldCache import ScaffoldCache
+
+logger = logging.getLogger('run_history')
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+logger.addHandler(ch)
+
+
+def _quote(name: str):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+class RunHistory:
+    """
+    One row per scored molecule (as in scores.csv, keyed by the main dataframe index) plus its Murcko scaffold, in
+     an SQLite file with indexes on step, SMILES, scaffold and selected score columns.
+    """
+    def __init__(self, path: str, index_columns: list = (), scaffold_cache: ScaffoldCache = None):
+        """
+        SQLite copy of MolScore results.
+        :param path: Path to database file (.db), created if it doesn't exist
+        :param index_columns: Additional columns to index once they exist (e.g. score columns for top-k queries)
+        :param scaffold_cache: Scaffold cache to share (e.g. with the diversity filter)
+        """
+        self.path = os.path.abspath(path)
+        self.index_columns = list(index_columns)
+        self.scaffold_cache = scaffold_cache if scaffold_cache is not None else ScaffoldCache()
+        self.conn = None
+        self.connect()
+
+    def connect(self):
+        """
+        Open the database if it isn't open (e.g. to query after close).
+        """
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=60.0)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS scores (id INTEGER PRIMARY KEY, scaffold TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_scaffold ON scores (scaffold)")
+            self.conn.commit()
+        return self
+
+    @property
+    def columns(self):
+        return [row[1] for row in self.connect().conn.execute("PRAGMA table_info(scores)")]
+
+    @staticmethod
+    def _sql_type(dtype):
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(dtype):
+            return 'REAL'
+        return 'TEXT'
+
+    def _index(self, columns: list):
+        for column in columns:
+            if column in ['step', 'smiles'] + self.index_columns:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote('idx_' + column)} ON scores "
+                                  f"({_quote(column)})")
+
+    def add(self, df: pd.DataFrame):
+        """
+        Insert (or replace) rows of a MolScore dataframe, adding any new columns.
+        :param df: Dataframe with a unique index and a smiles column
+        """
+        if len(df) == 0:
+            return self
+        self.connect()
+        existing = set(self.columns)
+        new_columns = [c for c in df.columns if c not in existing]
+        for column in new_columns:
+            self.conn.execute(f"ALTER TABLE scores ADD COLUMN {_quote(column)} {self._sql_type(df[column].dtype)}")
+        self._index(new_columns)
+
+        scaffolds = [s[0] if s[0] is not None else '' for s in self.scaffold_cache.get_many(df['smiles'].tolist())]
+        values = df.astype(object).where(pd.notnull(df), None).values.tolist()
+        rows = [[int(i), scaffold] + [v.item() if isinstance(v, np.generic) else v for v in row]
+                for i, scaffold, row in zip(df.index, scaffolds, values)]
+        columns = ', '.join(_quote(c) for c in ['id', 'scaffold'] + list(df.columns))
+        placeholders = ', '.join(['?'] * (len(df.columns) + 2))
+        self.conn.executemany(f"INSERT OR REPLACE INTO scores ({columns}) VALUES ({placeholders})", rows)
+        self.conn.commit()
+        return self
+
+    def query(self, top: int = None, by: str = None, ascending: bool = False, steps: tuple = None,
+              scaffold: str = None, smiles: str = None, columns: list = None, where: str = None,
+              params: tuple = ()):
+        """
+        Query scored molecules, filters are combined with AND.
+        :param top: Return only the first top rows (after sorting)
+        :param by: Column to sort by (e.g. a score column for top-k)
+        :param ascending: Sort ascending rather than descending
+        :param steps: Step or (first, last) steps, inclusive
+        :param scaffold: Murcko scaffold SMILES, all molecules with this scaffold
+        :param smiles: SMILES, all occurrences of this molecule
+        :param columns: Columns to return (default all)
+        :param where: Additional SQL condition e.g. 'valid = ?'
+        :param params: Parameters for where
+        :return: pd.DataFrame indexed as the MolScore dataframe
+        """
+        # SQLite would treat unknown quoted names as strings, so check them
+        existing = self.columns
+        for column in (columns or []) + ([by] if by is not None else []):
+            if column not in existing:
+                raise ValueError(f'Unknown column {column}, found {existing}')
+
+        conditions = []
+        args = []
+        if steps is not None:
+            if isinstance(steps, (int, np.integer)):
+                steps = (steps, steps)
+            conditions.append("step BETWEEN ? AND ?")
+            args += [int(steps[0]), int(steps[1])]
+        if scaffold is not None:
+            mol = Chem.MolFromSmiles(scaffold)
+            conditions.append("scaffold = ?")
+            args.append(Chem.MolToSmiles(mol, isomericSmiles=False) if mol else scaffold)
+        if smiles is not None:
+            mol = Chem.MolFromSmiles(smiles)
+            conditions.append("smiles = ?")
+            args.append(Chem.MolToSmiles(mol) if mol else smiles)
+        if where is not None:
+            conditions.append(f"({where})")
+            args += list(params)
+
+        select = '*' if columns is None else ', '.join(_quote(c) for c in ['id'] + [c for c in columns if c != 'id'])
+        sql = f"SELECT {select} FROM scores"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if by is not None:
+            sql += f" ORDER BY {_quote(by)} {'ASC' if ascending else 'DESC'}, id"
+        else:
+            sql += " ORDER BY id"
+        if top is not None:
+            sql += " LIMIT ?"
+            args.append(int(top))
+        return pd.read_sql_query(sql, self.conn, params=args, index_col='id')
+
+    def close(self):
+        """
+        Close the database (checkpointing the write-ahead log), it's reopened if used again.
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a MolScore run history (scores.db)')
+    parser.add_argument('db', help='Path to scores.db in a MolScore output directory')
+    parser.add_argument('--top', type=int, help='Number of rows to return')
+    parser.add_argument('--by', help='Column to sort by, descending unless --ascending')
+    parser.add_argument('--ascending', action='store_true')
+    parser.add_argument('--steps', type=int, nargs='+', help='Step, or first and last step (inclusive)')
+    parser.add_argument('--scaffold', help='Murcko scaffold SMILES')
+    parser.add_argument('--smiles', help='SMILES')
+    parser.add_argument('--columns', nargs='+', help='Columns to return')
+    parser.add_argument('--where', help='Additional SQL condition')
+    parser.add_argument('--output', help='Write results to this csv file instead of stdout')
+    args = parser.parse_args()
+
+    assert os.path.exists(args.db), f'{args.db} not found'
+    steps = None
+    if args.steps is not None:
+        steps = (args.steps[0], args.steps[-1])
+    history = RunHistory(args.db)
+    df = history.query(top=args.top, by=args.by, ascending=args.ascending, steps=steps, scaffold=args.scaffold,
+                       smiles=args.smiles, columns=args.columns, where=args.where)
+    history.close()
+    if args.output is not None:
+        df.to_csv(args.output)
+    else:
+        print(df.to_csv(), end='')
+
+
+if __name__ == '__main__':
+    main()